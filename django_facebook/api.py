@@ -1,15 +1,20 @@
 from django.forms.util import ValidationError
 from django_facebook import settings as facebook_settings, signals
 from django_facebook.exceptions import FacebookException
-from django_facebook.utils import get_user_model, mass_get_or_create, \
+from django_facebook.membership import get_membership_index
+from django_facebook.utils import get_user_model, mass_upsert, delete_stale, \
+    fingerprint, combine_fingerprints, content_chunks, \
     cleanup_oauth_url, get_profile_model, parse_signed_request, hash_key, \
     try_get_profile, get_user_attribute
 from open_facebook import exceptions as open_facebook_exceptions
 from open_facebook.exceptions import OpenFacebookException
 from open_facebook.utils import send_warning, validate_is_instance
 import datetime
+import itertools
 import json
 import logging
+import time
+import uuid
 try:
     from dateutil.parser import parse as parse_date
 except ImportError:
@@ -124,8 +129,7 @@ def get_facebook_graph(request=None, access_token=None, redirect_uri=None, raise
         access_token = request.REQUEST['access_token']
     # should drop query params be included in the open facebook api,
     # maybe, weird this...
-    from open_facebook import OpenFacebook, FacebookAuthorization
-    from django.core.cache import cache
+    from open_facebook import OpenFacebook
     expires = None
     if hasattr(request, 'facebook') and request.facebook:
         logger.info("GFaG01 graph in request")
@@ -141,7 +145,7 @@ def get_facebook_graph(request=None, access_token=None, redirect_uri=None, raise
         signed_request_string = request.REQUEST.get('signed_data')
         if signed_request_string:
             logger.info('GFaG02 Got signed data from facebook')
-            signed_data = parse_signed_request(signed_request_string)
+            signed_data = parse_signed_request(signed_request_string, request)
         if signed_data:
             logger.info('GFaG03 We were able to parse the signed data')
 
@@ -165,7 +169,8 @@ def get_facebook_graph(request=None, access_token=None, redirect_uri=None, raise
                 signed_request_string = cookie_data
                 if signed_request_string:
                     logger.info('GFaG06 Got signed data from cookie')
-                signed_data = parse_signed_request(signed_request_string)
+                signed_data = parse_signed_request(
+                    signed_request_string, request)
                 if signed_data:
                     logger.info('GFaG07 Parsed the cookie data')
                 # the javascript api assumes a redirect uri of ''
@@ -184,42 +189,36 @@ def get_facebook_graph(request=None, access_token=None, redirect_uri=None, raise
 
         if not access_token:
             if code:
-                cache_key = hash_key('convert_code_%s' % code)
-                access_token = cache.get(cache_key)
-                if not access_token:
-                    # exchange the code for an access token
-                    # based on the php api
-                    # https://github.com/facebook/php-sdk/blob/master/src/base_facebook.php
-                    # create a default for the redirect_uri
-                    # when using the javascript sdk the default
-                    # should be '' an empty string
-                    # for other pages it should be the url
-                    if not redirect_uri:
-                        redirect_uri = ''
-
-                    # we need to drop signed_data, code and state
-                    redirect_uri = cleanup_oauth_url(redirect_uri)
-
-                    try:
-                        logger.info(
-                            'GFaG10 trying to convert the code with redirect uri: %s' % redirect_uri)
-                        # This is realy slow, that's why it's cached
-                        token_response = FacebookAuthorization.convert_code(
-                            code, redirect_uri=redirect_uri)
-                        expires = token_response.get('expires')
-                        access_token = token_response['access_token']
-                        # would use cookies instead, but django's cookie setting
-                        # is a bit of a mess
-                        cache.set(cache_key, access_token, 60 * 60 * 2)
-                    except (open_facebook_exceptions.OAuthException, open_facebook_exceptions.ParameterException), e:
-                        # this sometimes fails, but it shouldnt raise because
-                        # it happens when users remove your
-                        # permissions and then try to reauthenticate
-                        logger.warn('GFaG11 Error when trying to convert code %s' % unicode(e))
-                        if raise_:
-                            raise
-                        else:
-                            return None
+                # exchange the code for an access token
+                # based on the php api
+                # https://github.com/facebook/php-sdk/blob/master/src/base_facebook.php
+                # create a default for the redirect_uri
+                # when using the javascript sdk the default
+                # should be '' an empty string
+                # for other pages it should be the url
+                if not redirect_uri:
+                    redirect_uri = ''
+
+                # we need to drop signed_data, code and state
+                redirect_uri = cleanup_oauth_url(redirect_uri)
+
+                try:
+                    logger.info(
+                        'GFaG10 trying to convert the code with redirect uri: %s' % redirect_uri)
+                    # This is realy slow, that's why it's cached
+                    token_response = convert_code(
+                        code, redirect_uri=redirect_uri)
+                    expires = token_response.get('expires')
+                    access_token = token_response['access_token']
+                except (open_facebook_exceptions.OAuthException, open_facebook_exceptions.ParameterException), e:
+                    # this sometimes fails, but it shouldnt raise because
+                    # it happens when users remove your
+                    # permissions and then try to reauthenticate
+                    logger.warn('GFaG11 Error when trying to convert code %s' % unicode(e))
+                    if raise_:
+                        raise
+                    else:
+                        return None
             elif request.user.is_authenticated():
                 # support for offline access tokens stored in the users profile
                 logger.info('GFaG12 get access_token of authorised user with id = %s' % request.user.id)
@@ -249,6 +248,57 @@ def get_facebook_graph(request=None, access_token=None, redirect_uri=None, raise
     return graph
 
 
+def convert_code(code, redirect_uri=''):
+    '''
+    Exchanges the code for an access token, caching the result
+
+    Codes can only be used once, so when concurrent requests carry the
+    same code, only the request which acquires the lock converts it.
+    The others wait for the access token to show up in the cache, when
+    the converting request fails one of them takes over the lock.
+    The lock uses cache.add, so any Django cache backend works
+
+    :returns: dict with the access_token and, when we converted the code
+        ourselves, the expires
+    '''
+    from django.core.cache import cache
+    from open_facebook import FacebookAuthorization
+    cache_key = hash_key('convert_code_%s' % code)
+    access_token = cache.get(cache_key)
+    if access_token:
+        return dict(access_token=access_token)
+
+    lock_key = hash_key('convert_code_lock_%s' % code)
+    lock_timeout = facebook_settings.FACEBOOK_CONVERT_CODE_LOCK_TIMEOUT
+    acquired = cache.add(lock_key, 1, lock_timeout)
+    if not acquired:
+        logger.info('CC01 another request is converting the code, waiting')
+    wait_until = time.time() + lock_timeout
+    while not acquired:
+        if time.time() >= wait_until:
+            raise open_facebook_exceptions.FacebookUnreachable(
+                'Timed out waiting for another request to convert the code')
+        time.sleep(facebook_settings.FACEBOOK_CONVERT_CODE_POLL_INTERVAL)
+        access_token = cache.get(cache_key)
+        if access_token:
+            return dict(access_token=access_token)
+        if cache.get(lock_key) is None:
+            # the other request failed, only one of the waiters retries
+            acquired = cache.add(lock_key, 1, lock_timeout)
+            if acquired:
+                logger.info('CC02 no access token after waiting, converting')
+
+    try:
+        token_response = FacebookAuthorization.convert_code(
+            code, redirect_uri=redirect_uri)
+        # would use cookies instead, but django's cookie setting
+        # is a bit of a mess
+        cache.set(cache_key, token_response['access_token'], 60 * 60 * 2)
+    finally:
+        cache.delete(lock_key)
+    return token_response
+
+
 def _add_current_user_id(graph, user):
     '''
     set the current user id, convenient if you want to make sure you
@@ -268,6 +318,30 @@ def _add_current_user_id(graph, user):
                 graph.current_user_id = facebook_id
 
 
+def get_facebook_converter(request, graph=None):
+    '''
+    Returns the user conversion instance for the graph
+
+    Converters are stored on the request, so the views, connect flows
+    and signal handlers handling a request share one OpenFacebook instance
+    and fetch the profile data only once
+    '''
+    from django_facebook.utils import get_instance_for
+    if graph is None:
+        graph = get_facebook_graph(request)
+    converters = getattr(request, '_facebook_converters', None)
+    if converters is None:
+        converters = {}
+        if request is not None:
+            request._facebook_converters = converters
+    # the converter references the graph, so the id can't be reused
+    converter = converters.get(id(graph))
+    if converter is None:
+        converter = get_instance_for('user_conversion', graph)
+        converters[id(graph)] = converter
+    return converter
+
+
 class FacebookUserConverter(object):
 
     '''
@@ -286,6 +360,9 @@ class FacebookUserConverter(object):
         self._profile = None
 
     def is_authenticated(self):
+        if self._profile is not None:
+            # we already got the profile data, so we have access
+            return True
         return self.open_facebook.is_authenticated()
 
     def facebook_registration_data(self, username=True):
@@ -456,18 +533,63 @@ class FacebookUserConverter(object):
     def _create_unique_username(cls, base_username):
         '''
         Check the database and add numbers to the username to ensure its unique
+        Uses the next number after the highest one in use, so when john,
+        john1 and john7 are taken this returns john8
+        '''
+        user_model = get_user_model()
+        max_length = user_model._meta.get_field('username').max_length
+        base_username = str(base_username)
+        minimum = None
+        while True:
+            suffix = cls._highest_username_suffix(base_username)
+            if suffix is None and minimum is None:
+                return base_username
+            number = max((suffix or 0) + 1, minimum or 1)
+            username = base_username + str(number)
+            if len(username) <= max_length:
+                return username
+            # make room for the number
+            base_username = base_username[:max_length - len(str(number))]
+            minimum = number
+
+    @classmethod
+    def _highest_username_suffix(cls, base_username):
+        '''
+        Returns the highest number used after the base username, 0 if only
+        the base username is taken and None if it's available
         '''
-        usernames = list(
-            get_user_model().objects.filter(
-                username__istartswith=base_username
-            ).values_list('username', flat=True))
-        usernames_lower = [str(u).lower() for u in usernames]
-        username = str(base_username)
-        i = 1
-        while base_username.lower() in usernames_lower:
-            base_username = username + str(i)
-            i += 1
-        return base_username
+        usernames = cls._username_suffix_queryset(base_username)
+        highest = list(usernames.values_list('username', flat=True)[:1])
+        if not highest:
+            return None
+        suffix = highest[0][len(base_username):]
+        return int(suffix) if suffix else 0
+
+    @classmethod
+    def _username_suffix_queryset(cls, base_username):
+        '''
+        The usernames which are the base username followed by a number,
+        longest first
+
+        Generated usernames are lowercase, so they're compared case
+        sensitively. All of them sort between the base username and the
+        base username followed by nines, a range the unique index on
+        username can look up
+        '''
+        import re
+        from django.db import connection
+        user_model = get_user_model()
+        max_length = user_model._meta.get_field('username').max_length
+        highest = base_username + '9' * (max_length - len(base_username))
+        pattern = r'^%s([1-9][0-9]*)?$' % re.escape(base_username)
+        column = connection.ops.quote_name('username')
+        usernames = user_model.objects.filter(
+            username__gte=base_username, username__lte=highest)
+        usernames = usernames.filter(username__regex=pattern)
+        # the longest username has the highest number
+        usernames = usernames.extra(
+            select={'username_length': 'LENGTH(%s)' % column})
+        return usernames.order_by('-username_length', '-username')
 
     @classmethod
     def _retrieve_facebook_username(cls, facebook_data):
@@ -530,19 +652,34 @@ class FacebookUserConverter(object):
             self._get_and_store_likes(user)
 
     def _get_and_store_likes(self, user):
-        likes = self.get_likes()
-        stored_likes = self._store_likes(user, likes)
-        return stored_likes
+        '''
+        Streams the likes page by page into the db and removes the likes
+        which are no longer on facebook
+
+        :returns: the number of likes
+        '''
+        chunk_size = facebook_settings.FACEBOOK_STORE_CHUNK_SIZE
+        likes = self.iterate_likes(page_size=chunk_size)
+        return self._store_likes(user, likes, count=True, sync=True)
 
     def get_likes(self, limit=5000):
         '''
         Parses the facebook response and returns the likes
+        Follows the paging until all likes (or limit likes) are retrieved,
+        use iterate_likes to go over all of them
         '''
-        likes_response = self.open_facebook.get('me/likes', limit=limit)
-        likes = likes_response and likes_response.get('data')
+        likes = self.iterate_likes()
+        likes = list(itertools.islice(likes, limit))
         logger.info('found %s likes', len(likes))
         return likes
 
+    def iterate_likes(self, page_size=500):
+        '''
+        Lazily yields the likes one at a time, use this instead of
+        get_likes to keep memory usage bounded for users with many likes
+        '''
+        return self.open_facebook.iterate('me/likes', page_size=page_size)
+
     def store_likes(self, user, likes):
         '''
         Given a user and likes store these in the db
@@ -556,40 +693,58 @@ class FacebookUserConverter(object):
             self._store_likes(user, likes)
 
     @classmethod
-    def _store_likes(self, user, likes):
-        current_likes = inserted_likes = None
-
-        if likes:
-            from django_facebook.models import FacebookLike
-            base_queryset = FacebookLike.objects.filter(user_id=user.id)
-            global_defaults = dict(user_id=user.id)
-            id_field = 'facebook_id'
-            default_dict = {}
-            for like in likes:
-                name = like.get('name')
-                created_time_string = like.get('created_time')
-                created_time = None
-                if created_time_string:
-                    created_time = parse_date(like['created_time'])
-                default_dict[like['id']] = dict(
-                    created_time=created_time,
-                    category=like.get('category'),
-                    name=name
-                )
-            current_likes, inserted_likes = mass_get_or_create(
-                FacebookLike, base_queryset, id_field, default_dict,
-                global_defaults)
-            logger.debug('found %s likes and inserted %s new likes',
-                         len(current_likes), len(inserted_likes))
-
-        # fire an event, so u can do things like personalizing the users' account
-        # based on the likes
-        signals.facebook_post_store_likes.send(sender=get_profile_model(),
-                                               user=user, likes=likes, current_likes=current_likes,
-                                               inserted_likes=inserted_likes,
-                                               )
+    def _store_likes(self, user, likes, count=False, sync=False):
+        '''
+        Stores the likes in chunks of FACEBOOK_STORE_CHUNK_SIZE, likes can
+        be any iterable, so a generator is never loaded at once
+        New likes are inserted and renamed pages are updated
 
-        return likes
+        :param sync:
+            the likes are complete, delete the stored likes which
+            aren't in there
+
+        :returns: the likes, or their number when count is True
+        '''
+        from django_facebook.models import FacebookLike
+        stored = self._store_in_chunks(
+            user, likes, FacebookLike, self._store_likes_chunk,
+            fields=('id', 'name', 'category', 'created_time'),
+            signal=signals.facebook_post_store_likes, name='likes',
+            sync=sync)
+        return stored if count else likes
+
+    @classmethod
+    def _store_likes_chunk(self, user, likes, changed=True):
+        '''
+        :returns: the ids of the likes which were already stored and the
+            inserted likes
+        '''
+        from django_facebook.models import FacebookLike
+        if not changed:
+            # stored during the previous sync
+            return [l['id'] for l in likes], []
+
+        base_queryset = FacebookLike.objects.filter(user_id=user.id)
+        global_defaults = dict(user_id=user.id)
+        id_field = 'facebook_id'
+        default_dict = {}
+        for like in likes:
+            name = like.get('name')
+            created_time_string = like.get('created_time')
+            created_time = None
+            if created_time_string:
+                created_time = parse_date(like['created_time'])
+            default_dict[like['id']] = dict(
+                created_time=created_time,
+                category=like.get('category'),
+                name=name
+            )
+        current_ids, inserted_likes, updated = mass_upsert(
+            FacebookLike, base_queryset, id_field, default_dict,
+            global_defaults)
+        logger.debug('found %s likes, inserted %s and updated %s',
+                     len(current_ids), len(inserted_likes), updated)
+        return current_ids, inserted_likes
 
     def get_and_store_friends(self, user):
         '''
@@ -605,15 +760,32 @@ class FacebookUserConverter(object):
 
     def _get_and_store_friends(self, user):
         '''
-        Getting the friends via fb and storing them
+        Streams the friends page by page into the db and removes the
+        friends which are no longer on facebook
+
+        :returns: the number of friends
+        '''
+        chunk_size = facebook_settings.FACEBOOK_STORE_CHUNK_SIZE
+        friends = self.iterate_friends(page_size=chunk_size)
+        return self._store_friends(user, friends, count=True, sync=True)
+
+    def iterate_friends(self, page_size=500):
+        '''
+        Lazily yields the friends one at a time, in the same format as
+        get_friends, by following the paging of me/friends
         '''
-        friends = self.get_friends()
-        stored_friends = self._store_friends(user, friends)
-        return stored_friends
+        friends = self.open_facebook.iterate(
+            'me/friends', page_size=page_size, fields='id,name,gender')
+        for friend in friends:
+            yield dict(id=friend['id'], uid=friend['id'],
+                       name=friend.get('name'), sex=friend.get('gender'))
 
     def get_friends(self, limit=5000):
         '''
         Connects to the facebook api and gets the users friends
+
+        FQL has no paging, so this loads up to limit friends from a single
+        response into memory. Use iterate_friends to stream all of them
         '''
         friends = getattr(self, '_friends', None)
         if friends is None:
@@ -644,64 +816,343 @@ class FacebookUserConverter(object):
             self._store_friends(user, friends)
 
     @classmethod
-    def _store_friends(self, user, friends):
+    def _store_friends(self, user, friends, count=False, sync=False):
+        '''
+        Stores the friends in chunks of FACEBOOK_STORE_CHUNK_SIZE
+        New friends are inserted, changed names and genders are updated
+
+        :param sync:
+            the friends are complete, delete the stored friends which
+            aren't in there
+
+        :returns: the friends, or their number when count is True
+        '''
+        from django_facebook.models import FacebookUser, FacebookUserNameToken
+        stored = self._store_in_chunks(
+            user, friends or [], FacebookUser, self._store_friends_chunk,
+            fields=('id', 'name', 'sex'),
+            signal=signals.facebook_post_store_friends, name='friends',
+            sync=sync)
+        if sync and stored and facebook_settings.FACEBOOK_NAME_SEARCH_INDEX:
+            FacebookUserNameToken.objects.delete_orphans(user.id)
+        return stored if count else friends
+
+    @classmethod
+    def _store_friends_chunk(self, user, friends, changed=True):
+        '''
+        :returns: the ids of the friends which were already stored and the
+            inserted friends
+        '''
         from django_facebook.models import FacebookUser
-        current_friends = inserted_friends = None
+        if not changed:
+            # stored during the previous sync
+            return [f['id'] for f in friends], []
 
         # store the users for later retrieval
-        if friends:
-            # see which ids this user already stored
-            base_queryset = FacebookUser.objects.filter(user_id=user.id)
-            # if none if your friend have a gender clean the old data
-            genders = FacebookUser.objects.filter(
-                user_id=user.id, gender__in=('M', 'F')).count()
-            if not genders:
-                FacebookUser.objects.filter(user_id=user.id).delete()
-
-            global_defaults = dict(user_id=user.id)
-            default_dict = {}
-            gender_map = dict(female='F', male='M')
-            gender_map['male (hidden)'] = 'M'
-            gender_map['female (hidden)'] = 'F'
-            for f in friends:
-                name = f.get('name')
-                gender = None
-                if f.get('sex'):
-                    gender = gender_map[f.get('sex')]
-                default_dict[str(f['id'])] = dict(name=name, gender=gender)
-            id_field = 'facebook_id'
-
-            current_friends, inserted_friends = mass_get_or_create(
-                FacebookUser, base_queryset, id_field, default_dict,
-                global_defaults)
-            logger.debug('found %s friends and inserted %s new ones',
-                         len(current_friends), len(inserted_friends))
-
-        # fire an event, so u can do things like personalizing suggested users
-        # to follow
-        signals.facebook_post_store_friends.send(sender=get_profile_model(),
-                                                 user=user, friends=friends, current_friends=current_friends,
-                                                 inserted_friends=inserted_friends,
-                                                 )
+        base_queryset = FacebookUser.objects.filter(user_id=user.id)
+        global_defaults = dict(user_id=user.id)
+        default_dict = {}
+        gender_map = dict(female='F', male='M')
+        gender_map['male (hidden)'] = 'M'
+        gender_map['female (hidden)'] = 'F'
+        for f in friends:
+            name = f.get('name')
+            gender = None
+            if f.get('sex'):
+                gender = gender_map[f.get('sex')]
+            default_dict[str(f['id'])] = dict(name=name, gender=gender)
+        id_field = 'facebook_id'
+
+        current_ids, inserted_friends, updated = mass_upsert(
+            FacebookUser, base_queryset, id_field, default_dict,
+            global_defaults)
+        logger.debug('found %s friends, inserted %s and updated %s',
+                     len(current_ids), len(inserted_friends), updated)
+        if facebook_settings.FACEBOOK_NAME_SEARCH_INDEX:
+            self._store_name_tokens(
+                base_queryset, [f['id'] for f in friends])
+        return current_ids, inserted_friends
 
-        return friends
+    @classmethod
+    def _store_name_tokens(self, base_queryset, facebook_ids):
+        '''
+        Updates the name tokens which find_users searches
+        '''
+        from django_facebook.models import FacebookUserNameToken
+        facebook_users = base_queryset.filter(
+            facebook_id__in=facebook_ids).values_list('pk', 'user_id', 'name')
+        inserted = FacebookUserNameToken.objects.update_tokens(facebook_users)
+        logger.debug('stored %s name tokens', inserted)
+
+    @classmethod
+    def _store_in_chunks(self, user, items, model_class, store_chunk, fields,
+                         signal, name, sync=False):
+        '''
+        Calls store_chunk for every chunk of items and sends the signal
+        once all of them are stored
+
+        Chunk boundaries depend on the item ids, see content_chunks, and
+        chunks are fingerprinted using the given fields. A chunk which
+        was stored during the previous run is passed with changed=False
+        and isn't compared to the db again. When the fingerprint of all
+        items didn't change either, the stale records aren't searched
+
+        The fingerprints are only trusted when the number of stored
+        records still matches, so rows which were deleted or rolled back
+        since then are stored again
+
+        :returns: the number of items
+        '''
+        from django.core.cache import cache
+        timeout = facebook_settings.FACEBOOK_STORE_FINGERPRINT_TIMEOUT
+        chunk_size = facebook_settings.FACEBOOK_STORE_CHUNK_SIZE
+        cache_key = self._fingerprint_cache_key(model_class, user)
+        base_queryset = model_class.objects.filter(user_id=user.id)
+        previous = (timeout and cache.get(cache_key)) or {}
+        count = None
+        if previous:
+            count = base_queryset.count()
+            if count != previous.get('count'):
+                logger.info('stored %s changed, not using the fingerprints',
+                            model_class._meta.verbose_name_plural)
+                previous = {}
+        previous_chunks = previous.get('chunks') or ()
+        # receivers get all items, only keep them when someone listens
+        collected = None
+        if not isinstance(items, (list, tuple)) and signal.receivers:
+            collected = []
+
+        if isinstance(items, (list, tuple)):
+            # the same items give the same chunks in any order
+            ordered = sorted(items, key=lambda item: item['id'])
+        else:
+            ordered = items
+
+        stored = 0
+        seen_ids = set()
+        current_ids = []
+        inserted = []
+        chunk_fingerprints = []
+        for chunk in content_chunks(ordered, chunk_size):
+            chunk_fingerprint = fingerprint(chunk, fields)
+            chunk_fingerprints.append(chunk_fingerprint)
+            chunk_current_ids, chunk_inserted = store_chunk(
+                user, chunk, changed=chunk_fingerprint not in previous_chunks)
+            current_ids.extend(chunk_current_ids)
+            inserted.extend(chunk_inserted)
+            stored += len(chunk)
+            if sync:
+                seen_ids.update([item['id'] for item in chunk])
+            if collected is not None:
+                collected.extend(chunk)
+        full_fingerprint = combine_fingerprints(chunk_fingerprints)
+        changed = full_fingerprint != previous.get('fingerprint')
+
+        deleted = 0
+        # an empty response is more likely an error than removing everything
+        if sync and seen_ids and changed:
+            deleted = delete_stale(
+                base_queryset, 'facebook_id', seen_ids, chunk_size=chunk_size)
+        if timeout:
+            if count is None:
+                count = base_queryset.count()
+            else:
+                count += len(inserted) - deleted
+            # only a sync tells us the full list is stored
+            full = full_fingerprint if sync else previous.get('fingerprint')
+            cache.set(cache_key, dict(fingerprint=full, count=count,
+                                      chunks=chunk_fingerprints), timeout)
+        logger.info('stored %s %s, deleted %s', stored,
+                    model_class._meta.verbose_name_plural, deleted)
+
+        current = None
+        if stored:
+            # lazy, only evaluated by receivers which use it
+            current = base_queryset.filter(facebook_id__in=current_ids)
+        else:
+            inserted = None
+        signal_kwargs = {
+            name: items if collected is None else collected,
+            'current_%s' % name: current,
+            'inserted_%s' % name: inserted,
+        }
+        signal.send(sender=get_profile_model(), user=user, changed=changed,
+                    **signal_kwargs)
+        return stored
+
+    @classmethod
+    def _fingerprint_cache_key(self, model_class, user):
+        return 'django_facebook:fingerprint:%s:%s' % (
+            model_class._meta.db_table, user.id)
+
+    @classmethod
+    def _stored_friends_fresh(self, user):
+        '''
+        The stored friends are complete when they were synced within
+        FACEBOOK_STORE_FINGERPRINT_TIMEOUT
+        '''
+        from django.core.cache import cache
+        from django_facebook.models import FacebookUser
+        if not facebook_settings.FACEBOOK_STORE_FINGERPRINT_TIMEOUT:
+            return False
+        cache_key = self._fingerprint_cache_key(FacebookUser, user)
+        fingerprints = cache.get(cache_key) or {}
+        return bool(fingerprints.get('fingerprint'))
 
     def registered_friends(self, user):
         '''
         Returns all profile models which are already registered on your site
         and a list of friends which are not on your site
+
+        Uses the stored friends when they are fresh, otherwise the friends
+        are requested from Facebook. The result is cached for
+        FACEBOOK_REGISTERED_FRIENDS_CACHE_TIMEOUT, until the friends are
+        stored again or someone registers or connects
+
+        The friends which are not on your site are dicts with the id and
+        uid (both strings), name and sex
         '''
+        from django.core.cache import cache
         profile_class = get_profile_model()
-        friends = self.get_friends(limit=1000)
+        timeout = facebook_settings.FACEBOOK_REGISTERED_FRIENDS_CACHE_TIMEOUT
+        cache_key = registered_friends_cache_key(user)
+        cached = cache.get(cache_key) if timeout else None
+        if cached is None:
+            if self._stored_friends_fresh(user):
+                cached = self._registered_stored_friends(user)
+            else:
+                cached = self._registered_facebook_friends(user)
+            if timeout:
+                cache.set(cache_key, cached, timeout)
 
-        if friends:
-            friend_ids = [f['id'] for f in friends]
-            friend_objects = profile_class.objects.filter(
-                facebook_id__in=friend_ids).select_related('user')
-            registered_ids = [f.facebook_id for f in friend_objects]
-            new_friends = [f for f in friends if f['id'] not in registered_ids]
+        profile_ids, new_friends = cached
+        friend_objects = profile_class.objects.filter(
+            pk__in=profile_ids).select_related('user')
+        return friend_objects, new_friends
+
+    @classmethod
+    def _registered_stored_friends(self, user):
+        '''
+        Splits the stored friends in the database, using a subquery
+        '''
+        from django.db import router
+        from django_facebook.models import FacebookUser
+        profile_class = get_profile_model()
+        stored_friends = FacebookUser.objects.filter(user_id=user.id)
+        friend_ids = stored_friends.values('facebook_id')
+        if router.db_for_read(FacebookUser) != \
+                router.db_for_read(profile_class):
+            # different databases, so no subquery
+            friend_ids = list(friend_ids.values_list('facebook_id', flat=True))
+        registered = profile_class.objects.filter(facebook_id__in=friend_ids)
+        profile_ids = list(registered.values_list('pk', flat=True))
+        if isinstance(friend_ids, list):
+            registered_ids = list(
+                registered.values_list('facebook_id', flat=True))
         else:
-            new_friends = []
-            friend_objects = profile_class.objects.none()
+            registered_ids = registered.values('facebook_id')
+        gender_map = dict(F='female', M='male')
+        new_friends = []
+        non_members = stored_friends.exclude(
+            facebook_id__in=registered_ids).values_list(
+            'facebook_id', 'name', 'gender')
+        for facebook_id, name, gender in non_members:
+            new_friends.append(self._new_friend_dict(
+                facebook_id, name, gender_map.get(gender)))
+        return profile_ids, new_friends
 
-        return friend_objects, new_friends
+    @classmethod
+    def _new_friend_dict(self, facebook_id, name, sex):
+        '''
+        Both ways of splitting the friends return the same dicts
+        '''
+        facebook_id = str(facebook_id)
+        return dict(id=facebook_id, uid=facebook_id, name=name, sex=sex)
+
+    def _registered_facebook_friends(self, user):
+        '''
+        Splits the friends from Facebook using a set of the registered ids
+        '''
+        profile_class = get_profile_model()
+        friends = self.get_friends(limit=1000)
+        profile_ids = []
+        new_friends = []
+        if friends:
+            friend_ids = [int(f['id']) for f in friends]
+            membership_index = get_membership_index()
+            if membership_index is not None:
+                # only query the ids which might be registered
+                friend_ids = membership_index.filter(friend_ids)
+            registered = []
+            if friend_ids:
+                registered = profile_class.objects.filter(
+                    facebook_id__in=friend_ids).values_list(
+                    'pk', 'facebook_id')
+            registered_ids = set()
+            for profile_id, facebook_id in registered:
+                profile_ids.append(profile_id)
+                registered_ids.add(int(facebook_id))
+            new_friends = [
+                self._new_friend_dict(f['id'], f.get('name'), f.get('sex'))
+                for f in friends if int(f['id']) not in registered_ids]
+        return profile_ids, new_friends
+
+
+def _registered_friends_version():
+    '''
+    A version which changes when someone registers or connects, since that
+    changes the registered friends of other users
+    '''
+    from django.core.cache import cache
+    version = cache.get(REGISTERED_FRIENDS_VERSION_KEY)
+    if version is None:
+        # an expired version must never match old entries, so we
+        # always start with a random version
+        cache.add(REGISTERED_FRIENDS_VERSION_KEY, uuid.uuid4().hex,
+                  REGISTERED_FRIENDS_VERSION_TIMEOUT)
+        version = cache.get(REGISTERED_FRIENDS_VERSION_KEY)
+    return version
+
+
+def registered_friends_cache_key(user):
+    return 'django_facebook:registered_friends:%s:%s' % (
+        _registered_friends_version(), user.id)
+
+
+def non_member_friends_cache_key(user, gender=None):
+    return 'django_facebook:non_member_friends:%s:%s:%s' % (
+        _registered_friends_version(), user.id, gender or '')
+
+
+def invalidate_registered_friends(sender, user, changed=True, **kwargs):
+    '''
+    Drops the registered and non member friends of the user when the
+    stored friends changed
+    '''
+    from django.core.cache import cache
+    if changed:
+        keys = [registered_friends_cache_key(user)]
+        keys += [non_member_friends_cache_key(user, gender)
+                 for gender in (None, 'M', 'F')]
+        cache.delete_many(keys)
+
+
+def invalidate_all_registered_friends(sender, **kwargs):
+    '''
+    A new registration or connect can change everybody's registered friends
+    '''
+    from django.core.cache import cache
+    cache.set(REGISTERED_FRIENDS_VERSION_KEY, uuid.uuid4().hex,
+              REGISTERED_FRIENDS_VERSION_TIMEOUT)
+
+
+REGISTERED_FRIENDS_VERSION_KEY = 'django_facebook:registered_friends:version'
+# explicit, None means the default timeout on Django < 1.6
+REGISTERED_FRIENDS_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+signals.facebook_post_store_friends.connect(
+    invalidate_registered_friends,
+    dispatch_uid='django_facebook.invalidate_registered_friends')
+signals.facebook_user_registered.connect(
+    invalidate_all_registered_friends,
+    dispatch_uid='django_facebook.invalidate_all_registered_friends')
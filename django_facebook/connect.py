@@ -7,16 +7,17 @@ from django.db.utils import IntegrityError
 import json
 from django_facebook import exceptions as facebook_exceptions, \
     settings as facebook_settings, signals
-from django_facebook.api import get_facebook_graph
+from django_facebook.api import get_facebook_graph, get_facebook_converter, \
+    invalidate_all_registered_friends
 from django_facebook.utils import get_registration_backend, get_form_class, \
-    get_profile_model, to_bool, get_user_model, get_instance_for,\
+    get_profile_model, to_bool, get_user_model,\
     get_user_attribute, try_get_profile, get_model_for_attribute,\
     get_instance_for_attribute, update_user_attributes
+from open_facebook.pool import build_opener
 from social_auth.models import UserSocialAuth
 from random import randint
 import logging
 import sys
-import urllib2
 from urlparse import urlparse
 
 from bongoregistration.models import FacebookUserProfile
@@ -24,6 +25,10 @@ from bongoregistration.models import FacebookUserProfile
 logger = logging.getLogger(__name__)
 
 
+# how often registration is tried when the username is taken concurrently
+REGISTER_ATTEMPTS = 3
+
+
 class CONNECT_ACTIONS:
 
     class LOGIN:
@@ -39,21 +44,27 @@ class CONNECT_ACTIONS:
         pass
 
 
-def connect_user(request, access_token=None, facebook_graph=None, connect_facebook=False):
+def connect_user(request, access_token=None, facebook_graph=None, connect_facebook=False,
+                 converter=None):
     '''
     Given a request either
 
     - (if authenticated) connect the user
     - login
     - register
+
+    Pass the converter if you already have one, so the profile data
+    isn't requested again
     '''
     logger.info('CU01: Start data access_token %s' % access_token)
     logger.info('CU02: Start data facebook_graph %s' % facebook_graph)
     logger.info('CU03: Connect facebook %s' % connect_facebook)
     user = None
-    graph = facebook_graph or get_facebook_graph(request, access_token)
-
-    converter = get_instance_for('user_conversion', graph)
+    if converter is not None:
+        graph = converter.open_facebook
+    else:
+        graph = facebook_graph or get_facebook_graph(request, access_token)
+        converter = get_facebook_converter(request, graph)
 
     assert converter.is_authenticated()
     facebook_data = converter.facebook_profile_data()
@@ -296,26 +307,45 @@ def _register_user(request, facebook, profile_callback=None,
 
     if not existing_user:
         logger.info("RU04 No existing user, need to create one")
-        if not form.is_valid():
-            # show errors in sentry
-            form_errors = form.errors
-            error = facebook_exceptions.IncompleteProfileError(
-                'Facebook signup incomplete')
-            error.form = form
-            raise error
-        try:
-            # for new registration systems use the backends methods of saving
-            if backend:
-                new_user = backend.register(request,
-                                            form=form, **form.cleaned_data)
-            # fall back to the form approach
-            if new_user is None:
-                raise ValueError(
-                    'new_user is None, note that backward compatability for the older versions of django registration has been dropped.')
-        except IntegrityError, e:
-            # this happens when users click multiple times, the first request registers
-            # the second one raises an error
-            raise facebook_exceptions.AlreadyRegistered(e)
+        for attempt in range(REGISTER_ATTEMPTS):
+            if not form.is_valid():
+                # show errors in sentry
+                form_errors = form.errors
+                error = facebook_exceptions.IncompleteProfileError(
+                    'Facebook signup incomplete')
+                error.form = form
+                raise error
+            sid = transaction.savepoint()
+            try:
+                # for new registration systems use the backends methods of saving
+                if backend:
+                    new_user = backend.register(request,
+                                                form=form, **form.cleaned_data)
+                # fall back to the form approach
+                if new_user is None:
+                    raise ValueError(
+                        'new_user is None, note that backward compatability for the older versions of django registration has been dropped.')
+                transaction.savepoint_commit(sid)
+                break
+            except IntegrityError, e:
+                transaction.savepoint_rollback(sid)
+                username = form.cleaned_data.get('username')
+                already_registered = _get_old_connections(
+                    facebook_data['facebook_id']).exists()
+                # only retry usernames we generated ourselves
+                username_taken = not request.POST.get('username') and \
+                    get_user_model().objects.filter(username=username).exists()
+                if already_registered or not username_taken or \
+                        attempt == REGISTER_ATTEMPTS - 1:
+                    # this happens when users click multiple times, the first request registers
+                    # the second one raises an error
+                    raise facebook_exceptions.AlreadyRegistered(e)
+                # someone else registered the same username in the meantime
+                logger.info('RU05 username %s was taken, retrying', username)
+                data['username'] = facebook.facebook_registration_data()[
+                    'username']
+                form = form_class(data=data, files=request.FILES,
+                                  initial={'ip': request.META['REMOTE_ADDR']})
 
         signals.facebook_user_registered.send(sender=get_user_model(),
                                               user=new_user, facebook_data=facebook_data, request=request)
@@ -359,7 +389,10 @@ def _remove_old_connections(facebook_id, current_user_id=None):
     '''
     other_facebook_accounts = _get_old_connections(
         facebook_id, current_user_id)
-    other_facebook_accounts.update(facebook_id=None)
+    # save them one by one, so post_save updates the cached profiles
+    for account in other_facebook_accounts:
+        account.facebook_id = None
+        account.save()
 
 
 def _update_user(user, facebook, overwrite=True):
@@ -428,6 +461,9 @@ def _update_user(user, facebook, overwrite=True):
         user.save()
     if getattr(profile, '_fb_is_dirty', False):
         profile.save()
+    if facebook_id_overwritten:
+        # connecting an account changes the registered friends of others
+        invalidate_all_registered_friends(sender=get_user_model())
 
     signals.facebook_post_update.send(sender=get_user_model(),
                                       user=user, profile=profile, facebook_data=facebook_data)
@@ -443,7 +479,7 @@ def _update_image(facebook_id, image_url):
     '''
     image_name = 'fb_image_%s.jpg' % facebook_id
     image_temp = NamedTemporaryFile()
-    image_response = urllib2.urlopen(image_url)
+    image_response = build_opener().open(image_url)
     image_content = image_response.read()
     image_temp.write(image_content)
     http_message = image_response.info()
@@ -465,7 +501,7 @@ def update_connection(request, graph):
     - sets the facebook_id if nothing is specified
     - stores friends and likes if possible
     '''
-    converter = get_instance_for('user_conversion', graph)
+    converter = get_facebook_converter(request, graph)
     user = _connect_user(request, converter, overwrite=False)
     _update_likes_and_friends(request, user, converter)
     _update_access_token(user, graph)
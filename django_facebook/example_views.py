@@ -73,7 +73,7 @@ def canvas(request, graph):
     signed_request_string = request.POST.get('signed_request')
     signed_request = {}
     if signed_request_string:
-        signed_request = parse_signed_request(signed_request_string)
+        signed_request = parse_signed_request(signed_request_string, request)
     context['signed_request'] = signed_request
     likes = []
     if graph:
@@ -91,7 +91,7 @@ def page_tab(request, graph):
     # get signed_request
     context = RequestContext(request)
     signed_request_string = request.POST['signed_request']
-    signed_request = parse_signed_request(signed_request_string)
+    signed_request = parse_signed_request(signed_request_string, request)
     context['signed_request'] = signed_request
 
     return render_to_response('django_facebook/page_tab.html', context)
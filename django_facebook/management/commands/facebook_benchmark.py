@@ -0,0 +1,77 @@
+from django.core.management.base import CommandError
+from django_facebook.management.commands.base import CustomBaseCommand
+from django_facebook.test_utils import benchmarks
+from optparse import make_option
+
+
+class Command(CustomBaseCommand):
+    help = 'Runs the Django Facebook benchmarks, optionally comparing them ' \
+        'to a stored baseline. Usage: facebook_benchmark [name name ...]'
+    option_list = CustomBaseCommand.option_list + (
+        make_option('--repeat',
+                    type='int',
+                    dest='repeat',
+                    default=3,
+                    help='How often to repeat every benchmark'
+                    ),
+        make_option('--save',
+                    dest='save',
+                    default=None,
+                    help='Store the results as a baseline in this file'
+                    ),
+        make_option('--compare',
+                    dest='compare',
+                    default=None,
+                    help='Compare the results to the baseline in this file'
+                    ),
+        make_option('--tolerance',
+                    type='float',
+                    dest='tolerance',
+                    default=0.2,
+                    help='Fail when a benchmark is this much slower than '
+                    'the baseline'
+                    ),
+    )
+
+    def handle(self, *args, **kwargs):
+        CustomBaseCommand.handle(self, *args, **kwargs)
+        names = list(args) or sorted(benchmarks.BENCHMARKS.keys())
+        database = [n for n in names
+                    if getattr(benchmarks.BENCHMARKS.get(n), 'database', False)]
+
+        # never touch the real data, the database benchmarks get a
+        # test database
+        try:
+            with benchmarks.benchmark_database(enabled=bool(database)):
+                results = benchmarks.run_benchmarks(
+                    names, repeat=kwargs['repeat'])
+        except ValueError, e:
+            raise CommandError(unicode(e))
+
+        for name in names:
+            result = results[name]
+            self.log.info('%-25s best %10.3fms mean %10.3fms (%s calls)',
+                          name, result['best'] * 1000,
+                          result['mean'] * 1000, result['number'])
+
+        if kwargs['save']:
+            benchmarks.save_baseline(kwargs['save'], results)
+            self.log.info('stored the baseline in %s', kwargs['save'])
+
+        if kwargs['compare']:
+            baseline = benchmarks.load_baseline(kwargs['compare'])
+            comparison = benchmarks.compare(
+                results, baseline, tolerance=kwargs['tolerance'])
+            regressions = []
+            for name, previous, current, ratio, regression in comparison:
+                if ratio is None:
+                    self.log.info('%-25s not in the baseline', name)
+                    continue
+                self.log.info('%-25s %6.2fx the baseline%s', name, ratio,
+                              ' REGRESSION' if regression else '')
+                if regression:
+                    regressions.append(name)
+            if regressions:
+                raise CommandError(
+                    'Benchmarks slower than the baseline: %s' %
+                    ', '.join(regressions))
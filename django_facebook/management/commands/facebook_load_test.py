@@ -0,0 +1,42 @@
+from django_facebook.management.commands.base import CustomBaseCommand
+from django_facebook.test_utils import benchmarks
+from django_facebook.test_utils.load import ConnectLoadTest
+from optparse import make_option
+
+
+class Command(CustomBaseCommand):
+    help = 'Drives the connect view through the register, login and ' \
+        'connect flows against a local fake Graph server and reports ' \
+        'the throughput and latency'
+    option_list = CustomBaseCommand.option_list + (
+        make_option('--users',
+                    type='int',
+                    dest='users',
+                    default=1000,
+                    help='The number of synthetic users'
+                    ),
+        make_option('--latency-scale',
+                    type='float',
+                    dest='latency_scale',
+                    default=1.0,
+                    help='Multiplies the simulated Graph latency, '
+                    '0 disables it'
+                    ),
+        make_option('--seed',
+                    type='int',
+                    dest='seed',
+                    default=None,
+                    help='Seed for the simulated latency'
+                    ),
+    )
+
+    def handle(self, *args, **kwargs):
+        CustomBaseCommand.handle(self, *args, **kwargs)
+        load_test = ConnectLoadTest(users=kwargs['users'],
+                                    latency_scale=kwargs['latency_scale'],
+                                    seed=kwargs['seed'])
+        # the synthetic users are created in a test database
+        with benchmarks.benchmark_database():
+            report = load_test.run()
+        for line in load_test.format_report(report).splitlines():
+            self.log.info(line)
@@ -0,0 +1,16 @@
+from django_facebook.management.commands.base import CustomBaseCommand
+from django_facebook.membership import membership_index
+import time
+
+
+class Command(CustomBaseCommand):
+    help = 'Rebuilds the index of registered facebook ids, every process ' \
+        'rebuilds its snapshot from the database on the next check'
+
+    def handle(self, *args, **kwargs):
+        CustomBaseCommand.handle(self, *args, **kwargs)
+        start = time.time()
+        membership_index.invalidate()
+        membership_index.rebuild()
+        self.log.info('rebuilt the membership index in %.3fs',
+                      time.time() - start)
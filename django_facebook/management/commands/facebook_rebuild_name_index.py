@@ -0,0 +1,29 @@
+from django_facebook import settings as facebook_settings
+from django_facebook.management.commands.base import CustomBaseCommand
+from django_facebook.models import FacebookUser, FacebookUserNameToken
+
+
+class Command(CustomBaseCommand):
+    help = 'Indexes the names of all stored friends for find_users, ' \
+        'see FACEBOOK_NAME_SEARCH_INDEX'
+
+    def handle(self, *args, **kwargs):
+        CustomBaseCommand.handle(self, *args, **kwargs)
+        chunk_size = facebook_settings.FACEBOOK_STORE_CHUNK_SIZE
+        friends = FacebookUser.objects.order_by('pk').values_list(
+            'pk', 'user_id', 'name')
+        last_pk = 0
+        indexed = inserted = 0
+        while True:
+            chunk = list(friends.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            inserted += FacebookUserNameToken.objects.update_tokens(chunk)
+            indexed += len(chunk)
+            last_pk = chunk[-1][0]
+        user_ids = FacebookUserNameToken.objects.values_list(
+            'user_id', flat=True).order_by('user_id').distinct()
+        for user_id in list(user_ids):
+            FacebookUserNameToken.objects.delete_orphans(user_id)
+        self.log.info('indexed %s friends, inserted %s name tokens',
+                      indexed, inserted)
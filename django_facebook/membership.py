@@ -0,0 +1,294 @@
+'''
+In-process index of the facebook ids which have an account on your site
+
+Checking which friends are registered normally needs a facebook_id__in
+query against the profile table. With FACEBOOK_MEMBERSHIP_INDEX enabled
+every process keeps a compact snapshot of the registered facebook ids,
+so friend lists of thousands of ids are checked in memory.
+
+The snapshot is a sorted array of ids, or when
+FACEBOOK_MEMBERSHIP_INDEX_ERROR_RATE is set a Bloom filter, which is
+several times smaller but can report false positives.
+
+New registrations are added incrementally. Saving a profile with a
+facebook_id appends a numbered delta to the Django cache, which the
+other processes pick up on their next check. The
+facebook_rebuild_membership_index command starts a new generation, making
+every process rebuild its snapshot from the database.
+
+Removed accounts stay in the index until it's rebuilt, so callers
+should verify the matches with the database. Only the ids which
+aren't in the index are guaranteed not to be registered.
+
+**Example**::
+
+    index = get_membership_index()
+    if index is not None:
+        friend_ids = index.filter(friend_ids)
+'''
+from django_facebook import settings as facebook_settings
+from array import array
+import bisect
+import logging
+import math
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# array typecode for 64 bit integers, python 2 has no 'q'
+ID_TYPECODE = 'l' if array('l').itemsize == 8 else 'd'
+
+# how long the generation and deltas are kept in the cache
+CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# seconds to wait for a delta which was counted but isn't stored yet
+MISSING_DELTA_TIMEOUT = 60
+
+
+class BloomFilter(object):
+
+    '''
+    Bloom filter for integers, sized for the given capacity and false
+    positive rate
+    '''
+
+    def __init__(self, capacity, error_rate=0.01):
+        # tiny filters don't spread the hashes well enough
+        self.size = max(int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)), 1024)
+        self.hashes = max(int(round(-math.log(error_rate, 2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # double hashing, based on the splitmix64 finalizer
+        mask = 0xFFFFFFFFFFFFFFFF
+        hashed = int(value) & mask
+        hashed = ((hashed ^ (hashed >> 30)) * 0xBF58476D1CE4E5B9) & mask
+        hashed = ((hashed ^ (hashed >> 27)) * 0x94D049BB133111EB) & mask
+        hashed ^= hashed >> 31
+        first, second = hashed & 0xFFFFFFFF, (hashed >> 32) | 1
+        size = self.size
+        return [(first + i * second) % size for i in xrange(self.hashes)]
+
+    def add(self, value):
+        bits = self.bits
+        for position in self._positions(value):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        bits = self.bits
+        for position in self._positions(value):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class SortedIds(object):
+
+    '''
+    The exact snapshot, a sorted array of ids searched with bisect
+    '''
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __contains__(self, value):
+        ids = self.ids
+        position = bisect.bisect_left(ids, value)
+        return position < len(ids) and ids[position] == value
+
+
+class MembershipIndex(object):
+
+    '''
+    The registered facebook ids of the profile model
+
+    :param error_rate:
+        use a Bloom filter with this false positive rate instead of
+        the sorted array of ids
+    '''
+    prefix = 'django_facebook:membership'
+
+    def __init__(self, error_rate=None):
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.generation = None
+            self.snapshot = None
+            # ids added since the snapshot was built
+            self.added = set()
+            self.applied = 0
+            self.missing_since = None
+
+    @property
+    def cache(self):
+        from django.core.cache import cache
+        return cache
+
+    @property
+    def generation_key(self):
+        return '%s:generation' % self.prefix
+
+    def count_key(self, generation):
+        return '%s:%s:count' % (self.prefix, generation)
+
+    def delta_key(self, generation, number):
+        return '%s:%s:%s' % (self.prefix, generation, number)
+
+    def get_generation(self):
+        generation = self.cache.get(self.generation_key)
+        if generation is None:
+            self.cache.add(self.generation_key, uuid.uuid4().hex,
+                           CACHE_TIMEOUT)
+            generation = self.cache.get(self.generation_key)
+        return generation
+
+    def get_ids(self):
+        '''
+        The registered facebook ids, sorted by the database
+        '''
+        from django_facebook.utils import get_profile_model
+        profile_class = get_profile_model()
+        ids = profile_class.objects.exclude(facebook_id=None).order_by(
+            'facebook_id').values_list('facebook_id', flat=True)
+        return ids.iterator()
+
+    def build(self):
+        '''
+        Builds the snapshot from the database
+        '''
+        start = time.time()
+        if self.error_rate:
+            from django_facebook.utils import get_profile_model
+            profile_class = get_profile_model()
+            count = profile_class.objects.exclude(facebook_id=None).count()
+            snapshot = BloomFilter(count, self.error_rate)
+            for facebook_id in self.get_ids():
+                snapshot.add(facebook_id)
+        else:
+            snapshot = SortedIds(array(ID_TYPECODE, self.get_ids()))
+        logger.info('built the membership index in %.3fs',
+                    time.time() - start)
+        return snapshot
+
+    def rebuild(self, generation=None):
+        '''
+        Rebuilds the snapshot for the current generation
+        '''
+        generation = generation or self.get_generation()
+        # deltas counted before the query are part of the snapshot
+        applied = self.cache.get(self.count_key(generation)) or 0
+        snapshot = self.build()
+        with self._lock:
+            self.generation = generation
+            self.snapshot = snapshot
+            self.added = set()
+            self.applied = applied
+            self.missing_since = None
+
+    def refresh(self):
+        '''
+        Applies the deltas from other processes, rebuilding the snapshot
+        when a new generation was started
+        '''
+        generation = self.generation
+        if generation is not None:
+            count_key = self.count_key(generation)
+            values = self.cache.get_many([self.generation_key, count_key])
+            current = values.get(self.generation_key)
+            count = values.get(count_key) or 0
+        else:
+            current = None
+        if current is None or current != generation:
+            self.rebuild(current)
+            return
+
+        if count > self.applied:
+            keys = [self.delta_key(generation, number)
+                    for number in range(self.applied + 1, count + 1)]
+            deltas = self.cache.get_many(keys)
+            applied = self.applied
+            for key in keys:
+                if key not in deltas:
+                    break
+                self.added.add(deltas[key])
+                applied += 1
+            if applied < count:
+                # a delta is counted but not stored yet, or it expired
+                now = time.time()
+                if self.missing_since is None:
+                    self.missing_since = now
+                elif now - self.missing_since > MISSING_DELTA_TIMEOUT:
+                    self.rebuild(generation)
+                    return
+            else:
+                self.missing_since = None
+            self.applied = applied
+
+    def __contains__(self, facebook_id):
+        return facebook_id in self.added or facebook_id in self.snapshot
+
+    def filter(self, facebook_ids):
+        '''
+        Returns the facebook ids which are (possibly) registered
+        '''
+        self.refresh()
+        added, snapshot = self.added, self.snapshot
+        registered = [facebook_id for facebook_id in facebook_ids
+                      if facebook_id in added or facebook_id in snapshot]
+        return registered
+
+    def add(self, facebook_id):
+        '''
+        Adds a newly registered facebook id and shares it with the other
+        processes
+        '''
+        self.refresh()
+        facebook_id = int(facebook_id)
+        if facebook_id in self:
+            return
+        generation = self.generation
+        count_key = self.count_key(generation)
+        self.cache.add(count_key, 0, CACHE_TIMEOUT)
+        try:
+            number = self.cache.incr(count_key)
+        except ValueError:
+            # the count expired, start over
+            self.invalidate()
+            return
+        self.cache.set(self.delta_key(generation, number), facebook_id,
+                       CACHE_TIMEOUT)
+        self.added.add(facebook_id)
+
+    def invalidate(self):
+        '''
+        Starts a new generation, all processes rebuild their snapshot
+        '''
+        self.cache.set(self.generation_key, uuid.uuid4().hex, CACHE_TIMEOUT)
+
+
+membership_index = MembershipIndex(
+    error_rate=facebook_settings.FACEBOOK_MEMBERSHIP_INDEX_ERROR_RATE)
+
+
+def get_membership_index():
+    '''
+    Returns the membership index if it's enabled using
+    FACEBOOK_MEMBERSHIP_INDEX
+    '''
+    if facebook_settings.FACEBOOK_MEMBERSHIP_INDEX:
+        return membership_index
+
+
+def update_membership_index(sender, instance, **kwargs):
+    '''
+    post_save handler adding the facebook id of the profile
+    '''
+    from django_facebook.utils import get_profile_model
+    if sender is get_profile_model() and instance.facebook_id:
+        membership_index.add(instance.facebook_id)
@@ -4,13 +4,14 @@ from urlparse import urlparse
 
 from django.contrib.auth import logout
 
-from open_facebook.api import FacebookAuthorization, OpenFacebook
+from open_facebook.api import OpenFacebook
 
 from django_facebook import settings
 from django_facebook.canvas import generate_oauth_url
 from django_facebook.connect import connect_user
 from django_facebook.exceptions import MissingPermissionsError
-from django_facebook.utils import ScriptRedirect, try_get_profile
+from django_facebook.utils import ScriptRedirect, try_get_profile, \
+    parse_signed_request
 from bongoregistration.models import FacebookUserProfile
 from django.contrib import messages
 
@@ -83,8 +84,8 @@ class FacebookCanvasMiddleWare(object):
         signed_request = request.POST.get('signed_request', None)
         try:
             # get signed_request
-            parsed_signed_request = FacebookAuthorization.parse_signed_data(
-                signed_request)
+            parsed_signed_request = parse_signed_request(
+                signed_request, request)
             access_token = parsed_signed_request['oauth_token']
             facebook_id = long(parsed_signed_request['user_id'])
             logger.info("PR07 facebook_id = %s" % facebook_id)
@@ -119,7 +120,7 @@ class FacebookCanvasMiddleWare(object):
     def check_permissions(self, access_token):
         logger.info("CHP01 check permissions access_token = %s" % access_token)
         graph = OpenFacebook(access_token)
-        permissions = set(graph.permissions())
+        permissions = set(graph.cached_permissions())
         scope_list = set(settings.FACEBOOK_DEFAULT_SCOPE)
         missing_perms = scope_list - permissions
         if missing_perms:
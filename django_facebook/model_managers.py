@@ -13,56 +13,191 @@ logger = logging.getLogger(__name__)
 
 class FacebookUserManager(models.Manager):
 
-    def find_users(self, queries, base_queryset=None):
+    def find_users(self, queries, base_queryset=None, user=None):
         '''
         Queries, a list of search queries
         Base Queryset, the base queryset in which we are searching
+        User, only search the friends of this user
+
+        A name matches a query when the name, or a word after a space,
+        starts with the query. With FACEBOOK_NAME_SEARCH_INDEX the
+        name tokens are searched instead
         '''
         if base_queryset is None:
             base_queryset = self.all()
+        if user is not None:
+            base_queryset = base_queryset.filter(user_id=user.id)
         filters = []
         for query in queries:
-            match = Q(
-                name__istartswith=query) | Q(name__icontains=' %s' % query)
-            filters.append(match)
+            filters.append(self._name_filter(query, user))
 
         users = base_queryset.filter(reduce(operator.and_, filters))
 
         return users
 
+    def _name_filter(self, query, user=None):
+        from django_facebook import settings as facebook_settings
+        token = query.lower()
+        # tokens never contain spaces, so those queries scan the names
+        use_index = facebook_settings.FACEBOOK_NAME_SEARCH_INDEX and \
+            token and ' ' not in token and len(token) <= TOKEN_MAX_LENGTH
+        if use_index:
+            from django_facebook.models import FacebookUserNameToken
+            tokens = FacebookUserNameToken.objects.filter(
+                token__startswith=token)
+            if user is not None:
+                tokens = tokens.filter(user_id=user.id)
+            match = Q(pk__in=tokens.values('facebook_user_id'))
+        else:
+            match = Q(
+                name__istartswith=query) | Q(name__icontains=' %s' % query)
+        return match
+
     def random_facebook_friends(self, user, gender=None, limit=3):
         '''
-        Returns a random sample of your FB friends
+        Returns a random sample of your FB friends which aren't registered
 
         Limit = Number of friends
         Gender = None, M or F
+
+        The ids of the non members are cached, so this only runs a query
+        for the sampled friends
         '''
         assert gender in (
             None, 'M', 'F'), 'Gender %s wasnt recognized' % gender
 
-        from django_facebook.utils import get_profile_model
-        facebook_cache_key = 'facebook_users_%s' % user.id
-        non_members = cache.get(facebook_cache_key)
-        profile_class = get_profile_model()
-        if not non_members:
-            facebook_users = list(
-                self.filter(user_id=user.id, gender=gender)[:50])
-            facebook_ids = [u.facebook_id for u in facebook_users]
-            members = list(profile_class.objects.filter(
-                facebook_id__in=facebook_ids).select_related('user'))
-            member_ids = [p.facebook_id for p in members]
-            non_members = [
-                u for u in facebook_users if u.facebook_id not in member_ids]
-
-            cache.set(facebook_cache_key, non_members, 60 * 60)
-
-        random_limit = min(len(non_members), 3)
+        from django_facebook.api import non_member_friends_cache_key
+        facebook_cache_key = non_member_friends_cache_key(user, gender)
+        non_member_ids = cache.get(facebook_cache_key)
+        if non_member_ids is None:
+            non_member_ids = self._non_member_ids(user, gender)
+            cache.set(facebook_cache_key, non_member_ids, 60 * 60)
+
+        random_limit = min(len(non_member_ids), limit)
         random_facebook_users = []
         if random_limit:
-            random_facebook_users = random.sample(non_members, random_limit)
+            sample = random.sample(non_member_ids, random_limit)
+            facebook_users = self.in_bulk(sample)
+            random_facebook_users = [facebook_users[pk] for pk in sample
+                                     if pk in facebook_users]
 
         return random_facebook_users
 
+    def _non_member_ids(self, user, gender=None):
+        '''
+        Returns a tuple with the primary keys of the friends which aren't
+        registered, using the membership index when it's enabled
+        '''
+        from django.db import router
+        from django_facebook.membership import get_membership_index
+        from django_facebook.utils import get_profile_model
+        friends = self.filter(user_id=user.id)
+        if gender:
+            friends = friends.filter(gender=gender)
+
+        profile_class = get_profile_model()
+        membership_index = get_membership_index()
+        if membership_index is not None:
+            friends = list(friends.values_list('pk', 'facebook_id'))
+            candidates = membership_index.filter(
+                [facebook_id for pk, facebook_id in friends])
+            registered_ids = set()
+            if candidates:
+                # the index can contain removed accounts or false positives
+                registered = profile_class.objects.filter(
+                    facebook_id__in=candidates)
+                registered_ids = set([int(facebook_id) for facebook_id in
+                                      registered.values_list(
+                                          'facebook_id', flat=True)])
+            return tuple([pk for pk, facebook_id in friends
+                          if int(facebook_id) not in registered_ids])
+
+        friend_ids = friends.values('facebook_id')
+        registered = profile_class.objects.filter(facebook_id__in=friend_ids)
+        registered_ids = registered.values('facebook_id')
+        if router.db_for_read(self.model) != \
+                router.db_for_read(profile_class):
+            # different databases, so no subquery
+            friend_ids = list(friend_ids.values_list('facebook_id', flat=True))
+            registered = profile_class.objects.filter(
+                facebook_id__in=friend_ids)
+            registered_ids = list(
+                registered.values_list('facebook_id', flat=True))
+        non_members = friends.exclude(facebook_id__in=registered_ids)
+        return tuple(non_members.values_list('pk', flat=True))
+
+
+TOKEN_MAX_LENGTH = 255
+
+
+def tokenize_name(name):
+    '''
+    The lowercased words of a name, split on spaces like find_users
+
+    **Example**::
+
+        >>> sorted(tokenize_name(u'Thierry  Schellenbach'))
+        [u'schellenbach', u'thierry']
+    '''
+    if not name:
+        return set()
+    return set([part.lower()[:TOKEN_MAX_LENGTH]
+                for part in name.split(' ') if part])
+
+
+class FacebookUserNameTokenManager(models.Manager):
+
+    def update_tokens(self, facebook_users):
+        '''
+        Stores the name tokens for the given (pk, user_id, name) tuples
+        of FacebookUser records, replacing the tokens of changed names
+
+        :returns: the number of inserted tokens
+        '''
+        # user_id => pk => tokens
+        wanted = {}
+        for pk, user_id, name in facebook_users:
+            wanted.setdefault(user_id, {})[pk] = tokenize_name(name)
+        inserted = 0
+        for user_id, user_tokens in wanted.items():
+            inserted += self._update_user_tokens(user_id, user_tokens)
+        return inserted
+
+    def _update_user_tokens(self, user_id, wanted):
+        from django.db import router, transaction
+        from django_facebook.utils import insert_ignore
+        using = router.db_for_write(self.model)
+        with transaction.commit_on_success(using=using):
+            # the unique index starts with the user_id
+            user_tokens = self.using(using).filter(user_id=user_id)
+            stored = set(user_tokens.filter(
+                facebook_user_id__in=wanted.keys()).values_list(
+                'facebook_user_id', 'token'))
+            # a renamed friend gets a fresh set of tokens
+            changed = set([pk for pk, token in stored
+                           if token not in wanted[pk]])
+            if changed:
+                user_tokens.filter(
+                    facebook_user_id__in=list(changed)).delete()
+            tokens = []
+            for pk, pk_tokens in wanted.items():
+                for token in pk_tokens:
+                    if pk in changed or (pk, token) not in stored:
+                        tokens.append(self.model(
+                            user_id=user_id, facebook_user_id=pk,
+                            token=token))
+            inserted = insert_ignore(self.model, tokens, using=using)
+        return inserted
+
+    def delete_orphans(self, user_id):
+        '''
+        Deletes the tokens of this user's friends which were removed
+        '''
+        from django_facebook.models import FacebookUser
+        friends = FacebookUser.objects.filter(user_id=user_id)
+        self.filter(user_id=user_id).exclude(
+            facebook_user_id__in=friends.values('pk')).delete()
+
 
 class OpenGraphShareManager(models.Manager):
 
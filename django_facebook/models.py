@@ -318,6 +318,28 @@ class FacebookUser(models.Model):
         return u'Facebook user %s' % self.name
 
 
+class FacebookUserNameToken(models.Model):
+
+    '''
+    The lowercased words of the names of the stored friends, so
+    find_users searches them with an index instead of scanning the names
+    Enable it using FACEBOOK_NAME_SEARCH_INDEX
+    '''
+    # the user_id and primary key of the FacebookUser, no foreign keys
+    # so these can be moved to another db together with the friends
+    user_id = models.IntegerField()
+    facebook_user_id = models.IntegerField()
+    token = models.CharField(max_length=255, db_index=True)
+
+    objects = model_managers.FacebookUserNameTokenManager()
+
+    class Meta:
+        unique_together = ['user_id', 'token', 'facebook_user_id']
+
+    def __unicode__(self):
+        return u'Name token %s' % self.token
+
+
 class FacebookLike(models.Model):
 
     '''
@@ -672,3 +694,20 @@ class OpenGraphShare(BaseModel):
         old_share_dict.update(share_dict)
         self.set_share_dict(old_share_dict)
         return old_share_dict
+
+
+if facebook_settings.FACEBOOK_PROFILE_CACHE_TIMEOUT:
+    # the profile model can live in any app, so we listen to all models
+    from django.db.models.signals import post_save, post_delete
+    from django_facebook.utils import update_cached_profile, \
+        remove_cached_profile
+    post_save.connect(update_cached_profile,
+                      dispatch_uid='django_facebook.update_cached_profile')
+    post_delete.connect(remove_cached_profile,
+                        dispatch_uid='django_facebook.remove_cached_profile')
+
+if facebook_settings.FACEBOOK_MEMBERSHIP_INDEX:
+    from django.db.models.signals import post_save
+    from django_facebook.membership import update_membership_index
+    post_save.connect(update_membership_index,
+                      dispatch_uid='django_facebook.update_membership_index')
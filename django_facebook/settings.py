@@ -92,3 +92,76 @@ FACEBOOK_CLASS_MAPPING = getattr(
 
 FACEBOOK_SKIP_VALIDATE = getattr(
     settings, 'FACEBOOK_SKIP_VALIDATE', False)
+
+# Maximum number of idle keep-alive connections we keep open per host
+FACEBOOK_CONNECTION_POOL_MAX_IDLE = getattr(
+    settings, 'FACEBOOK_CONNECTION_POOL_MAX_IDLE', 10)
+# Close pooled connections which have been idle for this many seconds
+FACEBOOK_CONNECTION_POOL_IDLE_TIMEOUT = getattr(
+    settings, 'FACEBOOK_CONNECTION_POOL_IDLE_TIMEOUT', 30)
+# Number of threads AsyncOpenFacebook uses for sending requests
+FACEBOOK_ASYNC_POOL_SIZE = getattr(settings, 'FACEBOOK_ASYNC_POOL_SIZE', 10)
+# Retry policy for failing requests to Facebook, retries back off
+# exponentially (with jitter) and at most 20% of requests get retried
+FACEBOOK_RETRY_ATTEMPTS = getattr(settings, 'FACEBOOK_RETRY_ATTEMPTS', 3)
+FACEBOOK_RETRY_BASE_DELAY = getattr(settings, 'FACEBOOK_RETRY_BASE_DELAY', 0.5)
+FACEBOOK_RETRY_MAX_DELAY = getattr(settings, 'FACEBOOK_RETRY_MAX_DELAY', 5)
+FACEBOOK_RETRY_BUDGET_RATIO = getattr(
+    settings, 'FACEBOOK_RETRY_BUDGET_RATIO', 0.2)
+# Stop sending requests after this many failures in a row, 0 disables it
+FACEBOOK_CIRCUIT_BREAKER_THRESHOLD = getattr(
+    settings, 'FACEBOOK_CIRCUIT_BREAKER_THRESHOLD', 5)
+# Seconds to wait before probing if Facebook is back
+FACEBOOK_CIRCUIT_BREAKER_RESET_TIMEOUT = getattr(
+    settings, 'FACEBOOK_CIRCUIT_BREAKER_RESET_TIMEOUT', 30)
+# Cache the responses of read requests (get, get_many, fql, permissions)
+FACEBOOK_RESPONSE_CACHE = getattr(settings, 'FACEBOOK_RESPONSE_CACHE', False)
+# Seconds to cache the responses per endpoint, * is the default
+default_response_cache_timeouts = {
+    'me': 5 * 60, 'permissions': 60, 'fql': 60, '*': 60}
+FACEBOOK_RESPONSE_CACHE_TIMEOUTS = getattr(
+    settings, 'FACEBOOK_RESPONSE_CACHE_TIMEOUTS',
+    default_response_cache_timeouts)
+# Number of responses kept in memory in front of the django cache
+FACEBOOK_RESPONSE_CACHE_LOCAL_SIZE = getattr(
+    settings, 'FACEBOOK_RESPONSE_CACHE_LOCAL_SIZE', 1000)
+# Seconds to cache the permissions of an access token, 0 disables the cache
+FACEBOOK_PERMISSIONS_CACHE_TIMEOUT = getattr(
+    settings, 'FACEBOOK_PERMISSIONS_CACHE_TIMEOUT', 5 * 60)
+# Number of verified signed requests kept in memory
+FACEBOOK_SIGNED_REQUEST_CACHE_SIZE = getattr(
+    settings, 'FACEBOOK_SIGNED_REQUEST_CACHE_SIZE', 1000)
+# Likes and friends are fetched and stored in chunks of this size
+FACEBOOK_STORE_CHUNK_SIZE = getattr(settings, 'FACEBOOK_STORE_CHUNK_SIZE', 500)
+# Seconds to remember fingerprints of the stored likes and friends, unchanged
+# chunks aren't compared to the database again. 0 disables
+FACEBOOK_STORE_FINGERPRINT_TIMEOUT = getattr(
+    settings, 'FACEBOOK_STORE_FINGERPRINT_TIMEOUT', 60 * 60 * 24)
+# Seconds to cache the result of registered_friends, 0 disables the cache
+FACEBOOK_REGISTERED_FRIENDS_CACHE_TIMEOUT = getattr(
+    settings, 'FACEBOOK_REGISTERED_FRIENDS_CACHE_TIMEOUT', 60 * 15)
+# Keep an in-process index of the registered facebook ids, so friend lists
+# are checked without querying the profile table
+FACEBOOK_MEMBERSHIP_INDEX = getattr(
+    settings, 'FACEBOOK_MEMBERSHIP_INDEX', False)
+# Use a Bloom filter with this false positive rate for the membership index
+# instead of the exact (larger) sorted array of ids
+FACEBOOK_MEMBERSHIP_INDEX_ERROR_RATE = getattr(
+    settings, 'FACEBOOK_MEMBERSHIP_INDEX_ERROR_RATE', None)
+# Store the words of the friends' names in FacebookUserNameToken, so
+# find_users searches an index instead of scanning the names
+FACEBOOK_NAME_SEARCH_INDEX = getattr(
+    settings, 'FACEBOOK_NAME_SEARCH_INDEX', False)
+# Seconds to cache profiles in the Django cache, 0 disables the cache
+FACEBOOK_PROFILE_CACHE_TIMEOUT = getattr(
+    settings, 'FACEBOOK_PROFILE_CACHE_TIMEOUT', 0)
+# Seconds a request may hold the lock for converting a code, other requests
+# with the same code wait this long for the access token
+FACEBOOK_CONVERT_CODE_LOCK_TIMEOUT = getattr(
+    settings, 'FACEBOOK_CONVERT_CODE_LOCK_TIMEOUT', 10)
+# Seconds between checks for the access token while waiting for the lock
+FACEBOOK_CONVERT_CODE_POLL_INTERVAL = getattr(
+    settings, 'FACEBOOK_CONVERT_CODE_POLL_INTERVAL', 0.1)
+# The class sending the requests to Facebook, see open_facebook.transport
+FACEBOOK_TRANSPORT = getattr(
+    settings, 'FACEBOOK_TRANSPORT', 'open_facebook.transport.PooledTransport')
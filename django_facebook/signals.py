@@ -12,11 +12,13 @@ facebook_post_update = Signal(
 
 # Sent after storing the friends from graph to db
 facebook_post_store_friends = Signal(
-    providing_args=['user', 'friends', 'current_friends', 'inserted_friends'])
+    providing_args=['user', 'friends', 'current_friends', 'inserted_friends',
+                    'changed'])
 
 # Sent after storing the likes from graph to db
 facebook_post_store_likes = Signal(
-    providing_args=['user', 'likes', 'current_likes', 'inserted_likes'])
+    providing_args=['user', 'likes', 'current_likes', 'inserted_likes',
+                    'changed'])
 
 # Some signals for compatibility with Django Registration
 # A new user has registered.
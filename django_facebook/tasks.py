@@ -74,7 +74,7 @@ def get_and_store_likes(user, facebook):
     try:
         logger.info('attempting to get and store friends for %s', user.id)
         stored_likes = facebook._get_and_store_likes(user)
-        logger.info('celery is storing %s likes', len(stored_likes))
+        logger.info('celery stored %s likes', stored_likes)
         return stored_likes
     except IntegrityError, e:
         logger.warn(
@@ -99,7 +99,7 @@ def get_and_store_friends(user, facebook):
     try:
         logger.info('attempting to get and store friends for %s', user.id)
         stored_friends = facebook._get_and_store_friends(user)
-        logger.info('celery is storing %s friends', len(stored_friends))
+        logger.info('celery stored %s friends', stored_friends)
         return stored_friends
     except IntegrityError, e:
         logger.warn(
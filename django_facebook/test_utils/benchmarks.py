@@ -0,0 +1,350 @@
+'''
+Micro benchmarks for the hot paths in open_facebook and django_facebook
+
+Run them with the facebook_benchmark management command. Requests go
+through a StaticTransport and database benchmarks run in a test
+database, so no network access or production data is needed.
+
+Results can be stored as a baseline and later runs compared against it::
+
+    ./manage.py facebook_benchmark --save=benchmarks.json
+    ./manage.py facebook_benchmark --compare=benchmarks.json
+
+Or from python::
+
+    from django_facebook.test_utils import benchmarks
+    results = benchmarks.run_benchmarks(['match_error_code'])
+'''
+from open_facebook.transport import BaseTransport
+from open_facebook.utils import json
+from StringIO import StringIO
+from contextlib import contextmanager
+import base64
+import hashlib
+import hmac
+import time
+import urllib
+
+# name => Benchmark, filled by the register decorator
+BENCHMARKS = {}
+
+
+class Benchmark(object):
+
+    '''
+    A function to time, optionally with a setup function which runs
+    before every repeat. The setup returns the arguments for the function
+
+    :param number:
+        the number of calls per repeat
+    :param database:
+        the benchmark needs database tables
+    '''
+
+    def __init__(self, name, function, setup=None, number=1000,
+                 database=False):
+        self.name = name
+        self.function = function
+        self.setup = setup
+        self.number = number
+        self.database = database
+
+    def run(self, repeat=3):
+        '''
+        Returns the best and mean time per call in seconds
+        '''
+        timings = []
+        for x in range(repeat):
+            args = self.setup() if self.setup else ()
+            start = time.time()
+            for y in range(self.number):
+                self.function(*args)
+            timings.append((time.time() - start) / self.number)
+        result = dict(best=min(timings),
+                      mean=sum(timings) / len(timings),
+                      number=self.number)
+        return result
+
+
+def register(number=1000, setup=None, database=False):
+    '''
+    Decorator adding the function to the benchmarks
+    '''
+    def wrapper(function):
+        name = function.__name__
+        BENCHMARKS[name] = Benchmark(name, function, setup=setup,
+                                     number=number, database=database)
+        return function
+    return wrapper
+
+
+def run_benchmarks(names=None, repeat=3):
+    '''
+    Runs the given benchmarks (all by default) and returns a dict
+    mapping the benchmark name to its timings
+    '''
+    names = names or sorted(BENCHMARKS.keys())
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        raise ValueError('Unknown benchmarks %s' % ', '.join(unknown))
+
+    results = {}
+    for name in names:
+        results[name] = BENCHMARKS[name].run(repeat=repeat)
+    return results
+
+
+@contextmanager
+def benchmark_database(enabled=True):
+    '''
+    Runs the block against a freshly created test database, so benchmarks
+    never touch real data
+    '''
+    from django.db import connection
+    old_name = None
+    if enabled:
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        if old_name is not None:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as baseline_file:
+        json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    Compares the best timings to the baseline
+
+    :returns: a list of (name, baseline, current, ratio, regression) tuples
+        where regression is True if the benchmark is more than tolerance
+        slower than the baseline
+    '''
+    comparison = []
+    for name in sorted(results):
+        current = results[name]['best']
+        previous = baseline.get(name, {}).get('best')
+        ratio = None
+        regression = False
+        if previous:
+            ratio = current / previous
+            regression = ratio > 1 + tolerance
+        comparison.append((name, previous, current, ratio, regression))
+    return comparison
+
+
+class StaticTransport(BaseTransport):
+
+    '''
+    Answers every request with the same response, without any network
+    '''
+
+    def __init__(self, body, status=200):
+        self.body = body
+        self.status = status
+
+    def open(self, url, data=None, timeout=None):
+        response = urllib.addinfourl(StringIO(self.body), {}, url)
+        response.code = self.status
+        return response
+
+
+def make_likes(count):
+    likes = []
+    for x in range(count):
+        like = dict(id=str(100000 + x), name='Like %s' % x,
+                    category='Media/news/publishing',
+                    created_time='2012-08-27T14:29:08+0000')
+        likes.append(like)
+    return likes
+
+
+def make_friends(count):
+    friends = []
+    genders = ['male', 'female', None]
+    for x in range(count):
+        friend = dict(id=str(200000 + x), name='Friend %s' % x,
+                      sex=genders[x % 3])
+        friends.append(friend)
+    return friends
+
+
+def make_signed_request(data, secret):
+    payload = base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+    signature = hmac.new(secret, msg=payload,
+                         digestmod=hashlib.sha256).digest()
+    encoded_signature = base64.urlsafe_b64encode(signature).rstrip('=')
+    return '%s.%s' % (encoded_signature, payload)
+
+
+def get_benchmark_user():
+    from django_facebook.utils import get_user_model
+    user_model = get_user_model()
+    user, created = user_model.objects.get_or_create(
+        username='facebook_benchmark')
+    return user
+
+
+def setup_request():
+    from open_facebook.api import OpenFacebook
+    body = json.dumps(dict(data=make_likes(100)))
+    graph = OpenFacebook('token')
+    return graph, StaticTransport(body)
+
+
+@register(number=200, setup=setup_request)
+def request(graph, transport):
+    # the full _request, transport and parsing included
+    from open_facebook.api import FacebookConnection
+    FacebookConnection.transport = transport
+    try:
+        graph.get('me/likes')
+    finally:
+        FacebookConnection.transport = None
+
+
+def setup_parse_response():
+    return (json.dumps(dict(data=make_likes(100))),)
+
+
+@register(number=200, setup=setup_parse_response)
+def parse_response(body):
+    from open_facebook.api import FacebookConnection
+    FacebookConnection.parse_response(body)
+
+
+ERRORS = [
+    ('OAuthException', '(#200) Requires extended permission', None),
+    ('OAuthException', 'Error validating access token', 190),
+    ('OAuthException', '(#341) Feed action request limit reached', None),
+    ('GraphMethodException', 'Unsupported get request.', 100),
+    ('OAuthException', 'Some unknown error', 12345),
+]
+
+
+@register(number=1000)
+def raise_error():
+    from open_facebook.api import FacebookConnection
+    from open_facebook.exceptions import OpenFacebookException
+    for error_type, message, code in ERRORS:
+        try:
+            FacebookConnection.raise_error(error_type, message, code)
+        except OpenFacebookException:
+            pass
+
+
+@register(number=10000)
+def match_error_code():
+    from open_facebook.api import FacebookConnection
+    for code in (1, 3, 100, 190, 200, 341, 506, 803, 3502, 12345):
+        FacebookConnection.match_error_code(code)
+
+
+def setup_signed_requests():
+    from open_facebook.api import signed_request_cache
+    signed_request_cache.clear()
+    signed_requests = []
+    for x in range(100):
+        data = dict(algorithm='HMAC-SHA256', user_id=str(x),
+                    oauth_token='token%s' % x, issued_at=1358068550)
+        signed_requests.append(make_signed_request(data, 'secret'))
+    return (signed_requests,)
+
+
+@register(number=20, setup=setup_signed_requests)
+def parse_signed_data(signed_requests):
+    # the first call per repeat verifies, the others hit the cache
+    from open_facebook.api import FacebookAuthorization
+    for signed_request in signed_requests:
+        FacebookAuthorization.parse_signed_data(signed_request, 'secret')
+
+
+def setup_convert_facebook_data():
+    from django_facebook.test_utils.sample_user_data import user_data
+    return (user_data['tschellenbach'],)
+
+
+@register(number=200, setup=setup_convert_facebook_data, database=True)
+def convert_facebook_data(facebook_data):
+    from django_facebook.api import FacebookUserConverter
+    FacebookUserConverter._convert_facebook_data(facebook_data)
+
+
+def setup_mass_get_or_create():
+    from django_facebook.models import FacebookLike
+    from django.core.cache import cache
+    from django_facebook.api import FacebookUserConverter
+    user = get_benchmark_user()
+    FacebookLike.objects.filter(user_id=user.id).delete()
+    # measure the full store, not skipped unchanged chunks
+    cache.delete(FacebookUserConverter._fingerprint_cache_key(FacebookLike, user))
+    default_dict = {}
+    for like in make_likes(5000):
+        default_dict[like['id']] = dict(name=like['name'],
+                                        category=like['category'])
+    return user, default_dict
+
+
+@register(number=1, setup=setup_mass_get_or_create, database=True)
+def mass_get_or_create(user, default_dict):
+    from django_facebook.models import FacebookLike
+    from django_facebook.utils import mass_get_or_create
+    base_queryset = FacebookLike.objects.filter(user_id=user.id)
+    mass_get_or_create(FacebookLike, base_queryset, 'facebook_id',
+                       default_dict, dict(user_id=user.id))
+
+
+def setup_store_likes():
+    from django_facebook.models import FacebookLike
+    user = get_benchmark_user()
+    FacebookLike.objects.filter(user_id=user.id).delete()
+    return user, make_likes(5000)
+
+
+@register(number=1, setup=setup_store_likes, database=True)
+def store_likes(user, likes):
+    from django_facebook.api import FacebookUserConverter
+    FacebookUserConverter._store_likes(user, iter(likes))
+
+
+def setup_store_friends():
+    from django_facebook.models import FacebookUser
+    from django.core.cache import cache
+    from django_facebook.api import FacebookUserConverter
+    user = get_benchmark_user()
+    FacebookUser.objects.filter(user_id=user.id).delete()
+    # measure the full store, not skipped unchanged chunks
+    cache.delete(FacebookUserConverter._fingerprint_cache_key(FacebookUser, user))
+    return user, make_friends(5000)
+
+
+@register(number=1, setup=setup_store_friends, database=True)
+def store_friends(user, friends):
+    from django_facebook.api import FacebookUserConverter
+    FacebookUserConverter._store_friends(user, friends)
+
+
+@register(number=1000)
+def cleanup_oauth_url():
+    from django_facebook.utils import cleanup_oauth_url
+    cleanup_oauth_url(
+        'http://www.example.com/connect/?code=abc&signed_request=def'
+        '&state=123&attempt=1&next=%2Fprofile%2F&utm_source=facebook')
+
+
+@register(number=1000)
+def merge_urls():
+    from open_facebook.utils import merge_urls
+    merge_urls(
+        'http://www.example.com/connect/?code=abc&attempt=1&next=/profile/',
+        'http://www.example.com/connect/?utm_source=facebook&next=/home/')
@@ -0,0 +1,141 @@
+'''
+A local stand in for graph.facebook.com
+
+Runs a small threaded HTTP server which answers Graph API requests with
+canned responses, so the real request, parsing and error handling code
+in open_facebook can be exercised without network access
+
+**Example**::
+
+    server = FakeGraphServer()
+    server.start()
+    server.add_response('me', dict(id='123', name='Thierry'))
+    OpenFacebook.api_url = server.url
+    ...
+    server.stop()
+'''
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from open_facebook.utils import json
+from urlparse import urlparse
+import socket
+import threading
+
+
+class FakeGraphRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so connections are kept alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length)
+        self.respond()
+
+    def respond(self):
+        graph = self.server.graph
+        path = urlparse(self.path).path.strip('/')
+        status, body = graph.get_response(path, self)
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/javascript; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        graph = self.server.graph
+        with graph._lock:
+            graph.connection_count += 1
+            graph.connections.add(self.connection)
+            graph.threads.add(threading.current_thread())
+
+    def finish(self):
+        BaseHTTPRequestHandler.finish(self)
+        graph = self.server.graph
+        with graph._lock:
+            graph.connections.discard(self.connection)
+
+    def log_message(self, format, *args):
+        # keep the test output clean
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeGraphServer(object):
+
+    '''
+    Threaded local HTTP server pretending to be the Graph API
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.responses = {}
+        self.request_count = 0
+        self.connection_count = 0
+        self.paths = []
+        # open client connections, kept alive by the clients
+        self.connections = set()
+        self.threads = set()
+        self._lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s/' % (self.host, self.port)
+
+    def add_response(self, path, response, status=200):
+        '''
+        Register the response to send for the given path
+        The response can also be a callable receiving the request handler
+        '''
+        self.responses[path.strip('/')] = (status, response)
+
+    def get_response(self, path, handler):
+        with self._lock:
+            self.request_count += 1
+            self.paths.append(path)
+        status, response = self.responses.get(
+            path, (404, dict(error=dict(type='GraphMethodException',
+                                        message='Unsupported get request.',
+                                        code=100))))
+        if callable(response):
+            response = response(handler)
+        return status, response
+
+    def start(self):
+        self.server = ThreadedHTTPServer(
+            (self.host, self.port), FakeGraphRequestHandler)
+        self.server.graph = self
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        # close the kept alive connections so the handler threads finish
+        with self._lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        # and wait for them, so they don't outlive the interpreter
+        with self._lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join(1)
@@ -0,0 +1,247 @@
+'''
+End to end load test for the connect view
+
+Drives the connect view through the register, login and connect flows
+for a number of synthetic users. Graph requests go to a local
+FakeGraphServer, which answers with the sample user data and sleeps
+according to a realistic latency distribution per endpoint.
+
+Reports the requests per second, the p50, p95 and p99 latency and the
+number of database queries and Graph calls per request, per flow.
+
+Run it with the facebook_load_test management command::
+
+    ./manage.py facebook_load_test --users=1000
+
+Note that with FACEBOOK_CELERY_STORE enabled storing likes and friends
+is left to celery and won't be measured.
+'''
+from django_facebook.test_utils.fake_graph import FakeGraphServer
+from django_facebook.test_utils.sample_user_data import user_data
+from urlparse import urlparse, parse_qs
+import math
+import random
+import time
+
+# median latency in seconds and sigma of the log normal distribution
+GRAPH_LATENCY = {
+    'me': (0.08, 0.5),
+    'me/permissions': (0.06, 0.4),
+    'me/likes': (0.15, 0.6),
+    'me/friends': (0.2, 0.6),
+    'fql': (0.2, 0.6),
+    'oauth/access_token': (0.1, 0.5),
+    'me/picture': (0.05, 0.3),
+}
+
+FLOWS = ('register', 'login', 'connect')
+
+
+def percentile(values, percent):
+    '''
+    Nearest rank percentile of a list of values
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+class FakeGraphUsers(object):
+
+    '''
+    Serves the Graph responses for the synthetic users, the access token
+    determines which user is returned
+    '''
+
+    def __init__(self, server, latency_scale=1.0, seed=None):
+        self.server = server
+        self.latency_scale = latency_scale
+        self.random = random.Random(seed)
+        self.users = {}
+        for path in GRAPH_LATENCY:
+            self.server.add_response(path, self.responder(path))
+
+    def add_user(self, access_token, number):
+        '''
+        Create a user, based on the sample user data
+        '''
+        data = dict(user_data['new_user'])
+        data.update(
+            id=str(900000000000 + number),
+            name='Load User %s' % number,
+            first_name='Load',
+            last_name='User %s' % number,
+            email='load_user_%s@example.com' % number,
+            username='load.user.%s' % number,
+            link='http://www.facebook.com/load.user.%s' % number,
+            image='%sme/picture' % self.server.url,
+        )
+        self.users[access_token] = data
+        return data
+
+    def sleep(self, path):
+        median, sigma = GRAPH_LATENCY[path]
+        if self.latency_scale:
+            latency = self.random.lognormvariate(math.log(median), sigma)
+            time.sleep(latency * self.latency_scale)
+
+    def responder(self, path):
+        def respond(handler):
+            self.sleep(path)
+            query = parse_qs(urlparse(handler.path).query)
+            access_token = query.get('access_token', [None])[0]
+            data = self.users.get(access_token, {})
+            if path == 'me':
+                return data
+            elif path == 'me/permissions':
+                permissions = dict(email=1, user_likes=1, user_friends=1,
+                                   publish_actions=1, installed=1)
+                return dict(data=[permissions])
+            elif path == 'me/likes':
+                likes = [dict(id=str(300000 + x), name='Like %s' % x,
+                              category='Community') for x in range(50)]
+                return dict(data=likes)
+            elif path in ('me/friends', 'fql'):
+                friends = [dict(uid=400000 + x, id=str(400000 + x),
+                                name='Friend %s' % x, sex='female')
+                           for x in range(100)]
+                return dict(data=friends)
+            elif path == 'oauth/access_token':
+                return 'access_token=%s&expires=5183999' % access_token
+            elif path == 'me/picture':
+                # a transparent 1x1 gif
+                return 'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00' \
+                    '\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00' \
+                    '\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+        return respond
+
+
+class ConnectLoadTest(object):
+
+    '''
+    Runs the connect flows for the given number of users
+
+    **Example**::
+
+        load_test = ConnectLoadTest(users=100, latency_scale=0)
+        report = load_test.run()
+        print load_test.format_report(report)
+    '''
+
+    def __init__(self, users=1000, latency_scale=1.0, seed=None):
+        self.user_count = users
+        self.latency_scale = latency_scale
+        self.seed = seed
+
+    def setup(self):
+        from open_facebook.api import FacebookConnection
+        self.server = FakeGraphServer().start()
+        self.graph_users = FakeGraphUsers(
+            self.server, latency_scale=self.latency_scale, seed=self.seed)
+        self.original_api_url = FacebookConnection.api_url
+        FacebookConnection.api_url = self.server.url
+
+    def teardown(self):
+        from open_facebook.api import FacebookConnection
+        FacebookConnection.api_url = self.original_api_url
+        self.server.stop()
+
+    def make_request(self, access_token, user=None, connect_facebook=False):
+        from django.contrib.auth.models import AnonymousUser
+        from django_facebook.test_utils.mocks import RequestMock
+        data = dict(access_token=access_token)
+        if connect_facebook:
+            data['connect_facebook'] = '1'
+        request = RequestMock().post('/facebook/connect/', data)
+        request.user = user or AnonymousUser()
+        return request
+
+    def measure(self, request):
+        '''
+        Calls the connect view and returns the duration, the number of
+        queries and the number of graph calls
+        '''
+        from django.db import connection
+        from django_facebook.views import connect
+        graph_calls = self.server.request_count
+        connection.queries = []
+        start = time.time()
+        connect(request)
+        duration = time.time() - start
+        queries = len(connection.queries)
+        graph_calls = self.server.request_count - graph_calls
+        return duration, queries, graph_calls
+
+    def run(self):
+        '''
+        Returns a dict mapping the flows to their statistics
+        '''
+        from django.db import connection
+        from django_facebook.utils import get_user_model
+        measurements = dict((flow, []) for flow in FLOWS)
+        use_debug_cursor = connection.use_debug_cursor
+        # store the queries, also when DEBUG is False
+        connection.use_debug_cursor = True
+        self.setup()
+        try:
+            for number in range(self.user_count):
+                access_token = 'load_user_%s' % number
+                self.graph_users.add_user(access_token, number)
+                # the first visit registers the user
+                request = self.make_request(access_token)
+                measurements['register'].append(self.measure(request))
+                # when they come back they are logged in
+                request = self.make_request(access_token)
+                measurements['login'].append(self.measure(request))
+
+                # an existing user connecting their facebook account
+                connect_token = 'load_connect_%s' % number
+                self.graph_users.add_user(
+                    connect_token, self.user_count + number)
+                user = get_user_model().objects.create(
+                    username='load_existing_%s' % number,
+                    email='load_existing_%s@example.com' % number)
+                request = self.make_request(
+                    connect_token, user=user, connect_facebook=True)
+                measurements['connect'].append(self.measure(request))
+        finally:
+            self.teardown()
+            connection.use_debug_cursor = use_debug_cursor
+
+        report = {}
+        for flow, results in measurements.items():
+            report[flow] = self.summarize(results)
+        return report
+
+    def summarize(self, results):
+        durations = [r[0] for r in results]
+        total = sum(durations)
+        count = len(results) or 1
+        summary = dict(
+            requests=len(results),
+            requests_per_second=len(results) / total if total else None,
+            p50=percentile(durations, 50),
+            p95=percentile(durations, 95),
+            p99=percentile(durations, 99),
+            queries_per_request=sum([r[1] for r in results]) / float(count),
+            graph_calls_per_request=sum(
+                [r[2] for r in results]) / float(count),
+        )
+        return summary
+
+    def format_report(self, report):
+        lines = ['%-10s %8s %8s %9s %9s %9s %8s %8s' % (
+            'flow', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+            'queries', 'graph')]
+        for flow in FLOWS:
+            summary = report[flow]
+            lines.append('%-10s %8s %8.1f %9.1f %9.1f %9.1f %8.1f %8.1f' % (
+                flow, summary['requests'],
+                summary['requests_per_second'] or 0,
+                (summary['p50'] or 0) * 1000, (summary['p95'] or 0) * 1000,
+                (summary['p99'] or 0) * 1000,
+                summary['queries_per_request'],
+                summary['graph_calls_per_request']))
+        return '\n'.join(lines)
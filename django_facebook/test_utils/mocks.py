@@ -53,6 +53,10 @@ class MockFacebookAPI(OpenFacebook):
             response = dict(data=[friend])
             return response
 
+    def request(self, path='', post_data=None, old_api=False, **params):
+        # iterate requests the first page without get
+        return self.get(path, **params)
+
     def set(self, path, **kwargs):
         return dict(id=123456789)
 
@@ -24,6 +24,10 @@ class FacebookTest(TestCase):
         open_facebook.OpenFacebook = api.OpenFacebook = MockFacebookAPI
         open_facebook.FacebookAuthorization = api.FacebookAuthorization = MockFacebookAuthorization
 
+        # the circuit breaker is shared by all tests
+        from open_facebook.resilience import circuit_breaker
+        circuit_breaker.reset()
+
         rf = RequestMock()
         self.request = rf.get('/')
         self.client = Client()
@@ -53,6 +57,8 @@ class FacebookTest(TestCase):
         import open_facebook
         open_facebook.OpenFacebook = api.OpenFacebook = self.originalAPI
         open_facebook.FacebookAuthorization = api.FacebookAuthorization = self.originalAuthorization
+        from open_facebook.resilience import circuit_breaker
+        circuit_breaker.reset()
 
         self.prints.seek(0)
         content = self.prints.read()
@@ -7,7 +7,7 @@ from django.test.client import Client, RequestFactory
 from django_facebook import exceptions as facebook_exceptions, \
     settings as facebook_settings, signals
 from django_facebook.api import get_facebook_graph, FacebookUserConverter, \
-    get_persistent_graph
+    get_persistent_graph, get_facebook_converter
 from django_facebook.auth_backends import FacebookBackend
 from django_facebook.connect import _register_user, connect_user, \
     CONNECT_ACTIONS
@@ -16,7 +16,8 @@ from django_facebook.test_utils.mocks import RequestMock
 from django_facebook.test_utils.testcases import FacebookTest, LiveFacebookTest
 from django_facebook.utils import cleanup_oauth_url, get_profile_model, \
     ScriptRedirect, get_user_model, get_user_attribute, try_get_profile, \
-    get_instance_for_attribute, update_user_attributes, get_registration_backend
+    get_instance_for_attribute, update_user_attributes, get_registration_backend, \
+    parse_signed_request
 from functools import partial
 from mock import Mock, patch
 from open_facebook.api import FacebookConnection, FacebookAuthorization, \
@@ -582,6 +583,21 @@ class UserConnectTest(FacebookTest):
             self.request, facebook_graph=graph, connect_facebook=True)
         self.assertEqual(action, CONNECT_ACTIONS.LOGIN)
 
+    def test_single_profile_request(self):
+        graph = get_facebook_graph(access_token='short_username')
+        converter = get_facebook_converter(self.request, graph)
+        self.assertTrue(converter.is_authenticated())
+        converter.facebook_profile_data()
+        # connect user reuses the converter registered on the request
+        with patch.object(graph, 'me') as me:
+            action, user = connect_user(self.request, facebook_graph=graph)
+            self.assertEqual(action, CONNECT_ACTIONS.REGISTER)
+            action, user = connect_user(self.request, converter=converter)
+            self.assertEqual(action, CONNECT_ACTIONS.LOGIN)
+        self.assertFalse(me.called)
+        self.assertTrue(get_facebook_converter(self.request, graph) is
+                        converter)
+
     def test_parallel_register(self):
         '''
         Adding some testing for the case when one person tries to register
@@ -676,6 +692,32 @@ class UserConnectTest(FacebookTest):
         self.assertNotEqual(user.username, new_user.username)
         self.assertNotEqual(user.id, new_user.id)
 
+    def test_unique_username(self):
+        user_model = get_user_model()
+        for username in ['johnny', 'john', 'john7', 'john_smith', 'john1a',
+                         'a' * 30]:
+            user_model.objects.create(username=username)
+        create_unique_username = FacebookUserConverter._create_unique_username
+        self.assertEqual(create_unique_username('john'), 'john8')
+        self.assertEqual(create_unique_username('jane'), 'jane')
+        # the number shouldn't make it too long
+        self.assertEqual(create_unique_username('a' * 30), 'a' * 29 + '1')
+
+    def test_unique_username_indexed(self):
+        from django.db import connection
+        usernames = FacebookUserConverter._username_suffix_queryset('john')
+        sql, params = usernames.query.sql_with_params()
+        # a range on the username, no case insensitive scan
+        self.assertTrue('LIKE' not in sql.upper())
+        max_length = get_user_model()._meta.get_field('username').max_length
+        self.assertEqual(tuple(params[:2]),
+                         ('john', 'john' + '9' * (max_length - 4)))
+        if connection.vendor == 'sqlite':
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join([str(row[-1]) for row in cursor.fetchall()])
+            self.assertTrue('USING' in plan and 'INDEX' in plan, plan)
+
     def test_registration_form(self):
         '''
         Django_facebook should use user supplied registration form if given
@@ -855,6 +897,18 @@ class FacebookCanvasMiddlewareTest(FacebookTest):
         self.assertTrue(mocked_method.called)
         self.assertIsInstance(response, ScriptRedirect)
 
+    @patch.object(FacebookAuthorization, 'parse_signed_data')
+    def test_parsed_once_per_request(self, mocked_method=FacebookAuthorization.parse_signed_data):
+        mocked_method.return_value = {'user_id': '123456'}
+        request = self.get_canvas_url(data={'signed_request': 'signed'})
+        for x in range(3):
+            parsed = parse_signed_request('signed', request)
+            self.assertEqual(parsed['user_id'], '123456')
+        self.assertEqual(mocked_method.call_count, 1)
+        # a new request parses it again
+        parse_signed_request('signed', self.get_canvas_url())
+        self.assertEqual(mocked_method.call_count, 2)
+
     @patch('django_facebook.middleware.connect_user', fake_connect)
     @patch.object(OpenFacebook, 'permissions')
     @patch.object(FacebookAuthorization, 'parse_signed_data')
@@ -870,3 +924,445 @@ class FacebookCanvasMiddlewareTest(FacebookTest):
         mocked_method_2.return_value = facebook_settings.FACEBOOK_DEFAULT_SCOPE
         self.assertIsNone(self.middleware.process_request(request))
         self.assertTrue(mocked_method_1.called)
+
+
+class ConvertCodeTest(FacebookTest):
+
+    def test_wait_for_other_request(self):
+        from django.core.cache import cache
+        from django_facebook.api import convert_code
+        from django_facebook.utils import hash_key
+        from open_facebook import FacebookAuthorization
+        code = 'concurrent_code'
+        cache_key = hash_key('convert_code_%s' % code)
+        # another request is converting the code
+        cache.add(hash_key('convert_code_lock_%s' % code), 1, 10)
+
+        def other_request_finishes(seconds):
+            cache.set(cache_key, 'other_token', 60)
+        with patch('django_facebook.api.time.sleep', other_request_finishes):
+            with patch.object(FacebookAuthorization, 'convert_code') as convert:
+                token_response = convert_code(code)
+        self.assertEqual(token_response['access_token'], 'other_token')
+        self.assertFalse(convert.called)
+
+    def test_other_request_fails(self):
+        import itertools
+        from django.core.cache import cache
+        from django_facebook.api import convert_code
+        from django_facebook.utils import hash_key
+        from open_facebook import FacebookAuthorization
+        code = 'failed_code'
+        lock_key = hash_key('convert_code_lock_%s' % code)
+        cache.add(lock_key, 1, 10)
+
+        def other_request_fails(seconds):
+            # the lock is released and taken by another waiter
+            cache.delete(lock_key)
+            cache.add(lock_key, 1, 10)
+        with patch('django_facebook.api.time.sleep', other_request_fails):
+            with patch('django_facebook.api.time.time') as now:
+                now.side_effect = itertools.count()
+                with patch.object(FacebookAuthorization, 'convert_code') as convert:
+                    self.assertRaises(FacebookUnreachable, convert_code, code)
+        # only the waiter holding the lock converts the code
+        self.assertFalse(convert.called)
+
+    def test_convert(self):
+        from django_facebook.api import convert_code
+        from open_facebook import FacebookAuthorization
+        with patch.object(FacebookAuthorization, 'convert_code') as convert:
+            convert.return_value = dict(access_token='new_token', expires=60)
+            self.assertEqual(convert_code('new_code')['expires'], 60)
+            # the second time it comes from the cache
+            self.assertEqual(
+                convert_code('new_code')['access_token'], 'new_token')
+        self.assertEqual(convert.call_count, 1)
+
+
+class StoreLikesTest(FacebookTest):
+
+    def test_chunked_store(self):
+        from django_facebook.models import FacebookLike
+        from django_facebook.test_utils.benchmarks import make_likes
+        user = get_user_model().objects.get(username='tschellenbach')
+        sizes = []
+
+        def post_likes(sender, user, likes, current_likes, inserted_likes,
+                       **kwargs):
+            sizes.append((len(likes), current_likes.count(),
+                          len(inserted_likes)))
+        signals.facebook_post_store_likes.connect(post_likes)
+        try:
+            with patch.object(facebook_settings, 'FACEBOOK_STORE_CHUNK_SIZE', 40):
+                stored = FacebookUserConverter._store_likes(
+                    user, iter(make_likes(100)), count=True)
+                self.assertEqual(stored, 100)
+                # the signal is sent once with all the likes
+                self.assertEqual(sizes, [(100, 0, 100)])
+                # storing them again doesn't insert anything
+                FacebookUserConverter._store_likes(user, make_likes(100))
+                self.assertEqual(sizes[1:], [(100, 100, 0)])
+        finally:
+            signals.facebook_post_store_likes.disconnect(post_likes)
+        self.assertEqual(
+            FacebookLike.objects.filter(user_id=user.id).count(), 100)
+
+    def test_get_and_store_friends(self):
+        from django_facebook.models import FacebookUser
+        user = get_user_model().objects.get(username='tschellenbach')
+        graph = get_facebook_graph(access_token='paul')
+        converter = FacebookUserConverter(graph)
+        friends = [dict(id=str(200000 + x), name='Friend %s' % x,
+                        gender='male') for x in range(30)]
+        with patch.object(graph, 'iterate', return_value=iter(friends)) as iterate:
+            stored = converter._get_and_store_friends(user)
+        self.assertEqual(stored, 30)
+        # the friends are paged instead of loaded in one response
+        self.assertEqual(iterate.call_args[0], ('me/friends',))
+        stored_friends = FacebookUser.objects.filter(user_id=user.id)
+        self.assertEqual(stored_friends.filter(gender='M').count(), 30)
+
+    def test_sync_friends(self):
+        from django_facebook.models import FacebookUser
+        from django_facebook.test_utils.benchmarks import make_friends
+        user = get_user_model().objects.get(username='tschellenbach')
+        stored = FacebookUserConverter._store_friends(
+            user, make_friends(30), count=True, sync=True)
+        self.assertEqual(stored, 30)
+        # one friend changed, one was removed
+        friends = make_friends(29)
+        friends[0]['sex'] = 'female'
+        FacebookUserConverter._store_friends(user, friends, sync=True)
+        stored_friends = FacebookUser.objects.filter(user_id=user.id)
+        self.assertEqual(stored_friends.count(), 29)
+        self.assertEqual(stored_friends.get(facebook_id=200000).gender, 'F')
+
+    def test_insert_ignore(self):
+        from django.db import transaction
+        from django_facebook.models import FacebookUser
+        from django_facebook.utils import insert_ignore
+        FacebookUser.objects.create(user_id=1, facebook_id=2, name='stored')
+        friends = [FacebookUser(user_id=1, facebook_id=2, name='concurrent'),
+                   FacebookUser(user_id=1, facebook_id=3, name='new')]
+        with transaction.commit_on_success():
+            insert_ignore(FacebookUser, friends)
+        self.assertEqual(FacebookUser.objects.filter(user_id=1).count(), 2)
+
+    def test_unchanged_friends(self):
+        from django.core.cache import cache
+        from django_facebook.models import FacebookUser
+        from django_facebook.test_utils.benchmarks import make_friends
+        user = get_user_model().objects.get(username='tschellenbach')
+        cache.delete('django_facebook:fingerprint:%s:%s' % (
+            'django_facebook_facebookuser', user.id))
+        changes = []
+
+        def post_friends(sender, changed, **kwargs):
+            changes.append(changed)
+        signals.facebook_post_store_friends.connect(post_friends)
+        try:
+            with patch.object(facebook_settings, 'FACEBOOK_STORE_FINGERPRINT_TIMEOUT', 60):
+                FacebookUserConverter._store_friends(
+                    user, make_friends(30), sync=True)
+                # the same friends in another order only count the rows
+                friends = list(reversed(make_friends(30)))
+                with self.assertNumQueries(1):
+                    FacebookUserConverter._store_friends(
+                        user, friends, sync=True)
+                # deleted rows are stored again
+                FacebookUser.objects.filter(user_id=user.id)[0].delete()
+                FacebookUserConverter._store_friends(user, friends, sync=True)
+        finally:
+            signals.facebook_post_store_friends.disconnect(post_friends)
+        self.assertEqual(changes, [True, False, True])
+        self.assertEqual(
+            FacebookUser.objects.filter(user_id=user.id).count(), 30)
+
+    def test_content_chunks(self):
+        from django_facebook.test_utils.benchmarks import make_friends
+        from django_facebook.utils import content_chunks, fingerprint
+        friends = make_friends(300)
+
+        def chunk_fingerprints(friends):
+            return set([fingerprint(chunk, ['id', 'name', 'sex'])
+                        for chunk in content_chunks(friends, 20)])
+        before = chunk_fingerprints(friends)
+        self.assertTrue(len(before) > 5)
+        # removing a friend only changes the chunk it was in
+        after = chunk_fingerprints(friends[:100] + friends[101:])
+        self.assertEqual(len(before - after), 1)
+        self.assertEqual(len(after - before), 1)
+
+    def test_registered_friends(self):
+        from django.core.cache import cache
+        from django_facebook.test_utils.benchmarks import make_friends
+        user = get_user_model().objects.get(username='tschellenbach')
+        cache.delete('django_facebook:fingerprint:%s:%s' % (
+            'django_facebook_facebookuser', user.id))
+        friend = get_user_model().objects.create(username='registered')
+        profile = try_get_profile(friend)
+        user_or_profile = get_instance_for_attribute(
+            friend, profile, 'facebook_id')
+        user_or_profile.facebook_id = 200001
+        user_or_profile.save()
+
+        with patch.object(facebook_settings, 'FACEBOOK_STORE_FINGERPRINT_TIMEOUT', 60):
+            FacebookUserConverter._store_friends(
+                user, make_friends(5), sync=True)
+            graph = get_facebook_graph(access_token='paul')
+            converter = FacebookUserConverter(graph)
+            friends, new_friends = converter.registered_friends(user)
+            self.assertEqual([f.pk for f in friends], [user_or_profile.pk])
+            self.assertEqual(sorted(f['id'] for f in new_friends),
+                             ['200000', '200002', '200003', '200004'])
+            self.assertEqual(new_friends[0]['id'], new_friends[0]['uid'])
+            self.assertEqual(sorted(new_friends[0].keys()),
+                             ['id', 'name', 'sex', 'uid'])
+            # logging in doesn't change the registered friends
+            signals.facebook_post_update.send(
+                sender=get_user_model(), user=friend, profile=profile,
+                facebook_data={})
+            with self.assertNumQueries(0):
+                converter.registered_friends(user)
+
+            # a registration drops the cached results
+            signals.facebook_user_registered.send(
+                sender=get_user_model(), user=friend, facebook_data={})
+            user_or_profile.facebook_id = 200002
+            user_or_profile.save()
+            friends, new_friends = converter.registered_friends(user)
+            self.assertEqual(len(new_friends), 4)
+            self.assertTrue('200002' not in [f['id'] for f in new_friends])
+
+    def test_registered_friends_version(self):
+        from django.core.cache import cache
+        from django_facebook.api import registered_friends_cache_key, \
+            REGISTERED_FRIENDS_VERSION_KEY
+        user = get_user_model().objects.get(username='tschellenbach')
+        key = registered_friends_cache_key(user)
+        self.assertEqual(registered_friends_cache_key(user), key)
+        # an expired version doesn't make old entries valid again
+        cache.delete(REGISTERED_FRIENDS_VERSION_KEY)
+        self.assertNotEqual(registered_friends_cache_key(user), key)
+
+    def test_random_facebook_friends(self):
+        from django_facebook.models import FacebookUser
+        from django_facebook.test_utils.benchmarks import make_friends
+        user = get_user_model().objects.get(username='tschellenbach')
+        FacebookUserConverter._store_friends(
+            user, make_friends(60), sync=True)
+        friend = get_user_model().objects.create(username='registered')
+        profile = try_get_profile(friend)
+        user_or_profile = get_instance_for_attribute(
+            friend, profile, 'facebook_id')
+        user_or_profile.facebook_id = 200003
+        user_or_profile.save()
+
+        friends = FacebookUser.objects.random_facebook_friends(
+            user, gender='M', limit=10)
+        self.assertEqual(len(friends), 10)
+        self.assertEqual(len(set(friends)), 10)
+        # the non members are cached, only the sample is queried
+        with self.assertNumQueries(1):
+            friends = FacebookUser.objects.random_facebook_friends(
+                user, gender='M', limit=100)
+        self.assertEqual(len(friends), 19)
+        self.assertEqual(set([f.gender for f in friends]), set(['M']))
+        self.assertTrue(200003 not in [f.facebook_id for f in friends])
+
+
+class MembershipIndexTest(FacebookTest):
+
+    def register(self, username, facebook_id):
+        user = get_user_model().objects.create(username=username)
+        profile = try_get_profile(user)
+        user_or_profile = get_instance_for_attribute(
+            user, profile, 'facebook_id')
+        user_or_profile.facebook_id = facebook_id
+        user_or_profile.save()
+        return user_or_profile
+
+    def test_membership_index(self):
+        from django_facebook.membership import MembershipIndex, \
+            update_membership_index
+        self.register('member_1', 200000)
+        self.register('member_2', 200002)
+        index = MembershipIndex()
+        index.invalidate()
+        self.assertEqual(index.filter([200000, 200001, 200002, 5]),
+                         [200000, 200002])
+
+        # registrations in another process are shared through the cache
+        other = MembershipIndex()
+        other.filter([])
+        user_or_profile = self.register('member_3', 200001)
+        index.add(user_or_profile.facebook_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(other.filter([200000, 200001, 5]),
+                             [200000, 200001])
+        # the handler ignores other models
+        update_membership_index(OpenGraphShare, OpenGraphShare())
+
+        # a new generation rebuilds the snapshot
+        index.invalidate()
+        with self.assertNumQueries(1):
+            other.filter([200000])
+
+    def test_bloom_filter(self):
+        from django_facebook.membership import MembershipIndex
+        self.register('member_1', 200000)
+        index = MembershipIndex(error_rate=0.01)
+        index.invalidate()
+        self.assertTrue(200000 in index.filter([200000]))
+        registered = index.filter(range(300000, 301000))
+        self.assertTrue(len(registered) < 50)
+
+    def test_random_friends_verified(self):
+        from django_facebook.membership import membership_index
+        from django_facebook.models import FacebookUser
+        from django_facebook.test_utils.benchmarks import make_friends
+        user = get_user_model().objects.get(username='tschellenbach')
+        FacebookUserConverter._store_friends(user, make_friends(6))
+        self.register('member_1', 200000)
+        with patch.object(facebook_settings, 'FACEBOOK_MEMBERSHIP_INDEX', True):
+            membership_index.invalidate()
+            # an id which isn't registered (anymore)
+            membership_index.add(200003)
+            friends = FacebookUser.objects.random_facebook_friends(
+                user, limit=10)
+        facebook_ids = sorted([f.facebook_id for f in friends])
+        self.assertEqual(facebook_ids, [200001, 200002, 200003, 200004,
+                                        200005])
+
+
+class NameSearchTest(FacebookTest):
+
+    def find_names(self, queries, user, index=True):
+        from django_facebook.models import FacebookUser
+        with patch.object(facebook_settings, 'FACEBOOK_NAME_SEARCH_INDEX', index):
+            users = FacebookUser.objects.find_users(queries, user=user)
+            return sorted([u.name for u in users])
+
+    def test_find_users(self):
+        from django_facebook.models import FacebookUserNameToken
+        user = get_user_model().objects.get(username='tschellenbach')
+        friends = [dict(id='1', name=u'Thierry Schellenbach', sex='male'),
+                   dict(id='2', name=u'Anne-Marie van Dijk', sex='female'),
+                   dict(id='3', name=u'Bob  Smith', sex='male')]
+        with patch.object(facebook_settings, 'FACEBOOK_NAME_SEARCH_INDEX', True):
+            FacebookUserConverter._store_friends(user, friends, sync=True)
+        self.assertEqual(FacebookUserNameToken.objects.count(), 7)
+
+        queries = [['thi'], ['SCH'], ['marie'], ['van'], ['van d'],
+                   ['smith', 'b'], ['s', 'ch']]
+        for query in queries:
+            self.assertEqual(self.find_names(query, user),
+                             self.find_names(query, user, index=False))
+        self.assertEqual(self.find_names(['sch'], user),
+                         [u'Thierry Schellenbach'])
+
+        # renamed and removed friends are updated
+        friends[0]['name'] = u'Thierry Schelle'
+        with patch.object(facebook_settings, 'FACEBOOK_NAME_SEARCH_INDEX', True):
+            FacebookUserConverter._store_friends(
+                user, friends[:2], sync=True)
+        self.assertEqual(self.find_names(['schellenbach'], user), [])
+        self.assertEqual(self.find_names(['bob'], user), [])
+        self.assertEqual(FacebookUserNameToken.objects.count(), 5)
+
+
+class UserAttributeTest(FacebookTest):
+
+    def test_field_names(self):
+        from django_facebook.utils import get_field_names
+        user = get_user_model()(username='attribute_test')
+        field_names = get_field_names(user)
+        self.assertTrue(field_names is get_field_names(get_user_model()))
+        self.assertTrue('username' in field_names)
+        self.assertEqual(
+            get_user_attribute(user, None, 'username'), 'attribute_test')
+        self.assertEqual(get_user_attribute(user, None, 'unknown', None),
+                         None)
+        self.assertRaises(AttributeError, get_user_attribute, user, None,
+                          'unknown')
+
+    def test_profile_cached(self):
+        user = get_user_model().objects.get(username='tschellenbach')
+        profile = get_profile_model()(user=user)
+        user._profile_cache = profile
+        with self.assertNumQueries(0):
+            self.assertTrue(try_get_profile(user) is profile)
+
+    def test_shared_profile_cache(self):
+        from django.core.cache import cache
+        from django_facebook.utils import cache_profile, profile_cache_key, \
+            remove_cached_profile
+        user = get_user_model().objects.get(username='tschellenbach')
+        profile_model = get_profile_model()
+        profile = profile_model(user=user)
+        key = profile_cache_key(profile_model, user.id)
+        with patch.object(facebook_settings, 'FACEBOOK_PROFILE_CACHE_TIMEOUT', 60):
+            cache_profile(profile)
+            user = get_user_model().objects.get(id=user.id)
+            with self.assertNumQueries(0):
+                cached = try_get_profile(user)
+            self.assertEqual(cached.user_id, user.id)
+            self.assertTrue(cached.user is user)
+            remove_cached_profile(profile_model, profile)
+            self.assertEqual(cache.get(key), None)
+
+    def test_remove_old_connections(self):
+        from django.db.models.signals import post_save
+        from django_facebook.connect import _remove_old_connections
+        user = get_user_model().objects.create(username='old_connection')
+        profile = try_get_profile(user)
+        user_or_profile = get_instance_for_attribute(
+            user, profile, 'facebook_id')
+        user_or_profile.facebook_id = 300000
+        user_or_profile.save()
+        saved = []
+
+        def post_save_account(sender, instance, **kwargs):
+            saved.append((instance.pk, instance.facebook_id))
+        post_save.connect(post_save_account, sender=type(user_or_profile))
+        try:
+            _remove_old_connections(300000)
+        finally:
+            post_save.disconnect(post_save_account,
+                                 sender=type(user_or_profile))
+        # post_save updates the cached profile
+        self.assertEqual(saved, [(user_or_profile.pk, None)])
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_compare(self):
+        from django_facebook.test_utils import benchmarks
+        results = benchmarks.run_benchmarks(
+            ['match_error_code', 'merge_urls'], repeat=1)
+        baseline = dict(match_error_code=dict(best=results[
+                        'match_error_code']['best'] / 2))
+        comparison = benchmarks.compare(results, baseline, tolerance=0.2)
+        self.assertEqual([c[0] for c in comparison],
+                         ['match_error_code', 'merge_urls'])
+        name, previous, current, ratio, regression = comparison[0]
+        self.assertTrue(regression)
+        # not in the baseline, so no regression
+        self.assertEqual(comparison[1][3], None)
+        self.assertFalse(comparison[1][4])
+
+
+class ConnectLoadTestTest(FacebookTest):
+
+    def test_load_test(self):
+        from django_facebook.test_utils.load import ConnectLoadTest
+        load_test = ConnectLoadTest(users=2, latency_scale=0)
+        report = load_test.run()
+        self.assertEqual(sorted(report.keys()),
+                         ['connect', 'login', 'register'])
+        for flow, summary in report.items():
+            self.assertEqual(summary['requests'], 2)
+            self.assertTrue(summary['p50'] <= summary['p99'])
+            self.assertTrue(summary['graph_calls_per_request'] > 0)
+        self.assertTrue(load_test.format_report(report))
@@ -12,7 +12,8 @@ from datetime import datetime
 from django.http import QueryDict, HttpResponse, HttpResponseRedirect
 from django.conf import settings
 import django.contrib.auth
-from django.db import models, transaction
+from django.db import models, transaction, connections, router
+import copy
 import logging
 import re
 from django_facebook import settings as facebook_settings
@@ -61,48 +62,52 @@ def get_model_for_attribute(attribute):
     return model
 
 
+# maps model options to a frozenset of field names
+_field_names = {}
+
+
+def get_field_names(model):
+    '''
+    Returns the field names for a model or model instance
+    These are only computed once per model
+    '''
+    options = model._meta
+    field_names = _field_names.get(options)
+    if field_names is None:
+        field_names = frozenset([f.name for f in options.fields])
+        _field_names[options] = field_names
+    return field_names
+
+
 def is_profile_attribute(attribute):
     profile_model = get_profile_model()
-    profile_fields = []
-    if profile_model:
-        profile_fields = [f.name for f in profile_model._meta.fields]
-    return attribute in profile_fields
+    return bool(profile_model) and attribute in get_field_names(profile_model)
 
 
 def is_user_attribute(attribute):
     user_model = get_user_model()
-    user_fields = [f.name for f in user_model._meta.fields]
-    return attribute in user_fields
+    return attribute in get_field_names(user_model)
 
 
 def get_instance_for_attribute(user, profile, attribute):
-    profile_fields = []
-    if profile:
-        profile_fields = [f.name for f in profile._meta.fields]
-    user_fields = [f.name for f in user._meta.fields]
-    is_profile_field = lambda f: f in profile_fields and hasattr(profile, f)
-    is_user_field = lambda f: f in user_fields and hasattr(user, f)
-
+    '''
+    Returns the profile or the user, whichever has the attribute as
+    a field. The profile takes precedence
+    '''
     instance = None
-    if is_profile_field(attribute):
+    if profile and attribute in get_field_names(profile) and \
+            hasattr(profile, attribute):
         instance = profile
-    elif is_user_field(attribute):
+    elif attribute in get_field_names(user) and hasattr(user, attribute):
         instance = user
     return instance
 
 
 def get_user_attribute(user, profile, attribute, default=NOTHING):
-    profile_fields = []
-    if profile:
-        profile_fields = [f.name for f in profile._meta.fields]
-    user_fields = [f.name for f in user._meta.fields]
-    is_profile_field = lambda f: f in profile_fields and hasattr(profile, f)
-    is_user_field = lambda f: f in user_fields and hasattr(user, f)
-
-    if is_profile_field(attribute):
-        value = getattr(profile, attribute)
-    elif is_user_field(attribute):
-        value = getattr(user, attribute)
+    instance = get_instance_for_attribute(user, profile, attribute)
+
+    if instance is not None:
+        value = getattr(instance, attribute)
     elif default is not NOTHING:
         value = default
     else:
@@ -116,21 +121,11 @@ def update_user_attributes(user, profile, attributes_dict, save=False):
     '''
     Write the attributes either to the user or profile instance
     '''
-    profile_fields = []
-    if profile:
-        profile_fields = [f.name for f in profile._meta.fields]
-    user_fields = [f.name for f in user._meta.fields]
-
-    is_profile_field = lambda f: f in profile_fields and hasattr(profile, f)
-    is_user_field = lambda f: f in user_fields and hasattr(user, f)
-
     for f, value in attributes_dict.items():
-        if is_profile_field(f):
-            setattr(profile, f, value)
-            profile._fb_is_dirty = True
-        elif is_user_field(f):
-            setattr(user, f, value)
-            user._fb_is_dirty = True
+        instance = get_instance_for_attribute(user, profile, f)
+        if instance is not None:
+            setattr(instance, f, value)
+            instance._fb_is_dirty = True
         else:
             logger.info('skipping update of field %s', f)
 
@@ -141,46 +136,142 @@ def update_user_attributes(user, profile, attributes_dict, save=False):
             profile.save()
 
 
+# maps FACEBOOK_PROFILE_MODULE to the model
+_facebook_profile_models = {}
+
+
+def get_facebook_profile_model():
+    '''
+    Returns the FACEBOOK_PROFILE_MODULE model, resolved only once
+    Raises SiteProfileNotAvailable if it isn't configured correctly
+    '''
+    profile_module = getattr(settings, 'FACEBOOK_PROFILE_MODULE', False)
+    model = _facebook_profile_models.get(profile_module)
+    if model is not None:
+        return model
+
+    if not profile_module:
+        logger.debug("TGP03 No facebook profile module insettings")
+        raise SiteProfileNotAvailable(
+            'You need to set FACEBOOK_PROFILE_MODULE in your project '
+            'settings')
+    try:
+        logger.debug("TGP03 Get model name and app name")
+        app_label, model_name = profile_module.split('.')
+        logger.debug("TGP04 App label: %s" % app_label)
+        logger.debug("TGP05 Model name: %s" % model_name)
+    except ValueError:
+        logger.debug("TGP06 Value error exception")
+        raise SiteProfileNotAvailable(
+            'app_label and model_name should be separated by a dot in '
+            'the FACEBOOK_PROFILE_MODULE setting')
+    try:
+        logger.debug("TGP07 Try getting model")
+        model = models.get_model(app_label, model_name)
+        logger.debug("TGP08 Model is %s" % model)
+    except (ImportError, ImproperlyConfigured):
+        logger.debug("TGP10 Import error in cache get ")
+        raise SiteProfileNotAvailable
+    if model is None:
+        logger.debug("TGP09 Model is None")
+        raise SiteProfileNotAvailable(
+            'Unable to load the profile model, check '
+            'FACEBOOK_PROFILE_MODULE in your project settings')
+    _facebook_profile_models[profile_module] = model
+    return model
+
+
+def profile_cache_key(model, user_id):
+    '''
+    The key includes a hash of the field names, so changing the profile
+    model never loads old pickles
+    '''
+    version = hash_key(','.join(sorted(get_field_names(model))))[:8]
+    key = 'django_facebook:profile:%s:%s:%s' % (
+        model._meta.db_table, version, user_id)
+    return key
+
+
+def cache_profile(profile, add=False):
+    '''
+    Stores the profile in the Django cache
+    With add=True an existing entry isn't replaced, so a slow read can't
+    overwrite a profile which was saved in the meantime
+    '''
+    from django.core.cache import cache
+    timeout = facebook_settings.FACEBOOK_PROFILE_CACHE_TIMEOUT
+    key = profile_cache_key(type(profile), profile.user_id)
+    # don't store the related objects, like the user
+    cached = copy.copy(profile)
+    for name in cached.__dict__.keys():
+        if name.startswith('_') and name.endswith('_cache'):
+            del cached.__dict__[name]
+    if add:
+        cache.add(key, cached, timeout)
+    else:
+        cache.set(key, cached, timeout)
+
+
+def get_cached_profile(model, user):
+    '''
+    Returns the profile from the Django cache, falling back to the
+    database
+    '''
+    from django.core.cache import cache
+    key = profile_cache_key(model, user.id)
+    profile = cache.get(key)
+    if profile is None:
+        profile = model._default_manager.using(
+            user._state.db).get(user__id__exact=user.id)
+        cache_profile(profile, add=True)
+    return profile
+
+
+def _is_profile_model(model):
+    try:
+        return model is get_facebook_profile_model()
+    except SiteProfileNotAvailable:
+        return False
+
+
+def update_cached_profile(sender, instance, **kwargs):
+    '''
+    post_save handler replacing the cached profile
+    '''
+    if _is_profile_model(sender):
+        cache_profile(instance)
+
+
+def remove_cached_profile(sender, instance, **kwargs):
+    '''
+    post_delete handler removing the cached profile
+    '''
+    if _is_profile_model(sender):
+        from django.core.cache import cache
+        cache.delete(profile_cache_key(sender, instance.user_id))
+
+
 def try_get_profile(user):
     """
     Overwritten.
     Returns FacebookUserProfile.
+
+    The profile is cached on the user instance, so it's only
+    fetched once per user object. With FACEBOOK_PROFILE_CACHE_TIMEOUT
+    it's also shared through the Django cache
     """
-    from bongoregistration.models import FacebookUserProfile
     logger.debug("TGP01 Try get profile")
-    if not hasattr(user, '_profile_cache') or not isinstance(user, FacebookUserProfile):
+    model = get_facebook_profile_model()
+    # django's get_profile uses the same attribute, possibly for another
+    # profile model
+    if not isinstance(getattr(user, '_profile_cache', None), model):
         logger.debug("TGP02 No _profile_cache")
-        from django.conf import settings
-        if not getattr(settings, 'FACEBOOK_PROFILE_MODULE', False):
-            logger.debug("TGP03 No facebook profile module insettings")
-            raise SiteProfileNotAvailable(
-                'You need to set FACEBOOK_PROFILE_MODULE in your project '
-                'settings')
-        try:
-            logger.debug("TGP03 Get model name and app name")
-            app_label, model_name = settings.FACEBOOK_PROFILE_MODULE.split('.')
-            logger.debug("TGP04 App label: %s" % app_label)
-            logger.debug("TGP05 Model name: %s" % model_name)
-        except ValueError:
-            logger.debug("TGP06 Value error exception")
-            raise SiteProfileNotAvailable(
-                'app_label and model_name should be separated by a dot in '
-                'the FACEBOOK_PROFILE_MODULE setting')
-        try:
-            logger.debug("TGP07 Try getting model")
-            model = models.get_model(app_label, model_name)
-            logger.debug("TGP08 Model is %s" % model)
-            if model is None:
-                logger.debug("TGP09 Model is None")
-                raise SiteProfileNotAvailable(
-                    'Unable to load the profile model, check '
-                    'FACEBOOK_PROFILE_MODULE in your project settings')
+        if facebook_settings.FACEBOOK_PROFILE_CACHE_TIMEOUT:
+            user._profile_cache = get_cached_profile(model, user)
+        else:
             user._profile_cache = model._default_manager.using(
-                               user._state.db).get(user__id__exact=user.id)
-            user._profile_cache.user = user
-        except (ImportError, ImproperlyConfigured):
-            logger.debug("TGP10 Import error in cache get ")
-            raise SiteProfileNotAvailable
+                user._state.db).get(user__id__exact=user.id)
+        user._profile_cache.user = user
     logger.debug("TGP11 Got profile %s" % user._profile_cache)
     return user._profile_cache
 
@@ -191,14 +282,27 @@ def hash_key(key):
     return hashed
 
 
-def parse_signed_request(signed_request_string):
+def parse_signed_request(signed_request_string, request=None):
     '''
     Just here for your convenience, actual logic is in the
     FacebookAuthorization class
+
+    When the request is given the result is remembered on it, so the
+    middleware, decorators and views only parse it once per request
     '''
     from open_facebook.api import FacebookAuthorization
+    memo = None
+    if request is not None:
+        memo = getattr(request, '_parsed_signed_requests', None)
+        if memo is None:
+            memo = request._parsed_signed_requests = {}
+        if signed_request_string in memo:
+            return memo[signed_request_string]
+
     signed_request = FacebookAuthorization.parse_signed_data(
         signed_request_string)
+    if memo is not None:
+        memo[signed_request_string] = signed_request
     return signed_request
 
 
@@ -390,6 +494,226 @@ def mass_get_or_create(model_class, base_queryset, id_field, default_dict,
     return current_instances, inserted_model_instances
 
 
+@transaction.commit_on_success
+def mass_upsert(model_class, base_queryset, id_field, default_dict,
+                global_defaults):
+    '''
+    Inserts the new records and updates the columns which changed for the
+    records which are already stored. Only the given ids are looked up,
+    so calling this per chunk keeps memory usage and transactions small
+
+    Records inserted by a concurrent run are skipped instead of raising
+    an IntegrityError, see insert_ignore
+
+    **Example**::
+
+        default_dict = {'12': dict(name='Thierry', gender='M')}
+        mass_upsert(FacebookUser, FacebookUser.objects.filter(user_id=1),
+                    'facebook_id', default_dict, dict(user_id=1))
+
+    :returns: a tuple with the set of ids which were already stored, the
+        list of new instances and the number of updated records
+    '''
+    connection = connections[base_queryset.db]
+    given_ids = map(unicode, default_dict.keys())
+    update_fields = set()
+    for defaults in default_dict.values():
+        update_fields.update(defaults.keys())
+    update_fields.discard(id_field)
+    update_fields = [model_class._meta.get_field(f) for f in update_fields]
+
+    # compare the prepared database values, which handles timezones etc
+    def prepare(field, value):
+        return field.get_db_prep_save(value, connection=connection)
+
+    lookup = {'%s__in' % id_field: given_ids}
+    stored = base_queryset.filter(**lookup).values_list(
+        id_field, *[f.name for f in update_fields])
+    current_values = dict((unicode(row[0]), row[1:]) for row in stored)
+
+    prepared_models = []
+    # maps the changed values to the ids needing them
+    changes = {}
+    for new_id in given_ids:
+        defaults = default_dict[new_id]
+        if new_id in current_values:
+            changed = []
+            for field, value in zip(update_fields, current_values[new_id]):
+                if field.name not in defaults:
+                    continue
+                new_value = defaults[field.name]
+                if prepare(field, new_value) != prepare(field, value):
+                    changed.append((field.name, new_value))
+            if changed:
+                changes.setdefault(tuple(changed), []).append(new_id)
+        else:
+            defaults[id_field] = new_id
+            defaults.update(global_defaults)
+            prepared_models.append(model_class(**defaults))
+
+    updated = 0
+    for changed, ids in changes.items():
+        lookup = {'%s__in' % id_field: ids}
+        updated += base_queryset.filter(**lookup).update(**dict(changed))
+
+    insert_ignore(model_class, prepared_models, using=base_queryset.db)
+    return set(current_values), prepared_models, updated
+
+
+def insert_ignore(model_class, instances, using=None):
+    '''
+    Inserts the instances, skipping the ones which violate a unique
+    constraint. Uses INSERT OR IGNORE on sqlite, INSERT IGNORE on MySQL
+    and ON CONFLICT DO NOTHING on PostgreSQL 9.5+. Other databases insert
+    row by row when the bulk insert fails
+
+    Needs to run in a transaction, like mass_upsert
+
+    :returns: the number of inserted rows
+    '''
+    if not instances:
+        return 0
+    using = using or router.db_for_write(model_class)
+    connection = connections[using]
+    vendor = connection.vendor
+    prefix, suffix = 'INSERT INTO', ''
+    if vendor == 'sqlite':
+        prefix = 'INSERT OR IGNORE INTO'
+    elif vendor == 'mysql':
+        prefix = 'INSERT IGNORE INTO'
+    elif vendor == 'postgresql' and \
+            (getattr(connection, 'pg_version', None) or 0) >= 90500:
+        suffix = ' ON CONFLICT DO NOTHING'
+    else:
+        return _insert_ignore_fallback(model_class, instances, using)
+
+    fields = [f for f in model_class._meta.local_fields
+              if not isinstance(f, models.AutoField)]
+    batch_size = len(instances)
+    if hasattr(connection.ops, 'bulk_batch_size'):
+        batch_size = connection.ops.bulk_batch_size(fields, instances)
+    quote_name = connection.ops.quote_name
+    columns = ', '.join([quote_name(f.column) for f in fields])
+    row = '(%s)' % ', '.join(['%s'] * len(fields))
+
+    inserted = 0
+    cursor = connection.cursor()
+    for start in range(0, len(instances), max(batch_size, 1)):
+        batch = instances[start:start + batch_size]
+        params = []
+        for instance in batch:
+            params.extend([
+                f.get_db_prep_save(f.pre_save(instance, True),
+                                   connection=connection)
+                for f in fields])
+        sql = '%s %s (%s) VALUES %s%s' % (
+            prefix, quote_name(model_class._meta.db_table), columns,
+            ', '.join([row] * len(batch)), suffix)
+        cursor.execute(sql, params)
+        inserted += max(cursor.rowcount, 0)
+    transaction.set_dirty(using=using)
+    return inserted
+
+
+def _insert_ignore_fallback(model_class, instances, using):
+    from django.db.utils import IntegrityError
+    sid = transaction.savepoint(using=using)
+    try:
+        model_class.objects.using(using).bulk_create(instances)
+        transaction.savepoint_commit(sid, using=using)
+        return len(instances)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid, using=using)
+
+    # a concurrent run inserted some of them, insert the others one by one
+    inserted = 0
+    for instance in instances:
+        sid = transaction.savepoint(using=using)
+        try:
+            instance.save(using=using, force_insert=True)
+            transaction.savepoint_commit(sid, using=using)
+            inserted += 1
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+    return inserted
+
+
+def delete_stale(base_queryset, id_field, keep_ids, chunk_size=500):
+    '''
+    Deletes the records which aren't in keep_ids, in chunks so no
+    transaction holds locks for too long
+
+    :returns: the number of deleted records
+    '''
+    from open_facebook.utils import chunks
+    keep_ids = set(map(unicode, keep_ids))
+    stored_ids = base_queryset.values_list(id_field, flat=True)
+    stale_ids = [i for i in stored_ids if unicode(i) not in keep_ids]
+    deleted = 0
+    for ids in chunks(stale_ids, chunk_size):
+        with transaction.commit_on_success(using=base_queryset.db):
+            lookup = {'%s__in' % id_field: ids}
+            base_queryset.filter(**lookup).delete()
+        deleted += len(ids)
+    return deleted
+
+
+def fingerprint(items, fields):
+    '''
+    Hash of the given fields of a list of dicts, independent of the
+    order of the items
+
+    **Example**::
+
+        >>> a = fingerprint([dict(id=1), dict(id=2)], ['id'])
+        >>> b = fingerprint([dict(id=2), dict(id=1)], ['id'])
+        >>> a == b
+        True
+    '''
+    import hashlib
+    total = 0
+    for item in items:
+        values = u'\x1f'.join([unicode(item.get(f)) for f in fields])
+        total += int(hashlib.md5(values.encode('utf8')).hexdigest(), 16)
+    return '%032x' % (total % 2 ** 128)
+
+
+def combine_fingerprints(fingerprints):
+    '''
+    Combines fingerprints of chunks into the fingerprint of all their
+    items, the same as calling fingerprint on all items
+    '''
+    total = sum([int(f, 16) for f in fingerprints])
+    return '%032x' % (total % 2 ** 128)
+
+
+def content_chunks(items, size, key='id'):
+    '''
+    Splits the items in chunks of on average size items, ending a chunk
+    after every item whose key hashes to a multiple of size
+
+    The boundaries depend on the items instead of their position, so
+    inserting or removing an item only changes the chunk it's in. Chunks
+    are cut at 4 times size to bound the memory usage
+
+    **Example**::
+
+        for friends in content_chunks(friends, 100):
+            store(friends)
+    '''
+    import hashlib
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        value = unicode(item[key]).encode('utf8')
+        boundary = int(hashlib.md5(value).hexdigest(), 16) % size == 0
+        if boundary or len(chunk) >= size * 4:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def get_form_class(backend, request):
     '''
     Will use registration form in the following order:
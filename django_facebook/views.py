@@ -8,10 +8,11 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django_facebook import exceptions as facebook_exceptions, \
     settings as facebook_settings
+from django_facebook.api import get_facebook_converter
 from django_facebook.connect import CONNECT_ACTIONS, connect_user
 from django_facebook.decorators import facebook_required_lazy
 from django_facebook.utils import next_redirect, get_registration_backend, \
-    to_bool, error_next_redirect, get_instance_for, try_get_profile
+    to_bool, error_next_redirect, try_get_profile
 from open_facebook import exceptions as open_facebook_exceptions
 from open_facebook.utils import send_warning
 import logging
@@ -40,8 +41,13 @@ def connect(request, graph):
 
     if 'campaign_id' in request.GET:
         request.session['share_campaign_id'] = request.GET['campaign_id']
+
     try:
         response = _connect(request, graph)
+    except open_facebook_exceptions.FacebookCircuitOpen, e:
+        logger.info('CO03 Facebook is down, connect failed fast')
+        additional_params = dict(fb_error_or_cancel=1, fb_unavailable=1)
+        response = backend.post_error(request, additional_params)
     except open_facebook_exceptions.FacebookUnreachable, e:
         logger.info('CO02 Probably slow FB')
         # often triggered when Facebook is slow
@@ -72,7 +78,8 @@ def _connect(request, graph):
     logger.info('C01: trying to connect using Facebook')
     if graph:
         logger.info('C02: found a graph object')
-        converter = get_instance_for('user_conversion', graph)
+        # shared with connect_user, so we only request the profile once
+        converter = get_facebook_converter(request, graph)
         authenticated = converter.is_authenticated()
         # Defensive programming :)
         if not authenticated:
@@ -84,7 +91,8 @@ def _connect(request, graph):
         # either, login register or connect the user
         try:
             action, user = connect_user(
-                request, connect_facebook=connect_facebook)
+                request, connect_facebook=connect_facebook,
+                converter=converter)
             logger.info('Django facebook performed action: %s', action)
             # If client or subclient were detected redirect them to client login page
             if action == CONNECT_ACTIONS.CLIENT_REDIRECT:
@@ -1,2 +1,2 @@
 from open_facebook.api import (OpenFacebook, FacebookConnection,
-                               FacebookAuthorization)
+                               FacebookAuthorization, AsyncOpenFacebook)
@@ -38,6 +38,9 @@ Open Facebook allows you to use Facebook's open graph API with simple python cod
     # Use fql to retrieve your name
     facebook.fql('SELECT name FROM user WHERE uid = me()')
 
+    # Sending several requests in one round trip
+    facebook.batch(['me', 'me/permissions', ('POST', 'me/feed', dict(message='hi'))])
+
     # Executing fql in batch
     facebook.batch_fql([
         'SELECT uid, name, pic_square FROM user WHERE uid = me()',
@@ -81,24 +84,46 @@ understand the required functionality
 
 '''
 from django.http import QueryDict
+from django.utils.crypto import constant_time_compare
 from django_facebook import settings as facebook_settings
 from open_facebook import exceptions as facebook_exceptions
 from open_facebook.utils import json, encode_params, send_warning, memoized, \
-    stop_statsd, start_statsd
+    stop_statsd, start_statsd, SingleFlight, is_json
+from open_facebook.transport import get_default_transport
+from open_facebook.resilience import retry_policy, circuit_breaker
+from open_facebook.cache import get_response_cache, ALL_OBJECTS, LRUCache
+import copy
+import hashlib
 import logging
 import urllib
 import urllib2
 from django_facebook.utils import to_int
 import ssl
 import re
+import threading
+import time
 from urlparse import urlparse
 logger = logging.getLogger(__name__)
 
 
-# base timeout, actual timeout will increase when requests fail
+# timeout per attempt, see open_facebook.resilience for the retry policy
 REQUEST_TIMEOUT = 10
 # two retries was too little, sometimes facebook is a bit flaky
-REQUEST_ATTEMPTS = 3
+REQUEST_ATTEMPTS = facebook_settings.FACEBOOK_RETRY_ATTEMPTS
+# facebook accepts at most 50 operations per batch request
+BATCH_LIMIT = 50
+# finds the names referenced in batch operations, ie {result=friends:$.data}
+BATCH_REFERENCE_RE = re.compile(r'\{result=([^:}]+):')
+# finds the error code in messages like (#200) Requires publish_actions
+ERROR_CODE_RE = re.compile(r'\(#(\d+)\)')
+# default number of items to request per page when following the paging
+PAGE_SIZE = 500
+
+# merges identical concurrent read requests, see FacebookConnection._request
+single_flight = SingleFlight()
+# verified signed requests, see FacebookAuthorization.parse_signed_data
+signed_request_cache = LRUCache(
+    facebook_settings.FACEBOOK_SIGNED_REQUEST_CACHE_SIZE)
 
 
 class FacebookConnection(object):
@@ -108,6 +133,10 @@ class FacebookConnection(object):
     of Facebook API responses
     '''
     api_url = 'https://graph.facebook.com/'
+    # built by get_error_code_index
+    _error_code_index = None
+    # the transport for sending requests, see get_transport
+    transport = None
     # this older url is still used for fql requests
     old_api_url = 'https://api.facebook.com/method/'
 
@@ -151,20 +180,48 @@ class FacebookConnection(object):
             response = dict(id=123456789, setting_read_only=True)
             return response
 
-        # nicely identify ourselves before sending the request
-        opener = urllib2.build_opener()
-        opener.addheaders = [('User-agent', 'Open Facebook Python')]
+        read_request = not post_request and 'method=' not in url
+        if read_request:
+            # identical reads which are in flight at the same moment
+            # share a single request to facebook
+            response = single_flight.do(
+                url, cls._send_request, url, post_data, timeout, attempts)
+        else:
+            response = cls._send_request(url, post_data, timeout, attempts)
+        return response
+
+    @classmethod
+    def get_transport(cls):
+        '''
+        Returns the transport for sending requests, either the one set on
+        the class or the FACEBOOK_TRANSPORT default
+        '''
+        transport = cls.transport
+        if transport is None:
+            transport = get_default_transport()
+        return transport
+
+    @classmethod
+    def _send_request(cls, url, post_data, timeout, attempts):
+        '''
+        Sends the request to facebook, retrying on temporary failures
+        '''
+        # the transport actually sends the request, see open_facebook.transport
+        transport = cls.get_transport()
 
         # get the statsd path to track response times with
         path = urlparse(url).path
         statsd_path = path.replace('.', '_')
 
+        # fail fast while facebook is known to be down
+        if not circuit_breaker.allow_request():
+            raise facebook_exceptions.FacebookCircuitOpen(
+                'Facebook is unreachable, not sending requests for now')
+        retry_policy.record_request()
+
         # give it a few shots, connection is buggy at times
-        timeout_mp = 0
-        while attempts:
-            # gradually increase the timeout upon failure
-            timeout_mp += 1
-            extended_timeout = timeout * timeout_mp
+        attempt = 1
+        while True:
             response_file = None
             encoded_params = encode_params(post_data) if post_data else None
             post_string = (urllib.urlencode(encoded_params)
@@ -173,8 +230,8 @@ class FacebookConnection(object):
                 start_statsd('facebook.%s' % statsd_path)
 
                 try:
-                    response_file = opener.open(
-                        url, post_string, timeout=extended_timeout)
+                    response_file = transport.open(
+                        url, post_string, timeout=timeout)
                     response = response_file.read().decode('utf8')
                 except (urllib2.HTTPError,), e:
                     response_file = e
@@ -194,10 +251,11 @@ class FacebookConnection(object):
                 # These are often temporary errors, so we will retry before
                 # failing
                 error_format = 'Facebook encountered a timeout (%ss) or error %s'
-                logger.warn(error_format, extended_timeout, unicode(e))
-                attempts -= 1
-                if not attempts:
+                logger.warn(error_format, timeout, unicode(e))
+                attempt += 1
+                if attempt > attempts or not retry_policy.should_retry(attempt):
                     # if we have no more attempts actually raise the error
+                    circuit_breaker.record_failure()
                     error_instance = facebook_exceptions.convert_unreachable_exception(
                         e)
                     error_msg = 'Facebook request failed after several retries, raising error %s'
@@ -207,7 +265,19 @@ class FacebookConnection(object):
                 if response_file:
                     response_file.close()
                 stop_statsd('facebook.%s' % statsd_path)
+            # back off before trying again
+            time.sleep(retry_policy.delay(attempt))
+
+        circuit_breaker.record_success()
+        parsed_response = cls.parse_response(response)
+        return parsed_response
 
+    @classmethod
+    def parse_response(cls, response):
+        '''
+        Parses the body of a Facebook response and raises the matching
+        exception if Facebook returned an error
+        '''
         # Faceboook response is either
         # Valid json
         # A string which is a querydict (a=b&c=d...etc)
@@ -241,7 +311,6 @@ class FacebookConnection(object):
         Facebook doesn't clearly distinquish between the two, so this is a bit
         of a hack
         '''
-        from open_facebook.utils import is_json
         server_error = False
         if hasattr(e, 'code') and e.code == 500:
             server_error = True
@@ -326,8 +395,7 @@ class FacebookConnection(object):
         # map error classes to facebook error codes
         # find the error code
         error_code = None
-        error_code_re = re.compile('\(#(\d+)\)')
-        matches = error_code_re.match(message)
+        matches = ERROR_CODE_RE.match(message)
         matching_groups = matches.groups() if matches else None
         if matching_groups:
             error_code = to_int(matching_groups[0]) or None
@@ -341,35 +409,27 @@ class FacebookConnection(object):
         exception_classes.sort(key=lambda e: e.range())
         return exception_classes
 
+    @classmethod
+    def get_error_code_index(cls):
+        '''
+        Returns the index used for matching error codes, it's built on
+        first usage
+        '''
+        index = FacebookConnection._error_code_index
+        if index is None:
+            index = facebook_exceptions.ErrorCodeIndex(
+                cls.get_sorted_exceptions())
+            FacebookConnection._error_code_index = index
+        return index
+
     @classmethod
     def match_error_code(cls, error_code):
         '''
         Return the right exception class for the error code
         '''
-        exception_classes = cls.get_sorted_exceptions()
-        error_class = None
-        for class_ in exception_classes:
-            codes_list = class_.codes_list()
-            # match the error class
-            matching_error_class = None
-            for code in codes_list:
-                if isinstance(code, tuple):
-                    start, stop = code
-                    if error_code and start <= error_code <= stop:
-                        matching_error_class = class_
-                        logger.info('Matched error on code %s', code)
-                elif isinstance(code, (int, long)):
-                    if int(code) == error_code:
-                        matching_error_class = class_
-                        logger.info('Matched error on code %s', code)
-                else:
-                    raise(
-                        ValueError, 'Dont know how to handle %s of '
-                        'type %s' % (code, type(code)))
-            # tell about the happy news if we found something
-            if matching_error_class:
-                error_class = matching_error_class
-                break
+        error_class = cls.get_error_code_index().match(error_code)
+        if error_class:
+            logger.info('Matched error on code %s', error_code)
         return error_class
 
 
@@ -451,7 +511,17 @@ class FacebookAuthorization(FacebookConnection):
         http://stackoverflow.com/questions/3302946/how-to-base64-url-decode-in-python
         and
         http://sunilarora.org/parsing-signedrequest-parameter-in-python-bas
+
+        Verified payloads are kept in a bounded LRU
+        (FACEBOOK_SIGNED_REQUEST_CACHE_SIZE), so the same signed request is
+        only decoded and verified once
         '''
+        cache_key = (hashlib.md5(secret).hexdigest(), signed_request)
+        data = signed_request_cache.get(cache_key)
+        if data is not None:
+            logger.debug('valid signed request found in cache')
+            return copy.deepcopy(data)
+
         from open_facebook.utils import base64_url_decode_php_style
         l = signed_request.split('.', 2)
         encoded_sig = l[0]
@@ -459,7 +529,6 @@ class FacebookAuthorization(FacebookConnection):
         from open_facebook.utils import json
         sig = base64_url_decode_php_style(encoded_sig)
         import hmac
-        import hashlib
         data = json.loads(base64_url_decode_php_style(payload))
 
         algo = data.get('algorithm').upper()
@@ -473,13 +542,14 @@ class FacebookAuthorization(FacebookConnection):
             expected_sig = hmac.new(secret, msg=payload,
                                     digestmod=hashlib.sha256).digest()
 
-        if sig != expected_sig:
+        if not constant_time_compare(sig, expected_sig):
             error_format = 'Signature %s didnt match the expected signature %s'
             error_message = error_format % (sig, expected_sig)
             send_warning(error_message)
             return None
         else:
             logger.debug('valid signed request received..')
+            signed_request_cache.set(cache_key, copy.deepcopy(data))
             return data
 
     @classmethod
@@ -706,7 +776,7 @@ class OpenFacebook(FacebookConnection):
 
         :returns:  dict
         '''
-        response = self.request(path, **kwargs)
+        response = self._cached_request(path, kwargs)
         return response
 
     def get_many(self, *ids, **kwargs):
@@ -725,7 +795,61 @@ class OpenFacebook(FacebookConnection):
         :returns:  dict
         '''
         kwargs['ids'] = ','.join(ids)
-        return self.request(**kwargs)
+        return self._cached_request('', kwargs, root=ALL_OBJECTS)
+
+    def iterate(self, path, page_size=PAGE_SIZE, prefetch=False, **params):
+        '''
+        Iterates over all the items of a paginated connection
+        The paging cursors are followed lazily, so only one page
+        (two with prefetch) is kept in memory at a time
+
+        **Example**::
+
+            for like in open_facebook.iterate('me/likes', page_size=100):
+                print like['name']
+
+        :param path:
+            The connection to iterate over, ie me/likes or me/friends
+
+        :param page_size:
+            The number of items to request per page
+
+        :param prefetch:
+            Fetch the next page in the background while the current
+            one is being consumed
+
+        :returns: generator of dicts
+        '''
+        params['limit'] = page_size
+        # the paging urls aren't cached, so neither is the first page
+        response = self.request(path, **params)
+        seen_urls = set()
+        while response:
+            data = response.get('data') or []
+            paging = response.get('paging') or {}
+            next_url = paging.get('next')
+            # facebook keeps returning a next url on the last page
+            if not data or next_url in seen_urls:
+                next_url = None
+
+            pending = None
+            if next_url and prefetch:
+                # not the async pool, iterating in one of its workers
+                # would wait for a page queued behind itself
+                pending = get_prefetch_pool().apply_async(
+                    self._request, (next_url,))
+
+            for item in data:
+                yield item
+
+            if not next_url:
+                break
+            seen_urls.add(next_url)
+            logger.info('requesting next page %s', next_url)
+            if pending is not None:
+                response = pending.get()
+            else:
+                response = self._request(next_url)
 
     def set(self, path, params=None, **post_data):
         '''
@@ -751,7 +875,11 @@ class OpenFacebook(FacebookConnection):
             params = {}
         params['method'] = 'post'
 
-        response = self.request(path, post_data=post_data, **params)
+        try:
+            response = self.request(path, post_data=post_data, **params)
+        finally:
+            # a failed write might still have changed something
+            self._invalidate_cache(path)
         return response
 
     def delete(self, path, *args, **kwargs):
@@ -768,7 +896,10 @@ class OpenFacebook(FacebookConnection):
         '''
 
         kwargs['method'] = 'delete'
-        self.request(path, *args, **kwargs)
+        try:
+            self.request(path, *args, **kwargs)
+        finally:
+            self._invalidate_cache(path)
 
     def fql(self, query, **kwargs):
         '''
@@ -789,7 +920,7 @@ class OpenFacebook(FacebookConnection):
         kwargs['q'] = query
         path = 'fql'
 
-        response = self.request(path, **kwargs)
+        response = self._cached_request(path, kwargs, root=ALL_OBJECTS)
 
         # return only the data for backward compatability
         return response['data']
@@ -822,6 +953,125 @@ class OpenFacebook(FacebookConnection):
 
         return named_results
 
+    def batch(self, operations, raise_errors=True):
+        '''
+        Sends multiple Graph API calls using the Facebook batch API
+        Operations are sent in batches of 50, so 120 calls only cost
+        3 round trips
+
+        **Example**::
+
+            me, permissions, friends, post = open_facebook.batch([
+                'me',
+                ('GET', 'me/permissions'),
+                dict(method='GET', relative_url='me/friends', name='friends'),
+                ('POST', 'me/feed', dict(message='testing open facebook')),
+            ])
+
+            # dependent operations, reference the result of a named one
+            open_facebook.batch([
+                dict(method='GET', relative_url='me/friends?limit=5',
+                     name='friends'),
+                ('GET', '?ids={result=friends:$.data.*.id}'),
+            ])
+
+        :param operations:
+            A list of operations, either a path (GET), a tuple of
+            (method, path) or (method, path, params) or a dict in the format
+            Facebook uses for batch operations
+
+        :param raise_errors:
+            When True the first error is raised, otherwise the exception
+            is returned in place of the result of the failing operation
+
+        :returns: list with one result per operation
+        '''
+        operations = [self._prepare_batch_operation(o) for o in operations]
+        results = []
+        for offset in range(0, len(operations), BATCH_LIMIT):
+            chunk = operations[offset:offset + BATCH_LIMIT]
+            self._validate_batch_dependencies(chunk)
+            post_data = dict(batch=json.dumps(chunk))
+            response = self.request(post_data=post_data)
+            if not isinstance(response, list) or len(response) != len(chunk):
+                raise facebook_exceptions.ParseException(
+                    'Unexpected batch response %r' % response)
+            for item in response:
+                try:
+                    result = self._parse_batch_item(item)
+                except facebook_exceptions.OpenFacebookException, e:
+                    if raise_errors:
+                        raise
+                    result = e
+                results.append(result)
+        return results
+
+    def _prepare_batch_operation(self, operation):
+        '''
+        Turns the different ways of specifying a batch operation into the
+        dict format used by Facebook
+        '''
+        if isinstance(operation, dict):
+            operation = operation.copy()
+            if isinstance(operation.get('body'), dict):
+                operation['body'] = urllib.urlencode(
+                    encode_params(operation['body']))
+            return operation
+        if isinstance(operation, basestring):
+            operation = ('GET', operation)
+        method, path = operation[:2]
+        params = operation[2] if len(operation) > 2 else None
+        method = method.upper()
+        prepared = dict(method=method, relative_url=path)
+        if params:
+            # change fb__explicitly_shared to fb:explicitly_shared
+            params = dict((k.replace('__', ':'), v)
+                          for k, v in params.items())
+            encoded_params = urllib.urlencode(encode_params(params))
+            if method == 'POST':
+                prepared['body'] = encoded_params
+            else:
+                separator = '&' if '?' in path else '?'
+                prepared['relative_url'] = path + separator + encoded_params
+        return prepared
+
+    def _validate_batch_dependencies(self, operations):
+        '''
+        Dependencies between operations only work within one batch request
+        '''
+        names = set()
+        for operation in operations:
+            references = BATCH_REFERENCE_RE.findall(
+                operation.get('relative_url', '') + operation.get('body', ''))
+            if operation.get('depends_on'):
+                references.append(operation['depends_on'])
+            missing = [r for r in references if r not in names]
+            if missing:
+                raise ValueError(
+                    'Batch operation %s depends on %s, which should be in the '
+                    'same batch of %s operations and defined before it' % (
+                        operation, missing, BATCH_LIMIT))
+            if operation.get('name'):
+                names.add(operation['name'])
+
+    def _parse_batch_item(self, item):
+        '''
+        Parses the response for a single operation in the batch
+        Results can be None when Facebook omits the response
+        '''
+        if item is None:
+            return None
+        body = item.get('body')
+        code = item.get('code')
+        if code and code >= 500:
+            if not body or not is_json(body):
+                raise facebook_exceptions.FacebookUnreachable(
+                    'Facebook is down, batch operation failed with code %s' % code)
+        if body is None:
+            return None
+        parsed_item = self.parse_response(body)
+        return parsed_item
+
     def me(self):
         '''
         Cached method of requesting information about me
@@ -851,6 +1101,42 @@ class OpenFacebook(FacebookConnection):
                                  if v == '1' or v == 1])
         return permissions_dict
 
+    def cached_permissions(self):
+        '''
+        Same as permissions, but cached per access token for
+        FACEBOOK_PERMISSIONS_CACHE_TIMEOUT seconds.
+        The cache is cleared when a request raises an OAuthException
+
+        :returns: dict
+        '''
+        from django.core.cache import cache
+        timeout = facebook_settings.FACEBOOK_PERMISSIONS_CACHE_TIMEOUT
+        if not timeout or not self.access_token:
+            return self.permissions()
+
+        key = self._permissions_cache_key()
+        permissions_dict = cache.get(key)
+        if permissions_dict is None:
+            permissions_dict = self.permissions()
+            # an empty dict usually means the token is invalid
+            if permissions_dict:
+                cache.set(key, permissions_dict, timeout)
+        return permissions_dict
+
+    def invalidate_permissions(self):
+        '''
+        Clears the cached permissions for this access token, including
+        the me/permissions response in the response cache
+        '''
+        from django.core.cache import cache
+        if self.access_token:
+            cache.delete(self._permissions_cache_key())
+            self._invalidate_cache('me')
+
+    def _permissions_cache_key(self):
+        token_hash = hashlib.md5(self.access_token).hexdigest()
+        return 'open_facebook:permissions:%s' % token_hash
+
     def has_permissions(self, required_permissions):
         '''
         Validate if all the required_permissions are currently given
@@ -865,7 +1151,7 @@ class OpenFacebook(FacebookConnection):
 
         :returns: bool
         '''
-        permissions_dict = self.permissions()
+        permissions_dict = self.cached_permissions()
         # see if we have all permissions
         has_permissions = True
         for permission in required_permissions:
@@ -890,16 +1176,131 @@ class OpenFacebook(FacebookConnection):
         url = '%sme/picture?%s' % (self.api_url, query_dict.urlencode())
         return url
 
+    def _cached_request(self, path, params, root=None):
+        '''
+        Sends a read request, using the response cache if it's enabled
+        '''
+        response_cache = get_response_cache()
+        if response_cache is None:
+            return self.request(path, **params)
+
+        def fetch():
+            return self.request(path, **dict(params))
+        response = response_cache.get_or_fetch(
+            self.access_token, path, params, fetch, root=root)
+        return response
+
+    def _invalidate_cache(self, path):
+        response_cache = get_response_cache()
+        if response_cache is not None:
+            response_cache.invalidate(self.access_token, unicode(path))
+
     def request(self, path='', post_data=None, old_api=False, **params):
         api_base_url = self.old_api_url if old_api else self.api_url
         if getattr(self, 'access_token', None):
             params['access_token'] = self.access_token
         url = '%s%s?%s' % (api_base_url, path, urllib.urlencode(params))
         logger.info('requesting url %s', url)
-        response = self._request(url, post_data)
+        try:
+            response = self._request(url, post_data)
+        except facebook_exceptions.OAuthException:
+            # the token or its permissions changed
+            self.invalidate_permissions()
+            raise
         return response
 
 
+class AsyncOpenFacebook(object):
+
+    '''
+    Non blocking version of OpenFacebook
+
+    The requests are executed by a shared pool of worker threads
+    (FACEBOOK_ASYNC_POOL_SIZE) and return a result object straight away.
+    Parsing and error mapping are done by a regular OpenFacebook instance,
+    so calling .get() on the result raises the same exceptions.
+
+    **Example**::
+
+        graph = AsyncOpenFacebook(access_token)
+        pending = [graph.get(facebook_id) for facebook_id in facebook_ids]
+        profiles = graph.gather(pending, timeout=30)
+
+    '''
+
+    def __init__(self, access_token=None, *args, **kwargs):
+        self.graph = OpenFacebook(access_token, *args, **kwargs)
+
+    @property
+    def access_token(self):
+        return self.graph.access_token
+
+    def get(self, path, **kwargs):
+        return self._apply(self.graph.get, path, **kwargs)
+
+    def get_many(self, *ids, **kwargs):
+        return self._apply(self.graph.get_many, *ids, **kwargs)
+
+    def set(self, path, params=None, **post_data):
+        return self._apply(self.graph.set, path, params, **post_data)
+
+    def delete(self, path, *args, **kwargs):
+        return self._apply(self.graph.delete, path, *args, **kwargs)
+
+    def fql(self, query, **kwargs):
+        return self._apply(self.graph.fql, query, **kwargs)
+
+    def batch_fql(self, queries_dict):
+        return self._apply(self.graph.batch_fql, queries_dict)
+
+    def _apply(self, method, *args, **kwargs):
+        pool = get_async_pool()
+        result = pool.apply_async(method, args, kwargs)
+        return result
+
+    @classmethod
+    def gather(cls, results, timeout=None):
+        '''
+        Waits for all the given results and returns their values
+        Raises the first error encountered
+        '''
+        values = [r.get(timeout) for r in results]
+        return values
+
+
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def _get_thread_pool(name):
+    '''
+    Returns the named pool of threads, it's only started when it's needed
+    '''
+    pool = _thread_pools.get(name)
+    if pool is None:
+        with _thread_pools_lock:
+            pool = _thread_pools.get(name)
+            if pool is None:
+                from multiprocessing.pool import ThreadPool
+                pool = _thread_pools[name] = ThreadPool(
+                    facebook_settings.FACEBOOK_ASYNC_POOL_SIZE)
+    return pool
+
+
+def get_async_pool():
+    '''
+    Returns the pool of threads used by AsyncOpenFacebook
+    '''
+    return _get_thread_pool('async')
+
+
+def get_prefetch_pool():
+    '''
+    Returns the pool of threads which fetch the next page for iterate
+    '''
+    return _get_thread_pool('prefetch')
+
+
 class TestUser(object):
 
     '''
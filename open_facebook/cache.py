@@ -0,0 +1,246 @@
+'''
+Opt-in response cache for read requests to Facebook
+
+Responses are stored in a small in-process LRU in front of the Django
+cache backend. Entries are keyed by access token, path and params and
+expire after a per endpoint timeout (FACEBOOK_RESPONSE_CACHE_TIMEOUTS).
+
+Writes invalidate the cached reads for the object they touch. Every
+(token, object) pair has a version stored in the Django cache, which is
+part of the cache key. Calling set or delete on 'me/feed' changes the
+version of 'me', so 'me' and 'me/permissions' are fetched again.
+FQL and get_many responses depend on a version shared by all objects.
+
+**Example**::
+
+    FACEBOOK_RESPONSE_CACHE = True
+    FACEBOOK_RESPONSE_CACHE_TIMEOUTS = {'me/permissions': 60, '*': 300}
+'''
+from django_facebook import settings as facebook_settings
+import copy
+import hashlib
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# the version which fql and get_many requests depend on
+ALL_OBJECTS = '*'
+
+# versions outlive the entries, 30 days is the longest memcached accepts
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+class LRUCache(object):
+
+    '''
+    Thread safe in-process cache, holding at most maxsize items
+    The least recently used items are evicted first
+
+    Python 2.6 has no OrderedDict, so the recency order is kept in a
+    circular doubly linked list of [previous, next, key, value, expires]
+    '''
+    PREVIOUS, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._map = {}
+            root = []
+            root[:] = [root, root, None, None, None]
+            self._root = root
+
+    def __len__(self):
+        return len(self._map)
+
+    def _unlink(self, link):
+        previous, next = link[self.PREVIOUS], link[self.NEXT]
+        previous[self.NEXT] = next
+        next[self.PREVIOUS] = previous
+
+    def _append(self, link):
+        root = self._root
+        last = root[self.PREVIOUS]
+        link[self.PREVIOUS] = last
+        link[self.NEXT] = root
+        last[self.NEXT] = root[self.PREVIOUS] = link
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            expires = link[self.EXPIRES]
+            if expires is not None and expires < time.time():
+                self._unlink(link)
+                del self._map[key]
+                return default
+            # mark as most recently used
+            self._unlink(link)
+            self._append(link)
+            return link[self.VALUE]
+
+    def set(self, key, value, timeout=None):
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+        with self._lock:
+            link = self._map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+            link = [None, None, key, value, expires]
+            self._append(link)
+            self._map[key] = link
+            while len(self._map) > self.maxsize:
+                oldest = self._root[self.NEXT]
+                self._unlink(oldest)
+                del self._map[oldest[self.KEY]]
+
+    def delete(self, key):
+        with self._lock:
+            link = self._map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+
+
+class ResponseCache(object):
+
+    '''
+    Two tier cache for Facebook responses
+
+    :param timeouts:
+        dict mapping endpoints to the number of seconds responses are
+        cached, see get_timeout
+    :param local_size:
+        the number of responses kept in the in-process LRU
+    '''
+    prefix = 'open_facebook:response'
+
+    def __init__(self, timeouts=None, local_size=1000):
+        self.timeouts = timeouts or {}
+        self.local = LRUCache(local_size)
+
+    @property
+    def cache(self):
+        from django.core.cache import cache
+        return cache
+
+    def get_timeout(self, path):
+        '''
+        The timeout for a path is looked up using
+        - the full path, ie me/permissions
+        - the connection, ie permissions for 1234/permissions
+        - the object, ie me
+        - the default, *
+
+        A timeout of 0 disables caching for the endpoint
+        '''
+        parts = path.strip('/').split('/')
+        candidates = ['/'.join(parts), parts[-1], parts[0], ALL_OBJECTS]
+        for candidate in candidates:
+            if candidate in self.timeouts:
+                return self.timeouts[candidate]
+        return 0
+
+    def get_root(self, path):
+        '''
+        The object a path belongs to, me/feed belongs to me
+        '''
+        return path.strip('/').split('/')[0] or ALL_OBJECTS
+
+    def token_hash(self, access_token):
+        return hashlib.md5(access_token or '').hexdigest()
+
+    def version_key(self, access_token, root):
+        key = '%s:version:%s:%s' % (
+            self.prefix, self.token_hash(access_token),
+            hashlib.md5(root).hexdigest())
+        return key
+
+    def get_version(self, access_token, root):
+        '''
+        Returns the current version of the object, creating a new
+        version when needed
+        '''
+        key = self.version_key(access_token, root)
+        version = self.cache.get(key)
+        if version is None:
+            # an expired version must never match old entries, so we
+            # always start with a random version
+            self.cache.add(key, uuid.uuid4().hex, self.version_timeout)
+            version = self.cache.get(key)
+        return version
+
+    @property
+    def version_timeout(self):
+        # None means the default timeout on Django < 1.6, not forever
+        timeout = max(self.timeouts.values() or [0]) * 2
+        return max(timeout, VERSION_TIMEOUT)
+
+    def make_key(self, access_token, path, params, version):
+        params = sorted((params or {}).items())
+        raw = repr((path.strip('/'), params, version))
+        key = '%s:%s:%s' % (self.prefix, self.token_hash(access_token),
+                            hashlib.md5(raw).hexdigest())
+        return key
+
+    def get_or_fetch(self, access_token, path, params, fetch, root=None):
+        '''
+        Returns the cached response or calls fetch and caches its result
+        '''
+        timeout = self.get_timeout(path)
+        if not timeout:
+            return fetch()
+        if root is None:
+            root = self.get_root(path)
+        version = self.get_version(access_token, root)
+        key = self.make_key(access_token, path, params, version)
+
+        response = self.local.get(key)
+        if response is None:
+            response = self.cache.get(key)
+            if response is not None:
+                self.local.set(key, response, timeout)
+        if response is not None:
+            logger.debug('response cache hit for %s', path)
+            # callers are free to modify their response
+            return copy.deepcopy(response)
+
+        response = fetch()
+        if response is not None:
+            self.cache.set(key, response, timeout)
+            self.local.set(key, copy.deepcopy(response), timeout)
+        return response
+
+    def invalidate(self, access_token, path):
+        '''
+        Drops the cached responses for the object the path belongs to
+        '''
+        root = self.get_root(path)
+        keys = [self.version_key(access_token, root)]
+        if root != ALL_OBJECTS:
+            keys.append(self.version_key(access_token, ALL_OBJECTS))
+        versions = dict((k, uuid.uuid4().hex) for k in keys)
+        self.cache.set_many(versions, self.version_timeout)
+        logger.debug('invalidated response cache for %s', root)
+
+
+response_cache = ResponseCache(
+    timeouts=facebook_settings.FACEBOOK_RESPONSE_CACHE_TIMEOUTS,
+    local_size=facebook_settings.FACEBOOK_RESPONSE_CACHE_LOCAL_SIZE,
+)
+
+
+def get_response_cache():
+    '''
+    Returns the response cache if it's enabled using
+    FACEBOOK_RESPONSE_CACHE
+    '''
+    if facebook_settings.FACEBOOK_RESPONSE_CACHE:
+        return response_cache
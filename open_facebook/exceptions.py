@@ -3,6 +3,7 @@
 Facebook error classes also see
 http://fbdevwiki.com/wiki/Error_codes#User_Permission_Errors
 '''
+import bisect
 import ssl
 import urllib2
 
@@ -137,6 +138,15 @@ class FacebookSSLError(FacebookUnreachable, ssl.SSLError):
     pass
 
 
+class FacebookCircuitOpen(FacebookUnreachable):
+
+    '''
+    Raised without contacting Facebook, because the last requests
+    all failed. See open_facebook.resilience
+    '''
+    pass
+
+
 class FacebookHTTPError(FacebookUnreachable, urllib2.HTTPError):
     pass
 
@@ -179,3 +189,62 @@ def get_exception_classes():
                          e, 'codes', None) and issubclass(
                          e, OpenFacebookException)]
     return exception_classes
+
+
+class ErrorCodeIndex(object):
+
+    '''
+    Maps Facebook error codes to the most specific exception class
+
+    The codes of all classes are split into non overlapping segments when
+    the index is built, so a lookup is a binary search over the segments.
+    Classes should be given in order of preference, the first class
+    matching a code wins (see FacebookConnection.get_sorted_exceptions)
+
+    **Example**::
+
+        index = ErrorCodeIndex(FacebookConnection.get_sorted_exceptions())
+        index.match(341)  # FeedActionLimit
+    '''
+
+    def __init__(self, exception_classes):
+        intervals = []
+        for class_ in exception_classes:
+            for code in class_.codes_list():
+                if isinstance(code, tuple):
+                    start, stop = code
+                elif isinstance(code, (int, long)):
+                    start = stop = int(code)
+                else:
+                    raise ValueError('Dont know how to handle %s of '
+                                     'type %s' % (code, type(code)))
+                intervals.append((start, stop, class_))
+
+        # the segments are delimited by the start and end of every interval
+        boundaries = set()
+        for start, stop, class_ in intervals:
+            boundaries.add(start)
+            boundaries.add(stop + 1)
+        boundaries = sorted(boundaries)
+
+        self.starts = []
+        self.stops = []
+        self.classes = []
+        for start, next_start in zip(boundaries, boundaries[1:]):
+            stop = next_start - 1
+            for interval_start, interval_stop, class_ in intervals:
+                if interval_start <= start and stop <= interval_stop:
+                    self.starts.append(start)
+                    self.stops.append(stop)
+                    self.classes.append(class_)
+                    break
+
+    def match(self, error_code):
+        '''
+        Returns the exception class for the error code or None
+        '''
+        if not isinstance(error_code, (int, long)):
+            return None
+        position = bisect.bisect_right(self.starts, error_code) - 1
+        if position >= 0 and error_code <= self.stops[position]:
+            return self.classes[position]
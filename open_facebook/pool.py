@@ -0,0 +1,250 @@
+'''
+Keep-alive connection pool for talking to Facebook
+
+urllib2 opens a new connection (and does a new SSL handshake) for every
+request. The pool in this module keeps connections to graph.facebook.com
+open and hands them out again for subsequent requests.
+
+**Example**::
+
+    from open_facebook.pool import build_opener, connection_pool
+    opener = build_opener()
+    response = opener.open('https://graph.facebook.com/fashiolista')
+
+    # see how well the pool is doing
+    connection_pool.stats()
+'''
+from django_facebook import settings as facebook_settings
+from StringIO import StringIO
+import httplib
+import logging
+import socket
+import threading
+import time
+import urllib
+import urllib2
+
+logger = logging.getLogger(__name__)
+
+# requests which are retried when a pooled connection went stale
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class ConnectionPool(object):
+
+    '''
+    Thread safe pool of idle HTTP(S) connections, grouped by host
+
+    :param max_idle:
+        The maximum number of idle connections we keep open per host.
+        Connections beyond this number are closed after usage. It
+        doesn't limit the connections which are in use
+    :param idle_timeout:
+        Connections which have been idle for longer than this number of
+        seconds are closed instead of reused
+    '''
+
+    def __init__(self, max_idle=10, idle_timeout=30):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # maps (secure, host) to a list of (connection, last_used) tuples
+        self._idle = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.discards = 0
+
+    def stats(self):
+        '''
+        Returns the hit and miss counts for this pool
+
+        :returns: dict
+        '''
+        with self._lock:
+            idle = sum([len(c) for c in self._idle.values()])
+            stats = dict(hits=self.hits, misses=self.misses,
+                         evictions=self.evictions, discards=self.discards,
+                         idle=idle)
+        return stats
+
+    def get_connection(self, secure, host, timeout):
+        '''
+        Returns a tuple with a connection for the given host and a boolean
+        indicating if the connection was reused
+        '''
+        key = (secure, host)
+        connection = None
+        now = time.time()
+        with self._lock:
+            idle_connections = self._idle.get(key, [])
+            while idle_connections:
+                # the most recently used connection is the most likely
+                # to still be alive
+                candidate, last_used = idle_connections.pop()
+                if now - last_used > self.idle_timeout:
+                    self.evictions += 1
+                    candidate.close()
+                    continue
+                connection = candidate
+                break
+            if connection is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if connection is None:
+            connection = self.new_connection(secure, host, timeout)
+            reused = False
+        else:
+            self.set_timeout(connection, timeout)
+            reused = True
+        return connection, reused
+
+    def new_connection(self, secure, host, timeout):
+        connection_class = httplib.HTTPConnection
+        if secure:
+            connection_class = httplib.HTTPSConnection
+        connection = connection_class(host, timeout=timeout)
+        return connection
+
+    def set_timeout(self, connection, timeout):
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        connection.timeout = timeout
+        if connection.sock:
+            connection.sock.settimeout(timeout)
+
+    def release_connection(self, secure, host, connection):
+        '''
+        Return the connection to the pool so it can be reused
+        '''
+        key = (secure, host)
+        with self._lock:
+            idle_connections = self._idle.setdefault(key, [])
+            if len(idle_connections) < self.max_idle:
+                idle_connections.append((connection, time.time()))
+                connection = None
+            else:
+                self.discards += 1
+        # too many idle connections for this host, close this one
+        if connection is not None:
+            connection.close()
+
+    def prune(self):
+        '''
+        Closes all the connections which have been idle for too long
+        '''
+        now = time.time()
+        with self._lock:
+            for key, idle_connections in self._idle.items():
+                fresh = []
+                for connection, last_used in idle_connections:
+                    if now - last_used > self.idle_timeout:
+                        self.evictions += 1
+                        connection.close()
+                    else:
+                        fresh.append((connection, last_used))
+                self._idle[key] = fresh
+
+    def clear(self):
+        '''
+        Closes all idle connections
+        '''
+        with self._lock:
+            for idle_connections in self._idle.values():
+                for connection, last_used in idle_connections:
+                    connection.close()
+            self._idle = {}
+
+    def urlopen(self, request, secure):
+        '''
+        Sends the urllib2 request over a pooled connection and returns
+        a urllib2 compatible response object
+        '''
+        host = request.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(request.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in request.headers.items()
+                            if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        connection, reused = self.get_connection(
+            secure, host, request.timeout)
+        try:
+            response = self._send(connection, request, headers)
+        except (socket.error, httplib.HTTPException), e:
+            connection.close()
+            # the request might have reached Facebook, so only retry
+            # requests which are safe to send twice
+            if not reused or request.get_method() not in IDEMPOTENT_METHODS:
+                raise urllib2.URLError(e)
+            # Facebook closed the idle connection on their end, this is
+            # expected so we retry once on a brand new connection
+            logger.info('pooled connection to %s went stale, reconnecting',
+                        host)
+            connection = self.new_connection(secure, host, request.timeout)
+            try:
+                response = self._send(connection, request, headers)
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                raise urllib2.URLError(e)
+
+        # we read the full body so the connection is ready for the next
+        # request
+        http_response, body = response
+        if http_response.will_close:
+            connection.close()
+        else:
+            self.release_connection(secure, host, connection)
+
+        response_file = urllib.addinfourl(
+            StringIO(body), http_response.msg, request.get_full_url())
+        response_file.code = http_response.status
+        response_file.msg = http_response.reason
+        return response_file
+
+    def _send(self, connection, request, headers):
+        connection.request(request.get_method(), request.get_selector(),
+                           request.data, headers)
+        http_response = connection.getresponse()
+        body = http_response.read()
+        return http_response, body
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+
+    '''
+    urllib2 handler which sends http and https requests using the
+    connection pool
+    '''
+
+    def __init__(self, pool):
+        urllib2.AbstractHTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, request):
+        return self.pool.urlopen(request, secure=False)
+
+    def https_open(self, request):
+        return self.pool.urlopen(request, secure=True)
+
+
+# the pool is shared by the entire process
+connection_pool = ConnectionPool(
+    max_idle=facebook_settings.FACEBOOK_CONNECTION_POOL_MAX_IDLE,
+    idle_timeout=facebook_settings.FACEBOOK_CONNECTION_POOL_IDLE_TIMEOUT,
+)
+
+
+def build_opener(*handlers):
+    '''
+    Returns a urllib2 opener which reuses connections from the shared
+    connection pool
+    '''
+    keep_alive_handler = KeepAliveHandler(connection_pool)
+    opener = urllib2.build_opener(keep_alive_handler, *handlers)
+    return opener
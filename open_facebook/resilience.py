@@ -0,0 +1,191 @@
+'''
+Retry policy and circuit breaker for requests to Facebook
+
+When Facebook is down every request would otherwise wait for several
+timeouts before failing, quickly exhausting the web workers.
+The retry policy spaces out the retries (exponential backoff with jitter)
+and limits the share of requests which may be retried.
+The circuit breaker stops sending requests after a number of consecutive
+failures and lets a single probe through every reset_timeout seconds to
+see if Facebook recovered.
+
+**Example**::
+
+    from open_facebook.resilience import circuit_breaker
+    if circuit_breaker.is_open():
+        # don't even bother asking Facebook
+        ...
+'''
+from django_facebook import settings as facebook_settings
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RetryPolicy(object):
+
+    '''
+    Decides if and when a failed request should be retried
+
+    :param attempts:
+        The maximum number of attempts per request
+    :param base_delay:
+        The delay before the first retry, doubled for every next retry
+    :param max_delay:
+        The upper bound for the delay between retries
+    :param budget_ratio:
+        Retries are only allowed as long as they stay below this fraction
+        of the requests in the current budget window
+    :param budget_minimum:
+        The number of retries per window which is always allowed
+    :param budget_window:
+        The length of the budget window in seconds
+    '''
+
+    def __init__(self, attempts=3, base_delay=0.5, max_delay=5,
+                 budget_ratio=0.2, budget_minimum=10, budget_window=10):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_minimum = budget_minimum
+        self.budget_window = budget_window
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._requests = 0
+        self._retries = 0
+
+    def delay(self, attempt):
+        '''
+        Returns the number of seconds to wait before the given attempt
+        Uses full jitter so that many workers don't retry in lockstep
+        '''
+        ceiling = self.base_delay * (2 ** max(attempt - 2, 0))
+        ceiling = min(self.max_delay, ceiling)
+        return random.uniform(0, ceiling)
+
+    def _roll_window(self, now):
+        if now - self._window_start > self.budget_window:
+            self._window_start = now
+            self._requests = 0
+            self._retries = 0
+
+    def record_request(self):
+        with self._lock:
+            self._roll_window(time.time())
+            self._requests += 1
+
+    def should_retry(self, attempt):
+        '''
+        Returns True if we are allowed to make the given attempt
+        A granted retry is subtracted from the budget
+        '''
+        if attempt > self.attempts:
+            return False
+        with self._lock:
+            self._roll_window(time.time())
+            allowed = self.budget_minimum + \
+                self.budget_ratio * self._requests
+            if self._retries >= allowed:
+                logger.warn('retry budget exhausted, not retrying')
+                return False
+            self._retries += 1
+        return True
+
+
+class CircuitBreaker(object):
+
+    '''
+    Thread safe circuit breaker, shared by all requests in this process
+
+    closed
+        requests are sent as normal
+    open
+        failure_threshold requests in a row failed, all requests fail
+        fast with FacebookCircuitOpen
+    half_open
+        reset_timeout seconds passed since the circuit opened, one probe
+        request is let through. If it succeeds the circuit closes,
+        otherwise it opens again
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.time() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def is_open(self):
+        '''
+        Returns True when requests to Facebook currently fail fast
+        '''
+        return self.state == self.OPEN
+
+    def allow_request(self):
+        '''
+        Returns True if a request may be sent
+        In the half open state only one probe is allowed per reset_timeout
+        '''
+        if not self.failure_threshold:
+            return True
+        with self._lock:
+            state = self.state
+            if state == self.HALF_OPEN:
+                # restart the timer, so the next probe waits for the
+                # outcome of this one (or for the reset timeout)
+                self._opened_at = time.time()
+                logger.info('circuit half open, sending a probe request')
+                return True
+            return state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info('facebook recovered, closing the circuit')
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            probe_failed = self._opened_at is not None
+            if probe_failed or self._failures >= self.failure_threshold:
+                if not probe_failed:
+                    logger.warn(
+                        'facebook failed %s times in a row, opening the '
+                        'circuit for %ss', self._failures, self.reset_timeout)
+                self._opened_at = time.time()
+
+    def reset(self):
+        self.record_success()
+
+    def stats(self):
+        return dict(state=self.state, failures=self._failures)
+
+
+retry_policy = RetryPolicy(
+    attempts=facebook_settings.FACEBOOK_RETRY_ATTEMPTS,
+    base_delay=facebook_settings.FACEBOOK_RETRY_BASE_DELAY,
+    max_delay=facebook_settings.FACEBOOK_RETRY_MAX_DELAY,
+    budget_ratio=facebook_settings.FACEBOOK_RETRY_BUDGET_RATIO,
+)
+
+circuit_breaker = CircuitBreaker(
+    failure_threshold=facebook_settings.FACEBOOK_CIRCUIT_BREAKER_THRESHOLD,
+    reset_timeout=facebook_settings.FACEBOOK_CIRCUIT_BREAKER_RESET_TIMEOUT,
+)
@@ -68,6 +68,38 @@ class OpenFacebookTest(unittest.TestCase):
             raise ValueError('print statement found, output %s' % content)
 
 
+class OfflineTest(unittest.TestCase):
+
+    '''
+    Tests which run against a fake graph server instead of Facebook
+    The shared circuit breaker, caches and connection pool are reset, so
+    tests don't depend on each other
+    '''
+
+    def setUp(self):
+        from django_facebook.test_utils.fake_graph import FakeGraphServer
+        self.reset()
+        self.server = FakeGraphServer().start()
+        self.original_api_url = FacebookConnection.api_url
+        FacebookConnection.api_url = self.server.url
+
+    def tearDown(self):
+        FacebookConnection.api_url = self.original_api_url
+        FacebookConnection.transport = None
+        self.server.stop()
+        self.reset()
+
+    def reset(self):
+        from django.core.cache import cache
+        from open_facebook.cache import response_cache
+        from open_facebook.pool import connection_pool
+        from open_facebook.resilience import circuit_breaker
+        circuit_breaker.reset()
+        cache.clear()
+        response_cache.local.clear()
+        connection_pool.clear()
+
+
 class TestErrorMapping(OpenFacebookTest):
 
     def test_syntax_error(self):
@@ -150,6 +182,28 @@ class TestErrorMapping(OpenFacebookTest):
         self.assertRaises(OpenGraphException, test)
 
 
+class ErrorCodeIndexTest(unittest.TestCase):
+
+    def test_error_code_index(self):
+        def linear_match(error_code):
+            for class_ in FacebookConnection.get_sorted_exceptions():
+                for code in class_.codes_list():
+                    if isinstance(code, tuple):
+                        if error_code and code[0] <= error_code <= code[1]:
+                            return class_
+                    elif code == error_code:
+                        return class_
+
+        for error_code in range(-1, 4000) + [None, '200']:
+            self.assertEqual(FacebookConnection.match_error_code(error_code),
+                             linear_match(error_code))
+        match = FacebookConnection.match_error_code
+        self.assertEqual(match(341), facebook_exceptions.FeedActionLimit)
+        self.assertEqual(match(3), facebook_exceptions.PermissionException)
+        self.assertEqual(match(150), facebook_exceptions.ParameterException)
+        self.assertEqual(match(10000), None)
+
+
 class Test500Detection(OpenFacebookTest):
 
     def test_application_error(self):
@@ -318,3 +372,461 @@ class TestOpenFacebook(OpenFacebookTest):
         facebook = self.guy.graph()
         assert 'name' in facebook.me()
         assert facebook.get('fashiolista')
+
+
+class ConnectionPoolTest(OfflineTest):
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.server.add_response('me', dict(id='123', name='Thierry'))
+
+    def test_reuse(self):
+        from open_facebook.pool import ConnectionPool, KeepAliveHandler
+        import urllib2
+        pool = ConnectionPool(max_idle=2)
+        opener = urllib2.build_opener(KeepAliveHandler(pool))
+        with mock.patch('open_facebook.pool.build_opener') as patched:
+            patched.return_value = opener
+            graph = OpenFacebook('token')
+            for x in range(3):
+                self.assertEqual(graph.get('me')['name'], 'Thierry')
+        stats = pool.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(self.server.connection_count, 1)
+        self.assertEqual(self.server.request_count, 3)
+
+    def test_stale_retry(self):
+        from open_facebook.pool import ConnectionPool
+        import socket
+        import urllib2
+        pool = ConnectionPool(max_idle=2)
+        url = '%sme' % self.server.url
+        host = urllib2.Request(url).get_host()
+        for data in [None, 'message=hi']:
+            stale = mock.Mock()
+            stale.request.side_effect = socket.error('connection reset')
+            pool.release_connection(False, host, stale)
+            request = urllib2.Request(url, data)
+            request.timeout = 10
+            if data is None:
+                response = pool.urlopen(request, secure=False)
+                self.assertEqual(json.loads(response.read())['id'], '123')
+            else:
+                # a POST might have been received, so it isn't retried
+                self.assertRaises(urllib2.URLError, pool.urlopen, request,
+                                  secure=False)
+        self.assertEqual(self.server.request_count, 1)
+
+    def test_idle_eviction(self):
+        from open_facebook.pool import ConnectionPool, KeepAliveHandler
+        import urllib2
+        pool = ConnectionPool(max_idle=2, idle_timeout=-1)
+        opener = urllib2.build_opener(KeepAliveHandler(pool))
+        for x in range(2):
+            opener.open('%sme' % self.server.url).read()
+        stats = pool.stats()
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 1)
+
+
+class BatchTest(OfflineTest):
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.batches = []
+
+        def batch_response(handler):
+            from urlparse import parse_qs
+            operations = json.loads(parse_qs(handler.body)['batch'][0])
+            self.batches.append(operations)
+            responses = []
+            for operation in operations:
+                if operation['relative_url'] == 'me/feed':
+                    body = dict(error=dict(
+                        type='OAuthException', code=200,
+                        message='(#200) Requires publish_actions'))
+                    responses.append(dict(code=403, body=json.dumps(body)))
+                else:
+                    body = dict(path=operation['relative_url'])
+                    responses.append(dict(code=200, body=json.dumps(body)))
+            return responses
+        self.server.add_response('', batch_response)
+
+    def test_batch(self):
+        graph = OpenFacebook('token')
+        paths = ['me/friends/%s' % x for x in range(60)]
+        results = graph.batch(['me', ('GET', 'me/permissions')] + paths)
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual(len(results), 62)
+        self.assertEqual(results[0]['path'], 'me')
+        self.assertEqual(results[1]['path'], 'me/permissions')
+        self.assertEqual(results[-1]['path'], 'me/friends/59')
+
+    def test_batch_errors(self):
+        graph = OpenFacebook('token')
+        operations = ['me', ('POST', 'me/feed', dict(message='hi'))]
+        self.assertRaises(facebook_exceptions.PermissionException,
+                          graph.batch, operations)
+        me, post = graph.batch(operations, raise_errors=False)
+        self.assertEqual(me['path'], 'me')
+        self.assertTrue(
+            isinstance(post, facebook_exceptions.PermissionException))
+        self.assertEqual(self.batches[-1][1]['body'], 'message=hi')
+
+    def test_batch_dependencies(self):
+        graph = OpenFacebook('token')
+        operations = [('GET', '?ids={result=friends:$.data.*.id}')]
+        self.assertRaises(ValueError, graph.batch, operations)
+
+
+class AsyncOpenFacebookTest(OfflineTest):
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        import time
+
+        def slow_response(handler):
+            time.sleep(0.2)
+            return dict(id='123', name='Thierry')
+        self.server.add_response('me', slow_response)
+
+    def test_concurrent_get(self):
+        import time
+        graph = AsyncOpenFacebook('token')
+        start = time.time()
+        pending = [graph.get('me') for x in range(5)]
+        results = graph.gather(pending, timeout=10)
+        duration = time.time() - start
+        self.assertEqual([r['name'] for r in results], ['Thierry'] * 5)
+        # sequentially this would take a second
+        self.assertTrue(duration < 0.8)
+
+    def test_errors(self):
+        from open_facebook import exceptions as open_facebook_exceptions
+        graph = AsyncOpenFacebook('token')
+        result = graph.get('unknown')
+        self.assertRaises(open_facebook_exceptions.OpenFacebookException,
+                          result.get, 10)
+
+
+class IterateTest(OfflineTest):
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+
+        def likes_response(handler):
+            from urlparse import urlparse, parse_qs
+            query = parse_qs(urlparse(handler.path).query)
+            limit = int(query['limit'][0])
+            offset = int(query.get('offset', ['0'])[0])
+            data = [dict(id=str(x)) for x in range(offset, min(offset + limit, 25))]
+            next_url = '%sme/likes?limit=%s&offset=%s' % (
+                self.server.url, limit, offset + limit)
+            return dict(data=data, paging=dict(next=next_url))
+        self.server.add_response('me/likes', likes_response)
+
+    def test_iterate(self):
+        graph = OpenFacebook('token')
+        likes = graph.iterate('me/likes', page_size=10)
+        self.assertEqual([l['id'] for l in likes], map(str, range(25)))
+        # 3 pages and the empty last page
+        self.assertEqual(self.server.request_count, 4)
+
+    def test_prefetch(self):
+        from open_facebook.utils import chunks
+        graph = OpenFacebook('token')
+        likes = graph.iterate('me/likes', page_size=10, prefetch=True)
+        first = likes.next()
+        self.assertEqual(first['id'], '0')
+        chunked = list(chunks(likes, 10))
+        self.assertEqual([len(c) for c in chunked], [10, 10, 4])
+
+    def test_prefetch_in_async_worker(self):
+        import threading
+        from open_facebook.api import get_async_pool
+        graph = OpenFacebook('token')
+        pool = get_async_pool()
+        # keep all the other workers busy
+        release = threading.Event()
+        for x in range(len(pool._pool) - 1):
+            pool.apply_async(release.wait, (10,))
+
+        def iterate():
+            likes = graph.iterate('me/likes', page_size=10, prefetch=True)
+            return [l['id'] for l in likes]
+        try:
+            ids = pool.apply_async(iterate).get(5)
+        finally:
+            release.set()
+        self.assertEqual(ids, map(str, range(25)))
+
+    def test_not_cached(self):
+        graph = OpenFacebook('token')
+        with mock.patch('django_facebook.settings.FACEBOOK_RESPONSE_CACHE', True):
+            for x in range(2):
+                self.assertEqual(len(list(graph.iterate(
+                    'me/likes', page_size=10))), 25)
+        # the first page is fetched again, like the others
+        self.assertEqual(self.server.request_count, 8)
+
+
+class ResilienceTest(OfflineTest):
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.server.add_response('down', 'Sorry, something went wrong.', 500)
+
+    def test_backoff(self):
+        from open_facebook.resilience import RetryPolicy
+        policy = RetryPolicy(attempts=3, base_delay=1, max_delay=3,
+                             budget_ratio=0, budget_minimum=1)
+        for x in range(20):
+            self.assertTrue(0 <= policy.delay(4) <= 3)
+        policy.record_request()
+        self.assertTrue(policy.should_retry(2))
+        # the budget only allows a single retry
+        self.assertFalse(policy.should_retry(2))
+        self.assertFalse(policy.should_retry(4))
+
+    def test_circuit_breaker(self):
+        from open_facebook.resilience import CircuitBreaker
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+        import time
+        time.sleep(0.1)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        # only a single probe is let through
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_fail_fast(self):
+        from open_facebook.resilience import circuit_breaker
+        graph = OpenFacebook('token')
+        with mock.patch('time.sleep'):
+            for x in range(circuit_breaker.failure_threshold):
+                self.assertRaises(facebook_exceptions.FacebookUnreachable,
+                                  graph.get, 'down')
+        requests = self.server.request_count
+        self.assertTrue(circuit_breaker.is_open())
+        self.assertRaises(facebook_exceptions.FacebookCircuitOpen,
+                          graph.get, 'down')
+        self.assertEqual(self.server.request_count, requests)
+
+
+class ResponseCacheTest(OfflineTest):
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.server.add_response('me', dict(id='123', name='Thierry'))
+        self.server.add_response(
+            'me/permissions', dict(data=[dict(read_stream=1)]))
+        self.server.add_response('me/feed', dict(id='123_1'))
+        self.server.add_response('123', dict(id='123'))
+        self.patcher = mock.patch(
+            'django_facebook.settings.FACEBOOK_RESPONSE_CACHE', True)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        OfflineTest.tearDown(self)
+
+    def test_cache(self):
+        graph = OpenFacebook('token')
+        for x in range(3):
+            me = graph.get('me')
+            # modifying the response doesn't change the cache
+            me['name'] = 'changed'
+            graph.permissions()
+        self.assertEqual(graph.get('me')['name'], 'Thierry')
+        self.assertEqual(self.server.paths, ['me', 'me/permissions'])
+        # params and tokens are part of the key
+        graph.get('me', fields='id')
+        OpenFacebook('other').get('me')
+        self.assertEqual(self.server.request_count, 4)
+
+    def test_invalidation(self):
+        graph = OpenFacebook('token')
+        graph.get('me')
+        graph.get('123')
+        graph.set('me/feed', message='hello')
+        graph.get('me')
+        graph.get('123')
+        self.assertEqual(self.server.paths,
+                         ['me', '123', 'me/feed', 'me'])
+
+    def test_lru(self):
+        from open_facebook.cache import LRUCache
+        lru = LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('d', 4, timeout=-1)
+        self.assertEqual(lru.get('d'), None)
+        self.assertEqual(len(lru), 1)
+
+
+class SingleFlightTest(OfflineTest):
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        import time
+
+        def slow_response(handler):
+            time.sleep(0.3)
+            return dict(id='123', name='Thierry')
+        self.server.add_response('me', slow_response)
+
+    def test_merge(self):
+        import threading
+        from open_facebook.api import single_flight
+        merged = single_flight.stats()['merged']
+        results = []
+
+        def get_me():
+            results.append(OpenFacebook('token').get('me'))
+        threads = [threading.Thread(target=get_me) for x in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [dict(id='123', name='Thierry')] * 5)
+        self.assertEqual(self.server.request_count, 1)
+        self.assertEqual(single_flight.stats()['merged'] - merged, 4)
+
+    def test_errors(self):
+        from open_facebook.utils import SingleFlight
+        single_flight = SingleFlight()
+
+        def fail():
+            raise ValueError('failed')
+        self.assertRaises(ValueError, single_flight.do, 'key', fail)
+        self.assertEqual(single_flight.stats()['in_flight'], 0)
+
+
+class PermissionsCacheTest(OfflineTest):
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        self.server.add_response(
+            'me/permissions', dict(data=[dict(read_stream=1)]))
+        error = dict(error=dict(type='OAuthException', code=200,
+                                message='(#200) Requires publish_actions'))
+        self.server.add_response('me/feed', error, 403)
+
+    def test_cached_permissions(self):
+        graph = OpenFacebook('token')
+        for x in range(3):
+            self.assertTrue(graph.has_permissions(['read_stream']))
+        self.assertFalse(graph.has_permissions(['publish_actions']))
+        self.assertEqual(self.server.paths, ['me/permissions'])
+        # a permission error clears the cache
+        self.assertRaises(facebook_exceptions.PermissionException,
+                          graph.set, 'me/feed', message='hello')
+        self.assertTrue(graph.has_permissions(['read_stream']))
+        self.assertEqual(self.server.paths,
+                         ['me/permissions', 'me/feed', 'me/permissions'])
+
+    def test_response_cache(self):
+        graph = OpenFacebook('token')
+        self.server.add_response('me/permissions', dict(
+            data=[dict(read_stream=1, publish_actions=1)]))
+        with mock.patch('django_facebook.settings.FACEBOOK_RESPONSE_CACHE', True):
+            self.assertTrue(graph.has_permissions(['publish_actions']))
+            # the permission was revoked
+            self.server.add_response(
+                'me/permissions', dict(data=[dict(read_stream=1)]))
+            self.assertRaises(facebook_exceptions.PermissionException,
+                              graph.set, 'me/feed', message='hello')
+            self.assertFalse(graph.has_permissions(['publish_actions']))
+        self.assertEqual(self.server.paths,
+                         ['me/permissions', 'me/feed', 'me/permissions'])
+
+
+class SignedRequestCacheTest(unittest.TestCase):
+
+    def make_signed_request(self, data, secret='secret'):
+        import base64
+        import hashlib
+        import hmac
+        payload = base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+        signature = hmac.new(secret, msg=payload,
+                             digestmod=hashlib.sha256).digest()
+        encoded_signature = base64.urlsafe_b64encode(signature).rstrip('=')
+        return '%s.%s' % (encoded_signature, payload)
+
+    def test_cache(self):
+        import hmac
+        data = dict(algorithm='HMAC-SHA256', user_id='123', issued_at=1)
+        signed_request = self.make_signed_request(data)
+        with mock.patch('hmac.new', wraps=hmac.new) as hmac_new:
+            for x in range(3):
+                parsed = FacebookAuthorization.parse_signed_data(
+                    signed_request, secret='secret')
+                self.assertEqual(parsed['user_id'], '123')
+                parsed['user_id'] = 'changed'
+            self.assertEqual(hmac_new.call_count, 1)
+            # a different secret needs its own verification
+            with mock.patch('open_facebook.api.send_warning'):
+                parsed = FacebookAuthorization.parse_signed_data(
+                    signed_request, secret='other')
+            self.assertEqual(parsed, None)
+            self.assertEqual(hmac_new.call_count, 2)
+
+    def test_invalid_signature(self):
+        data = dict(algorithm='HMAC-SHA256', user_id='123', issued_at=2)
+        signed_request = self.make_signed_request(data, secret='wrong')
+        with mock.patch('open_facebook.api.send_warning'):
+            for x in range(2):
+                parsed = FacebookAuthorization.parse_signed_data(
+                    signed_request, secret='secret')
+                self.assertEqual(parsed, None)
+
+
+class TransportTest(OfflineTest):
+
+    def setUp(self):
+        OfflineTest.setUp(self)
+        import tempfile
+        self.server.add_response('me', dict(id='123', name='Thierry'))
+        self.server.add_response('me/feed', dict(error=dict(
+            type='OAuthException', code=200,
+            message='(#200) Requires publish_actions')), 403)
+        self.cassette = tempfile.mktemp(suffix='.json')
+
+    def tearDown(self):
+        import os
+        OfflineTest.tearDown(self)
+        if os.path.exists(self.cassette):
+            os.remove(self.cassette)
+
+    def test_record_replay(self):
+        from open_facebook.transport import RecordReplayTransport, \
+            CassetteError
+        transport = RecordReplayTransport(self.cassette, mode='record')
+        FacebookConnection.transport = transport
+        graph = OpenFacebook('secret-token')
+        self.assertEqual(graph.get('me')['name'], 'Thierry')
+        self.assertRaises(facebook_exceptions.PermissionException,
+                          graph.set, 'me/feed', message='hello')
+        transport.save()
+        self.assertFalse('secret-token' in open(self.cassette).read())
+        self.server.stop()
+
+        # replay without the server, using another token
+        FacebookConnection.transport = RecordReplayTransport(
+            self.cassette, latency=0.01)
+        graph = OpenFacebook('other-token')
+        self.assertEqual(graph.get('me')['name'], 'Thierry')
+        self.assertRaises(facebook_exceptions.PermissionException,
+                          graph.set, 'me/feed', message='hello')
+        self.assertRaises(CassetteError, graph.get, 'me/friends')
@@ -0,0 +1,273 @@
+'''
+Transports send the actual HTTP requests for FacebookConnection._request
+
+The parsing, retry and error mapping logic lives in _request, so swapping
+the transport exercises the full client stack. There are three built-ins
+
+Urllib2Transport
+    a new urllib2 connection for every request
+PooledTransport
+    reuses keep-alive connections from open_facebook.pool (the default)
+RecordReplayTransport
+    records real Graph responses to a cassette file and replays them,
+    optionally with latency, allowing offline benchmarking
+
+The default transport is configured with FACEBOOK_TRANSPORT, or set one
+directly on the connection class
+
+**Example**::
+
+    from open_facebook.transport import RecordReplayTransport
+    transport = RecordReplayTransport('graph.json', mode='record')
+    OpenFacebook.transport = transport
+    OpenFacebook(access_token).get('me')
+    transport.save()
+
+    # later, without network access
+    OpenFacebook.transport = RecordReplayTransport(
+        'graph.json', latency=(0.05, 0.2))
+'''
+from django_facebook import settings as facebook_settings
+from open_facebook.utils import json
+from StringIO import StringIO
+from urlparse import urlparse, urlunparse, parse_qsl
+import logging
+import mimetools
+import os
+import random
+import re
+import threading
+import time
+import urllib
+import urllib2
+
+logger = logging.getLogger(__name__)
+
+# finds access tokens in recorded urls and responses
+ACCESS_TOKEN_RE = re.compile(r'access_token=[^&"\s]+')
+
+
+class CassetteError(Exception):
+
+    '''
+    Raised when replaying a request which isn't in the cassette
+    '''
+    pass
+
+
+class BaseTransport(object):
+
+    '''
+    Transports implement open, which has the same semantics as
+    urllib2's OpenerDirector.open
+
+    It returns a file like response and raises urllib2.HTTPError for
+    error status codes and urllib2.URLError or ssl.SSLError when Facebook
+    can't be reached
+    '''
+    user_agent = 'Open Facebook Python'
+
+    def open(self, url, data=None, timeout=None):
+        raise NotImplementedError(
+            'transports should implement open(url, data, timeout)')
+
+
+class Urllib2Transport(BaseTransport):
+
+    '''
+    Opens a new connection for every request
+    '''
+
+    def build_opener(self):
+        return urllib2.build_opener()
+
+    def open(self, url, data=None, timeout=None):
+        # nicely identify ourselves before sending the request
+        opener = self.build_opener()
+        opener.addheaders = [('User-agent', self.user_agent)]
+        return opener.open(url, data, timeout=timeout)
+
+
+class PooledTransport(Urllib2Transport):
+
+    '''
+    Reuses keep-alive connections from the shared connection pool
+    '''
+
+    def build_opener(self):
+        from open_facebook.pool import build_opener
+        return build_opener()
+
+
+class RecordReplayTransport(BaseTransport):
+
+    '''
+    Records responses to a JSON cassette file and replays them
+
+    :param path:
+        the cassette file
+    :param mode:
+        replay, only use the cassette
+        record, always send the request and record the response
+        once, replay the recorded responses and record the missing ones
+    :param latency:
+        seconds to wait before replaying a response. Either a number,
+        a (min, max) tuple, 'recorded' for the latency of the recorded
+        response, or a callable receiving the request url
+    :param transport:
+        the transport used for recording, defaults to a PooledTransport
+
+    Access tokens are stripped from the recorded urls and responses.
+    Requests are matched on the method, url (without the access token) and
+    post data. Identical requests replay the recorded responses in turn.
+    '''
+    modes = ('replay', 'record', 'once')
+
+    def __init__(self, path, mode='replay', latency=0, transport=None):
+        if mode not in self.modes:
+            raise ValueError('mode should be one of %s' % (self.modes,))
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.transport = transport or PooledTransport()
+        self._lock = threading.Lock()
+        # maps request keys to a list of recorded responses
+        self.interactions = {}
+        # how many times every key was replayed
+        self.replayed = {}
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as cassette:
+            recorded = json.load(cassette)
+        interactions = {}
+        for interaction in recorded.get('interactions', []):
+            key = self.make_key(interaction['method'], interaction['url'],
+                                interaction.get('data'))
+            interactions.setdefault(key, []).append(interaction)
+        with self._lock:
+            self.interactions = interactions
+            self.replayed = {}
+
+    def save(self):
+        with self._lock:
+            interactions = []
+            for key in sorted(self.interactions):
+                interactions.extend(self.interactions[key])
+        with open(self.path, 'w') as cassette:
+            json.dump(dict(interactions=interactions), cassette,
+                      indent=2, sort_keys=True)
+
+    def strip_token(self, string):
+        if string:
+            string = ACCESS_TOKEN_RE.sub('access_token=TOKEN', string)
+        return string
+
+    def make_key(self, method, url, data=None):
+        '''
+        Requests are matched ignoring the access token and the order
+        of the parameters
+        '''
+        parsed = urlparse(url)
+        params = [(k, v) for k, v in parse_qsl(parsed.query, True)
+                  if k != 'access_token']
+        query = urllib.urlencode(sorted(params))
+        url = urlunparse(parsed[:4] + (query, ''))
+        post_params = [(k, v) for k, v in parse_qsl(data or '', True)
+                       if k != 'access_token']
+        key = '%s %s %s' % (method, url, urllib.urlencode(sorted(post_params)))
+        return key
+
+    def open(self, url, data=None, timeout=None):
+        method = 'POST' if data is not None else 'GET'
+        key = self.make_key(method, url, data)
+        interaction = None
+        if self.mode != 'record':
+            interaction = self.find(key)
+        if interaction is None:
+            if self.mode == 'replay':
+                raise CassetteError('no recorded response for %s' % key)
+            interaction = self.record(method, url, data, timeout)
+        else:
+            self.wait(interaction, url)
+        return self.build_response(url, interaction)
+
+    def find(self, key):
+        with self._lock:
+            recorded = self.interactions.get(key)
+            if not recorded:
+                return None
+            replayed = self.replayed.get(key, 0)
+            self.replayed[key] = replayed + 1
+            return recorded[replayed % len(recorded)]
+
+    def wait(self, interaction, url):
+        latency = self.latency
+        if latency == 'recorded':
+            latency = interaction.get('duration', 0)
+        elif callable(latency):
+            latency = latency(url)
+        elif isinstance(latency, tuple):
+            latency = random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    def record(self, method, url, data, timeout):
+        start = time.time()
+        response_file = None
+        try:
+            try:
+                response_file = self.transport.open(url, data, timeout)
+            except urllib2.HTTPError, e:
+                response_file = e
+            status = getattr(response_file, 'code', 200)
+            body = response_file.read()
+        finally:
+            if response_file is not None:
+                response_file.close()
+        interaction = dict(
+            method=method,
+            url=self.strip_token(url),
+            data=self.strip_token(data),
+            status=status,
+            body=self.strip_token(body.decode('utf8')),
+            duration=round(time.time() - start, 4),
+        )
+        key = self.make_key(method, url, data)
+        with self._lock:
+            self.interactions.setdefault(key, []).append(interaction)
+        logger.info('recorded %s', key)
+        return interaction
+
+    def build_response(self, url, interaction):
+        body = interaction['body'].encode('utf8')
+        status = interaction['status']
+        headers = mimetools.Message(StringIO(
+            'Content-Type: text/javascript; charset=UTF-8\r\n\r\n'))
+        if status >= 400:
+            raise urllib2.HTTPError(url, status, 'recorded error', headers,
+                                    StringIO(body))
+        response = urllib.addinfourl(StringIO(body), headers, url)
+        response.code = status
+        response.msg = 'OK'
+        return response
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport():
+    '''
+    Returns an instance of the FACEBOOK_TRANSPORT class
+    '''
+    global _default_transport
+    if _default_transport is None:
+        with _default_transport_lock:
+            if _default_transport is None:
+                from django_facebook.utils import get_class_from_string
+                transport_class = get_class_from_string(
+                    facebook_settings.FACEBOOK_TRANSPORT)
+                _default_transport = transport_class()
+    return _default_transport
@@ -1,7 +1,10 @@
 import logging
 import re
 import sys
+import copy
 import functools
+import itertools
+import threading
 
 logger = logging.getLogger(__name__)
 URL_PARAM_RE = re.compile('(?P<k>[^(=|&)]+)=(?P<v>[^&]+)(&|$)')
@@ -252,3 +255,81 @@ def is_json(content):
     except:
         is_json = False
     return is_json
+
+
+def chunks(iterable, size):
+    '''
+    Splits the iterable in lists of at most size items
+    Only one chunk is held in memory at a time
+
+    **Example**::
+
+        for likes in chunks(graph.iterate('me/likes'), 100):
+            store(likes)
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+class SingleFlight(object):
+
+    '''
+    Merges identical calls which are running at the same moment
+    The first caller for a key does the actual work, callers arriving
+    while it's running wait for it and get (a copy of) the same result,
+    or the same exception
+
+    **Example**::
+
+        single_flight = SingleFlight()
+        response = single_flight.do(url, fetch, url)
+        single_flight.stats()
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.merged = 0
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = dict(event=threading.Event())
+                self.calls += 1
+            else:
+                self.merged += 1
+
+        if not leader:
+            call['event'].wait()
+            if 'error' in call:
+                error_class, error, traceback = call['error']
+                raise error_class, error, traceback
+            return copy.deepcopy(call['result'])
+
+        try:
+            call['result'] = function(*args, **kwargs)
+        except:
+            call['error'] = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
+        return call['result']
+
+    def stats(self):
+        '''
+        Returns the number of calls made and the number of calls which were
+        merged into another call
+        '''
+        with self._lock:
+            stats = dict(calls=self.calls, merged=self.merged,
+                         in_flight=len(self._calls))
+        return stats